@@ -38,3 +38,6 @@ log_status_file_name: "${log_status_file_name}"
 
 # Int value for multiprocessing on child accounts in parallel
 processes: ${processes}
+
+# Seconds the whole run may take. Requests are not sent after the deadline and the remaining workspaces are logged as timed out.
+run_deadline: ${run_deadline}
@@ -2,10 +2,10 @@ locals {
   log_operation_file_name = "pi_image_ops_log.json"
   log_status_file_name    = "pi_image_status_log.json"
 
-  is_cos_data_valid                = (var.image_operation == "IMPORT" && var.cos_data != null) || var.image_operation == "DELETE" ? true : false
+  is_cos_data_valid                = (var.image_operation == "IMPORT" && var.cos_data != null) || var.image_operation == "DELETE" || var.image_operation == "STATUS" ? true : false
   cos_data_validate_msg            = "The cos_data is null. The import operation of custom images requires cos_data."
   cos_data_chk                     = regex("^${local.cos_data_validate_msg}$", (local.is_cos_data_valid ? local.cos_data_validate_msg : ""))
-  is_cos_image_file_name_valid     = (var.image_operation == "IMPORT" && var.cos_image_file_name != null && var.cos_image_file_name != "") || var.image_operation == "DELETE" ? true : false
+  is_cos_image_file_name_valid     = (var.image_operation == "IMPORT" && var.cos_image_file_name != null && var.cos_image_file_name != "") || var.image_operation == "DELETE" || var.image_operation == "STATUS" ? true : false
   cos_image_file_name_validate_msg = "The cos_image_file_name is null or empty. The import operation of custom images requires cos_image_file_name."
   cos_image_file_name_chk          = regex("^${local.cos_image_file_name_validate_msg}$", (local.is_cos_image_file_name_valid ? local.cos_image_file_name_validate_msg : ""))
 }
@@ -28,6 +28,7 @@ resource "local_file" "config_yaml" {
     log_operation_file_name = local.log_operation_file_name
     log_status_file_name    = local.log_status_file_name
     processes               = var.processes
+    run_deadline            = var.run_deadline
 
   })
 
@@ -54,6 +55,7 @@ resource "terraform_data" "trigger_vars" {
     cos_image_file_name     = var.cos_image_file_name
     log_operation_file_name = local.log_operation_file_name
     log_status_file_name    = local.log_status_file_name
+    run_deadline            = var.run_deadline
   }
 }
 
@@ -0,0 +1,385 @@
+"""
+Local stand-in for the IBM Cloud APIs used by the image sharing scripts.
+
+Each API (iam, enterprise, powervs, cos) is served on its own port from one shared in-memory state, so the
+endpoint classes of the scripts stay distinct and the relative page links of the enterprise API resolve as they
+do against IBM Cloud. Point the 'endpoints' section of config.yaml at the printed URLs.
+
+    python3 benchmark/mock_ibmcloud.py --accounts 50 --workspaces 4 --latency 0.05 --throttle-rate 0.01
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+SERVICES = ("iam", "enterprise", "powervs", "cos")
+ENTERPRISE_TOKEN = "enterprise-token"
+ACCOUNT_TOKEN_PREFIX = "account-token-"
+
+
+class MockIBMCloud:
+    """
+    In-memory enterprise with N child accounts of M Power Virtual Server workspaces each.
+
+    Args:
+        accounts: Number of child accounts, each with a trusted profile.
+        workspaces: Number of workspaces per account.
+        latency: Seconds added to every response.
+        latency_jitter: Up to this many random seconds added on top of latency.
+        error_rate: Share of requests answered with a 500 error.
+        throttle_rate: Share of requests answered with a 429 error.
+        retry_after: Retry-After seconds sent with 429 errors.
+        capacity: Requests served at the same time, further ones are answered with a 429 error. 0 for no limit.
+        page_size: Largest page returned by the paginated profiles and accounts APIs.
+        job_seconds: Seconds an image import or delete takes to complete.
+        image_name: Name of the boot image imported by the scripts.
+        existing_image_ratio: Share of workspaces which already have the image, e.g. for DELETE runs.
+        regions: Location regions assigned to the workspaces round robin.
+        token_expires_in: Lifetime in seconds of the issued IAM tokens.
+        seed: Seed of the error injection, for repeatable runs.
+    """
+
+    def __init__(
+        self,
+        accounts=10,
+        workspaces=2,
+        latency=0.0,
+        latency_jitter=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after=1,
+        capacity=0,
+        page_size=100,
+        job_seconds=1.0,
+        image_name="test-image",
+        existing_image_ratio=0.0,
+        regions=("us-east",),
+        token_expires_in=3600,
+        seed=None,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.capacity = capacity
+        self.in_flight = 0
+        self.page_size = page_size
+        self.job_seconds = job_seconds
+        self.image_name = image_name
+        self.token_expires_in = token_expires_in
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.servers = {}
+        self.started_at = None
+
+        self.accounts = [{"id": f"account-{i:06d}", "name": f"Account {i}"} for i in range(accounts)]
+        self.workspaces = {}
+        # Boot images and the latest import job per workspace id
+        self.images = {}
+        self.jobs = {}
+        for account in self.accounts:
+            self.workspaces[account["id"]] = []
+            for j in range(workspaces):
+                workspace_id = f"{account['id']}-ws-{j:03d}"
+                self.workspaces[account["id"]].append(
+                    {
+                        "id": workspace_id,
+                        "name": f"workspace-{j}",
+                        "details": {"crn": f"crn:v1:bluemix:public:power-iaas:us-east:a/{account['id']}:{workspace_id}::"},
+                        "location": {"region": regions[j % len(regions)]},
+                    }
+                )
+                self.images[workspace_id] = {}
+                if self.random.random() < existing_image_ratio:
+                    self.images[workspace_id][f"{workspace_id}-image"] = {"name": image_name, "active_at": 0, "gone_at": None}
+
+    def start(self, host="127.0.0.1", base_port=0):
+        """
+        Starts one server thread per API. With base_port 0 free ports are picked.
+
+        Returns:
+            Dictionary with the base URL of each API, in the format of the 'endpoints' config section.
+        """
+        for offset, service in enumerate(SERVICES):
+            server = ThreadingHTTPServer((host, base_port + offset if base_port else 0), MockRequestHandler)
+            server.daemon_threads = True
+            server.mock = self
+            server.service = service
+            self.servers[service] = server
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        for workspace_list in self.workspaces.values():
+            for workspace in workspace_list:
+                workspace["location"]["url"] = self.endpoints["powervs"]
+        self.started_at = time.monotonic()
+        return self.endpoints
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    @property
+    def endpoints(self):
+        return {service: f"http://{server.server_address[0]}:{server.server_address[1]}" for service, server in self.servers.items()}
+
+    def get_stats(self):
+        """
+        Returns the request counters: total, per API, per status code and per API call.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        stats["elapsed"] = time.monotonic() - self.started_at if self.started_at else 0
+        return stats
+
+    def count(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.stats[key] += 1
+
+    def inject_fault(self):
+        """
+        Returns (status, headers) of an injected error, or None to answer the request normally.
+        """
+        if self.capacity and self.in_flight > self.capacity:
+            return 429, {"Retry-After": str(self.retry_after)}
+        draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429, {"Retry-After": str(self.retry_after)}
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, {}
+        return None
+
+    def list_images(self, workspace_id):
+        """
+        Returns the boot images of a workspace as listed by the PowerVS API, dropping completed deletes.
+        """
+        now = time.monotonic()
+        images = self.images[workspace_id]
+        for image_id, image in list(images.items()):
+            if image["gone_at"] is not None and now >= image["gone_at"]:
+                del images[image_id]
+        return [
+            {"imageID": image_id, "name": image["name"], "state": "active" if now >= image["active_at"] else "queued"}
+            for image_id, image in images.items()
+        ]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the connection pooling of the scripts is exercised as against IBM Cloud
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        mock = self.server.mock
+        service = self.server.service
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        url = urlparse(self.path)
+        if url.path == "/__stats":
+            self.send_json(200, mock.get_stats())
+            return
+
+        with mock.lock:
+            mock.in_flight += 1
+        try:
+            if mock.latency or mock.latency_jitter:
+                time.sleep(mock.latency + mock.random.uniform(0, mock.latency_jitter))
+            fault = mock.inject_fault()
+        finally:
+            with mock.lock:
+                mock.in_flight -= 1
+        if fault:
+            status, headers = fault
+            mock.count("requests", f"requests.{service}", f"status.{status}")
+            self.send_json(status, {"errors": [{"code": status, "message": "Injected by the mock server."}]}, headers)
+            return
+
+        route = getattr(self, f"route_{service}")
+        status, payload = route(method, url.path, parse_qs(url.query), body)
+        mock.count("requests", f"requests.{service}", f"status.{status}", f"call.{service}.{method}")
+        self.send_json(status, payload)
+
+    def send_json(self, status, payload, headers=None):
+        data = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def get_bearer_token(self):
+        return (self.headers.get("Authorization") or "").removeprefix("Bearer ")
+
+    def route_iam(self, method, path, query, body):
+        mock = self.server.mock
+        if method == "POST" and path == "/identity/token":
+            form = parse_qs(body.decode("utf-8"))
+            grant_type = form.get("grant_type", [""])[0]
+            if grant_type == "urn:ibm:params:oauth:grant-type:apikey":
+                token = ENTERPRISE_TOKEN
+            elif grant_type == "urn:ibm:params:oauth:grant-type:assume":
+                if form.get("access_token", [""])[0] != ENTERPRISE_TOKEN:
+                    return 401, {"errorMessage": "Invalid enterprise access token."}
+                token = ACCOUNT_TOKEN_PREFIX + form.get("account_id", [""])[0]
+            else:
+                return 400, {"errorMessage": f"Unsupported grant type '{grant_type}'."}
+            return 200, {"access_token": token, "token_type": "Bearer", "expires_in": mock.token_expires_in}
+
+        if method == "GET" and path == "/identity/profiles":
+            page_size = min(int(query.get("pagesize", [mock.page_size])[0]), mock.page_size)
+            start = int(query.get("pagetoken", ["0"])[0])
+            profiles = [
+                {"id": f"Profile-{account['id']}", "name": f"profile-{account['name']}", "account_id": account["id"]}
+                for account in mock.accounts[start : start + page_size]
+            ]
+            page = {"profiles": profiles}
+            if start + page_size < len(mock.accounts):
+                page["next"] = f"{mock.endpoints['iam']}/identity/profiles?{urlencode({'pagesize': page_size, 'pagetoken': start + page_size})}"
+            return 200, page
+        return 404, {"errorMessage": f"No route for {method} {path}."}
+
+    def route_enterprise(self, method, path, query, body):
+        mock = self.server.mock
+        if self.get_bearer_token() != ENTERPRISE_TOKEN:
+            return 401, {"message": "Invalid access token."}
+        if method == "GET" and path == "/v1/accounts":
+            start = int(query.get("next_docid", ["0"])[0])
+            page = {"resources": mock.accounts[start : start + mock.page_size]}
+            if start + mock.page_size < len(mock.accounts):
+                next_query = {key: values[0] for key, values in query.items()}
+                next_query["next_docid"] = start + mock.page_size
+                page["next_url"] = f"/v1/accounts?{urlencode(next_query)}"
+            return 200, page
+        if method == "GET" and path.startswith("/v1/accounts/"):
+            account_id = path.rsplit("/", 1)[1]
+            account = next((account for account in mock.accounts if account["id"] == account_id), None)
+            return (200, account) if account else (404, {"message": f"Account {account_id} not found."})
+        return 404, {"message": f"No route for {method} {path}."}
+
+    def route_powervs(self, method, path, query, body):
+        mock = self.server.mock
+        token = self.get_bearer_token()
+        if not token.startswith(ACCOUNT_TOKEN_PREFIX):
+            return 401, {"description": "Invalid access token."}
+        account_id = token.removeprefix(ACCOUNT_TOKEN_PREFIX)
+        if method == "GET" and path == "/v1/workspaces":
+            return 200, {"workspaces": mock.workspaces.get(account_id, [])}
+
+        # /pcloud/v1/cloud-instances/{workspace_id}/images[/{image_id}] and /cos-images
+        parts = path.strip("/").split("/")
+        if len(parts) < 5 or parts[:3] != ["pcloud", "v1", "cloud-instances"]:
+            return 404, {"description": f"No route for {method} {path}."}
+        workspace_id, resource = parts[3], parts[4]
+        if workspace_id not in mock.images or not workspace_id.startswith(account_id):
+            return 404, {"description": f"Workspace {workspace_id} not found."}
+
+        with mock.lock:
+            now = time.monotonic()
+            if resource == "images" and method == "GET" and len(parts) == 5:
+                return 200, {"images": mock.list_images(workspace_id)}
+            if resource == "images" and method == "DELETE" and len(parts) == 6:
+                image = mock.images[workspace_id].get(parts[5])
+                if not image:
+                    return 404, {"description": f"Image {parts[5]} not found."}
+                image["gone_at"] = now + mock.job_seconds
+                return 200, {}
+            if resource == "cos-images" and method == "POST":
+                # One import job per workspace at a time
+                if workspace_id in mock.jobs and now < mock.jobs[workspace_id]["completes_at"]:
+                    return 409, {"description": "An image import job is already running in this workspace."}
+                request_data = json.loads(body or b"{}")
+                mock.jobs[workspace_id] = {"completes_at": now + mock.job_seconds}
+                mock.images[workspace_id][f"{workspace_id}-image-{int(now * 1000)}"] = {
+                    "name": request_data.get("imageName", mock.image_name),
+                    "active_at": now + mock.job_seconds,
+                    "gone_at": None,
+                }
+                return 202, {"id": f"{workspace_id}-job", "status": {"state": "queued"}}
+            if resource == "cos-images" and method == "GET":
+                job = mock.jobs.get(workspace_id)
+                if not job:
+                    return 404, {"description": "No image import job found."}
+                return 200, {"id": f"{workspace_id}-job", "status": {"state": "completed" if now >= job["completes_at"] else "running"}}
+        return 404, {"description": f"No route for {method} {path}."}
+
+    def route_cos(self, method, path, query, body):
+        # HEAD /{bucket}/{object}: every object exists
+        if method == "HEAD" and path.count("/") >= 2:
+            return 200, None
+        return 404, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the IBM Cloud APIs used by the image sharing scripts.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100, help="Port of the iam API, the enterprise, powervs and cos APIs use the next ones.")
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--workspaces", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--capacity", type=int, default=0, help="Requests served at the same time before answering 429.")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--job-seconds", type=float, default=1.0)
+    parser.add_argument("--image-name", default="test-image")
+    parser.add_argument("--existing-image-ratio", type=float, default=0.0)
+    parser.add_argument("--regions", default="us-east", help="Comma separated location regions of the workspaces.")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    mock = MockIBMCloud(
+        accounts=args.accounts,
+        workspaces=args.workspaces,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        capacity=args.capacity,
+        page_size=args.page_size,
+        job_seconds=args.job_seconds,
+        image_name=args.image_name,
+        existing_image_ratio=args.existing_image_ratio,
+        regions=args.regions.split(","),
+        seed=args.seed,
+    )
+    endpoints = mock.start(args.host, args.port)
+    print("endpoints:")
+    for service, url in endpoints.items():
+        print(f'  {service}: "{url}"')
+    print(f"Enterprise ID: any, account group ID: any, accounts: {', '.join(account['id'] for account in mock.accounts[:3])}, ...")
+    print(f"Request counters: {endpoints['iam']}/__stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
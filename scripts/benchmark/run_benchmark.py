@@ -0,0 +1,245 @@
+"""
+Scaling benchmark of the image sharing scripts against the local mock IBM Cloud server.
+
+For every size of the matrix a fresh mock enterprise of N accounts x M workspaces is started, main.py is run
+against it with a generated config, and the wall time, the requests per second served by the mock and the peak
+memory of the main.py process tree are reported. Memory is the summed PSS of the tree where /proc provides it,
+so pages shared by forked pool workers are not counted once per worker.
+
+    python3 benchmark/run_benchmark.py --matrix 10x2,100x4 --latency 0.05 --set execution_engine=asyncio
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from mock_ibmcloud import MockIBMCloud
+
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def parse_matrix(matrix):
+    """
+    Parses '10x2,100x4' into [(10, 2), (100, 4)].
+    """
+    sizes = []
+    for size in matrix.split(","):
+        accounts, workspaces = size.lower().split("x")
+        sizes.append((int(accounts), int(workspaces)))
+    return sizes
+
+
+def parse_overrides(overrides):
+    """
+    Parses 'key.subkey=value' config overrides, the value is read as YAML.
+    """
+    parsed = {}
+    for override in overrides:
+        key, value = override.split("=", 1)
+        parsed[key] = yaml.safe_load(value)
+    return parsed
+
+
+def build_config(endpoints, operation, run_dir, overrides):
+    """
+    Builds the config of a benchmark run from scripts/config.yaml, pointed at the mock server.
+
+    Status polling is shortened to match the simulated job times and the client rate limit is lifted,
+    override either with --set to benchmark them.
+    """
+    with open(os.path.join(SCRIPTS_DIR, "config.yaml")) as file:
+        config = yaml.safe_load(file)
+    config.update(
+        {
+            "enterprise_id": "benchmark-enterprise",
+            "account_group_id": "benchmark-group",
+            "account_list": None,
+            "image_operation": operation,
+            "endpoints": endpoints,
+            "status_poll": {"initial_interval": 0.5, "max_interval": 2, "backoff_factor": 2, "deadline": 600, "concurrency": 16},
+            "rate_limit": {"requests_per_second": 10000, "burst": 10000},
+            "log_operation_file_name": os.path.join(run_dir, "pi_image_ops_log.json"),
+            "log_status_file_name": os.path.join(run_dir, "pi_image_status_log.json"),
+            "journal": {"file_name": os.path.join(run_dir, "pi_image_ops_journal.jsonl"), "resume": False},
+            "inventory_cache": {"directory": ""},
+        }
+    )
+    config["cos_bucket_details"]["cos_bucket"] = "benchmark-bucket"
+    for key, value in overrides.items():
+        section = config
+        *parents, leaf = key.split(".")
+        for parent in parents:
+            section = section.setdefault(parent, {})
+        section[leaf] = value
+    return config
+
+
+def get_process_memory(pid):
+    """
+    Returns the memory of a process in bytes: its proportional set size when the kernel reports it, so pages
+    shared by forked pool workers are counted once across the tree, otherwise its resident set size.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def get_process_tree_rss(root_pid):
+    """
+    Returns the summed memory in bytes of a process and all its descendants, read from /proc.
+    """
+    children = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # The command name may contain spaces, the fields after it are fixed
+                parent_pid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent_pid, []).append(int(pid))
+
+    total = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        try:
+            total += get_process_memory(pid)
+        except (OSError, IndexError, ValueError):
+            # The process exited while sampling
+            pass
+        stack.extend(children.get(pid, []))
+    return total
+
+
+def run_main(config_file, run_dir, sample_interval):
+    """
+    Runs main.py with the given config and samples the memory of its process tree until it exits.
+
+    Returns:
+        (exit_code, wall_time, peak_rss): peak_rss is in bytes, from /proc sampling when available,
+        otherwise the largest single child process reported by getrusage.
+    """
+    env = dict(os.environ, IMAGE_SHARING_CONFIG=config_file, IBMCLOUD_API_KEY="benchmark-key", COS_ACCESS_KEY="benchmark", COS_SECRET_KEY="benchmark")
+    started = time.monotonic()
+    with open(os.path.join(run_dir, "console.out"), "w") as output:
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, "main.py")], cwd=run_dir, env=env, stdout=output, stderr=subprocess.STDOUT)
+        peak_rss = 0
+        if os.path.isdir("/proc"):
+            while process.poll() is None:
+                peak_rss = max(peak_rss, get_process_tree_rss(process.pid))
+                time.sleep(sample_interval)
+        exit_code = process.wait()
+    wall_time = time.monotonic() - started
+    if not peak_rss:
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return exit_code, wall_time, peak_rss
+
+
+def run_benchmark(accounts, workspaces, args, overrides):
+    """
+    Runs main.py against a fresh mock enterprise of the given size.
+
+    Returns:
+        Dictionary with the measurements of the run.
+    """
+    mock = MockIBMCloud(
+        accounts=accounts,
+        workspaces=workspaces,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        capacity=args.capacity,
+        page_size=args.page_size,
+        job_seconds=args.job_seconds,
+        existing_image_ratio=1.0 if args.operation == "DELETE" else args.existing_image_ratio,
+        regions=args.regions.split(","),
+        seed=args.seed,
+    )
+    endpoints = mock.start()
+    try:
+        run_dir = tempfile.mkdtemp(prefix=f"benchmark-{accounts}x{workspaces}-")
+        config_file = os.path.join(run_dir, "config.yaml")
+        with open(config_file, "w") as file:
+            yaml.safe_dump(build_config(endpoints, args.operation, run_dir, overrides), file)
+        exit_code, wall_time, peak_rss = run_main(config_file, run_dir, args.sample_interval)
+        stats = mock.get_stats()
+    finally:
+        mock.stop()
+
+    requests_sent = stats.get("requests", 0)
+    return {
+        "accounts": accounts,
+        "workspaces": workspaces,
+        "exit_code": exit_code,
+        "wall_time": round(wall_time, 3),
+        "requests": requests_sent,
+        "requests_per_second": round(requests_sent / wall_time, 1) if wall_time else 0,
+        "throttled": stats.get("status.429", 0),
+        "server_errors": stats.get("status.500", 0),
+        "peak_rss_mb": round(peak_rss / 2**20, 1),
+        "run_dir": run_dir,
+        "mock_stats": {key: value for key, value in stats.items() if key != "elapsed"},
+    }
+
+
+def print_table(results):
+    columns = ("accounts", "workspaces", "exit_code", "wall_time", "requests", "requests_per_second", "throttled", "server_errors", "peak_rss_mb")
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.py against the local mock IBM Cloud server at N accounts x M workspaces.")
+    parser.add_argument("--matrix", default="10x2,50x4", help="Comma separated sizes as ACCOUNTSxWORKSPACES.")
+    parser.add_argument("--operation", default="IMPORT", choices=("IMPORT", "DELETE", "STATUS"))
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE", help="Config override, e.g. processes=16 or status_poll.concurrency=32.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every mock response.")
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--capacity", type=int, default=0, help="Requests the mock serves at the same time before answering 429.")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--job-seconds", type=float, default=1.0)
+    parser.add_argument("--existing-image-ratio", type=float, default=0.0)
+    parser.add_argument("--regions", default="us-east", help="Comma separated location regions of the mock workspaces.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sample-interval", type=float, default=0.05, help="Seconds between RSS samples.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    overrides = parse_overrides(args.overrides)
+    results = []
+    for accounts, workspaces in parse_matrix(args.matrix):
+        print(f"Running {args.operation} on {accounts} accounts x {workspaces} workspaces ...", flush=True)
+        results.append(run_benchmark(accounts, workspaces, args, overrides))
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    if any(result["exit_code"] for result in results):
+        print("Some runs failed, see console.out in their run directory.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
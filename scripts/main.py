@@ -1,68 +1,171 @@
-from src.ibmcloud_cos import *
-from src.ibmcloud_utils import *
-from src.log_utils import *
-from src.constants import CONFIG, validate_config
+import argparse
+import logging
+import os
+import sys
+import time
+
+from src.adaptive_limit import report_adaptive_limit, start_adaptive_limit
+from src.api_requests import set_run_deadline
+from src.ibmcloud_cos import object_exists_in_ibm_cos
+from src.ibmcloud_iam import build_trusted_profile_index, get_trusted_profiles, iter_account_list
+from src.custom_logger import merge_image_op_logs, merge_status_logs
+from src.ibmcloud_utils import create_account_identity_map, filter_trusted_profiles, get_enterprise_bearer_token, image_ops_on_child_accounts, write_logs_to_file
+from src.log_utils import configure_logging
+from src.metrics import track_phase, write_metrics
+from src.regions import start_region_slots
+from src.result_stream import start_stream
+from src.run_journal import start_journal
+from src.constants import CONFIG, get_daemon_url, get_image_specs, is_plan_run, validate_config
 
 pi_logger = logging.getLogger("logger")
 
-## get env vars
-ibmcloud_api_key = os.getenv("IBMCLOUD_API_KEY")
-access_key = os.getenv("COS_ACCESS_KEY")
-secret_key = os.getenv("COS_SECRET_KEY")
 
-if __name__ == "__main__":
+def run():
     """
-    Main function to coordinate the script execution.
+    Runs the image operations of config.yaml, on the account list or account group of the enterprise.
+    Exits with 1 when the run fails, see the error logs.
     """
+    # Loaded by runs only, like the plan and STATUS modules below, a run handed to the daemon does not need them
+    from src.sharding import in_shard, is_sharded, start_shard
+
+    ## get env vars
+    ibmcloud_api_key = os.getenv("IBMCLOUD_API_KEY")
+    access_key = os.getenv("COS_ACCESS_KEY")
+    secret_key = os.getenv("COS_SECRET_KEY")
+
     # Validate config.yaml
     validate_config()
-    enterprise_id = CONFIG.get("enterprise_id")
-    # Authenticate and get the bearer token
-    enterprise_access_token = get_enterprise_bearer_token(ibmcloud_api_key)
-
-    # Fetch the list of trusted profiles
-    trusted_profiles = get_trusted_profiles(enterprise_access_token)
-
-    # Find the relevant account group ID
-    if CONFIG.get("account_group_id"):
-        # Fetch the list accounts in the respective account group
-        relevant_accounts = get_account_list(enterprise_id, CONFIG.get("account_group_id"), enterprise_access_token)
-        # Create a dictionary of relevant accounts for quick lookup
-        relevant_accounts_dict = {account["id"]: account["name"] for account in relevant_accounts}
-        # Filter the trusted profiles to include account ID, profile ID, and account name
-        filtered_trusted_profiles = filter_trusted_profiles(trusted_profiles, relevant_accounts_dict)
-
-    elif CONFIG.get("account_list"):
-        # Map all the account ids in account_list to their respective account name
-        relevant_accounts = create_account_identity_map(enterprise_access_token, CONFIG.get("account_list"))
-        # Filter the trusted profiles to include account ID, profile ID, and account name
-        filtered_trusted_profiles = filter_trusted_profiles(trusted_profiles, relevant_accounts)
-
-    if filtered_trusted_profiles:
-        image_operation = CONFIG.get("image_operation")
-        log_operation_file_name = CONFIG.get("log_operation_file_name")
-        log_status_file_name = CONFIG.get("log_status_file_name")
-        pi_logger.info(f"Initiating provided PowerVS boot image {image_operation} operation.")
-
-        if image_operation == "IMPORT":
-            # Check if cos credentials and image exists in bucket
-            object_exists_in_ibm_cos(
-                access_key,
-                secret_key,
-                CONFIG.get("cos_bucket_details")["cos_region"],
-                CONFIG.get("cos_bucket_details")["cos_bucket"],
-                CONFIG.get("cos_bucket_details")["cos_image_file_name"],
-            )
-            # Import the image
-            image_ops_on_child_accounts("import", filtered_trusted_profiles, enterprise_access_token, log_operation_file_name, log_status_file_name)
-
-        elif image_operation == "DELETE":
-            # Delete the image
-            image_ops_on_child_accounts("delete", filtered_trusted_profiles, enterprise_access_token, log_operation_file_name, log_status_file_name)
+    # A sharded run writes its own output files, see src/sharding.py
+    start_shard()
+    # Every outbound call stops at the run deadline, so a hung endpoint cannot stall the run
+    if CONFIG.get("run_deadline"):
+        set_run_deadline(time.time() + CONFIG.get("run_deadline"))
+    # Shared by the pool workers, so they are created before the workers are forked
+    start_adaptive_limit()
+    start_region_slots()
+    image_specs = get_image_specs()
+    # STATUS only reads the image states, it must not start over the journal and result stream of an import/delete run
+    status_scan = all(image_spec["operation"] == "status" for image_spec in image_specs)
+    if not status_scan:
+        # Start the checkpoint journal, or load it when resuming an interrupted run
+        start_journal()
+        # Start the result stream, so progress can be followed while the run is going
+        start_stream()
+    try:
+        enterprise_id = CONFIG.get("enterprise_id")
+        with track_phase("discovery"):
+            # Authenticate and get the bearer token
+            enterprise_access_token = get_enterprise_bearer_token(ibmcloud_api_key)
+
+            # Fetch the list of trusted profiles and index them by account ID
+            trusted_profile_index = build_trusted_profile_index(get_trusted_profiles(enterprise_access_token))
+
+            # Find the relevant account group ID
+            if CONFIG.get("account_group_id"):
+                filtered_trusted_profiles = []
+                # Fetch the accounts in the respective account group page by page, later pages are fetched while earlier ones are filtered
+                for relevant_accounts in iter_account_list(enterprise_id, CONFIG.get("account_group_id"), enterprise_access_token):
+                    # Create a dictionary of relevant accounts for quick lookup, with the accounts of this shard only
+                    relevant_accounts_dict = {account["id"]: account["name"] for account in relevant_accounts if in_shard(account["id"])}
+                    # Filter the trusted profiles to include account ID, profile ID, and account name
+                    filtered_trusted_profiles.extend(filter_trusted_profiles(trusted_profile_index, relevant_accounts_dict))
+
+            elif CONFIG.get("account_list"):
+                # Map all the account ids in account_list to their respective account name
+                relevant_accounts = create_account_identity_map(enterprise_access_token, [account_id for account_id in CONFIG.get("account_list") if in_shard(account_id)])
+                # Filter the trusted profiles to include account ID, profile ID, and account name
+                filtered_trusted_profiles = filter_trusted_profiles(trusted_profile_index, relevant_accounts)
+
+        if filtered_trusted_profiles:
+            log_operation_file_name = CONFIG.get("log_operation_file_name")
+            log_status_file_name = CONFIG.get("log_status_file_name")
+
+            for image_spec in image_specs:
+                if image_spec["operation"] not in ("import", "delete", "status"):
+                    pi_logger.error(f"Unidentified action '{image_spec['operation'].upper()}' passed. Supported operations are IMPORT, DELETE and STATUS.")
+                    sys.exit(1)
+                if image_spec["operation"] == "status" and not status_scan:
+                    pi_logger.error(f"STATUS cannot be combined with IMPORT or DELETE in one run, got it for image {image_spec['image_name']}.")
+                    sys.exit(1)
+                pi_logger.info(f"Initiating provided PowerVS boot image {image_spec['operation'].upper()} operation for image {image_spec['image_name']}.")
+
+            if status_scan:
+                from src.status_scan import image_status_on_child_accounts
+
+                # Only report the image states, nothing is imported or deleted
+                image_status_on_child_accounts(image_specs, filtered_trusted_profiles, enterprise_access_token, log_status_file_name)
+            else:
+                # Check if cos credentials and images exist in their buckets, each object once
+                cos_objects = {
+                    (cos["cos_region"], cos["cos_bucket"], cos["cos_image_file_name"])
+                    for cos in (image_spec["cos_bucket_details"] for image_spec in image_specs if image_spec["operation"] == "import")
+                }
+                with track_phase("cos_check"):
+                    for cos_region, cos_bucket, cos_image_file_name in sorted(cos_objects):
+                        object_exists_in_ibm_cos(access_key, secret_key, cos_region, cos_bucket, cos_image_file_name)
 
+                if is_plan_run():
+                    from src.plan import plan_image_ops_on_child_accounts
+
+                    # Only work out what the run would do
+                    plan_image_ops_on_child_accounts(image_specs, filtered_trusted_profiles, enterprise_access_token, CONFIG["plan"].get("file_name", "pi_image_ops_plan.json"))
+                else:
+                    # Import and delete all images in one pass over the accounts
+                    image_ops_on_child_accounts(image_specs, filtered_trusted_profiles, enterprise_access_token, log_operation_file_name, log_status_file_name)
+        elif is_sharded():
+            # Shards may come out empty on small account lists, their empty logs are still merged
+            pi_logger.warning("WARNING: Could not find relevant trusted profiles in this shard.")
+            if status_scan:
+                write_logs_to_file(merge_status_logs([]), CONFIG.get("log_status_file_name"))
+            elif not is_plan_run():
+                write_logs_to_file(merge_image_op_logs([]), CONFIG.get("log_operation_file_name"))
+                write_logs_to_file(merge_image_op_logs([]), CONFIG.get("log_status_file_name"))
         else:
-            pi_logger.error(f"Unidentified action '{image_operation}' passed. Supported operations are IMPORT and DELETE.")
+            pi_logger.error(f"Could not find relevant trusted profiles.")
             sys.exit(1)
+    finally:
+        report_adaptive_limit()
+        # Write the run metrics when the run ends, also when it exits on an error
+        write_metrics()
+
+
+def main():
+    """
+    Main function to coordinate the script execution.
+    """
+    parser = argparse.ArgumentParser(description="Imports, deletes or checks PowerVS boot images in the workspaces of the enterprise child accounts.")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=("run", "daemon", "merge"),
+        help="'daemon' starts the job API, see the 'daemon' section of config.yaml. 'merge' merges the logs of the shards of a sharded run.",
+    )
+    parser.add_argument("--shard-index", type=int, help="Shard of the accounts to work on, from 0, overrides 'sharding.index'.")
+    parser.add_argument("--shard-count", type=int, help="Number of shards, overrides 'sharding.count'.")
+    args = parser.parse_args()
+    # Kept in CONFIG, so they also reach a run handed to the daemon
+    for key, value in (("index", args.shard_index), ("count", args.shard_count)):
+        if value is not None:
+            CONFIG["sharding"] = {**(CONFIG.get("sharding") or {}), key: value}
+    configure_logging(level=CONFIG.get("log_level", "DEBUG"))
+    if args.command == "merge":
+        from src.sharding import merge_shard_logs
+
+        validate_config()
+        merge_shard_logs()
+    elif args.command == "daemon":
+        from src.daemon import serve
+
+        serve(run)
+    elif get_daemon_url():
+        from src.daemon import submit_job
+
+        # Hand the run to the daemon, which keeps tokens and the workspace inventory warm between runs
+        sys.exit(submit_job(get_daemon_url()))
     else:
-        pi_logger.error(f"Could not find relevant trusted profiles.")
-        sys.exit(1)
+        run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import logging
+import multiprocessing
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+from requests.exceptions import ConnectionError, Timeout
+
+from src.metrics import count_sleep, get_registry
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+# Endpoint classes with their own latency baseline, their calls take very different times
+ENDPOINT_CLASSES = ("iam", "enterprise", "powervs")
+# Smoothing of the recent latency and of the latency baseline it is compared with
+RECENT_WEIGHT = 0.2
+BASELINE_WEIGHT = 0.02
+
+# Positions in the shared state of AdaptiveLimit
+LIMIT, IN_FLIGHT, LAST_DECREASE, LOWEST, HIGHEST = range(5)
+RECENT = 5
+BASELINE = RECENT + len(ENDPOINT_CLASSES)
+
+# Limit of the run, created by main.py before the pool workers are forked. Workers get it from the pool initializer.
+_adaptive_limit = None
+
+
+class SlotTimeout(Exception):
+    """
+    Raised when no slot of the adaptive limit became free before the run deadline.
+    """
+
+
+class AdaptiveLimit:
+    """
+    Limits the API requests in flight over main.py and all its pool workers, with a limit which follows the
+    API conditions of the run (additive increase, multiplicative decrease).
+
+    Every request which completes in time raises the limit by 1/limit, so by one per round of requests.
+    A request throttled with 429, answered with 5xx or failed on the connection lowers the limit by
+    'backoff_ratio', as does a request of an endpoint class whose recent latency has grown past
+    'latency_tolerance' times its baseline, as the endpoint is queueing. The limit is lowered at most once per
+    recent latency, so one burst of errors counts once. It always stays between 'floor' and 'ceiling'.
+
+    The workers and threads doing the work are still started as configured, requests over the limit wait for
+    a slot, so the limit can only be reached when 'processes' x 'workspace_concurrency' (or 'async_concurrency')
+    is at least the ceiling.
+    """
+
+    def __init__(self, floor, ceiling, initial, backoff_ratio, latency_tolerance):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        # Shared memory and a process-shared lock, so forked pool workers use the same limit as the parent
+        self._condition = multiprocessing.Condition()
+        self._state = multiprocessing.RawArray("d", BASELINE + len(ENDPOINT_CLASSES))
+        self._state[LIMIT] = self._state[LOWEST] = self._state[HIGHEST] = initial
+
+    def acquire(self, timeout=None):
+        """
+        Blocks until a request may be sent.
+
+        Args:
+            timeout: Seconds to wait at most, e.g. the time left until the run deadline. None waits until a slot is free.
+        Returns:
+            Seconds spent waiting.
+        Raises:
+            SlotTimeout: No slot became free within timeout.
+        """
+        started = time.monotonic()
+        with self._condition:
+            while self._state[IN_FLIGHT] >= int(self._state[LIMIT]):
+                remaining = None if timeout is None else timeout - (time.monotonic() - started)
+                if remaining is not None and remaining <= 0:
+                    raise SlotTimeout(f"No request slot became free within {timeout:.1f} seconds.")
+                self._condition.wait(remaining)
+            self._state[IN_FLIGHT] += 1
+        return time.monotonic() - started
+
+    def release(self, endpoint_class, latency, status):
+        """
+        Frees the slot of a request and adapts the limit to its outcome.
+
+        Args:
+            endpoint_class: iam, enterprise or powervs.
+            latency: Seconds the request took.
+            status: Status code of the response, "error" when the connection failed or timed out,
+                None when the request failed for another reason, which does not change the limit.
+        """
+        with self._condition:
+            self._state[IN_FLIGHT] -= 1
+            if status == "error" or status == 429 or (isinstance(status, int) and status >= 500):
+                self.decrease(endpoint_class)
+            elif status is not None:
+                recent, baseline = self.observe_latency(endpoint_class, latency)
+                if recent > baseline * self.latency_tolerance:
+                    self.decrease(endpoint_class)
+                else:
+                    self._state[LIMIT] = min(self._state[LIMIT] + 1 / self._state[LIMIT], self.ceiling)
+                    self._state[HIGHEST] = max(self._state[HIGHEST], self._state[LIMIT])
+            self._condition.notify_all()
+
+    def observe_latency(self, endpoint_class, latency):
+        index = ENDPOINT_CLASSES.index(endpoint_class)
+        if not self._state[BASELINE + index]:
+            self._state[RECENT + index] = self._state[BASELINE + index] = latency
+        else:
+            self._state[RECENT + index] += RECENT_WEIGHT * (latency - self._state[RECENT + index])
+            self._state[BASELINE + index] += BASELINE_WEIGHT * (latency - self._state[BASELINE + index])
+        return self._state[RECENT + index], self._state[BASELINE + index]
+
+    def decrease(self, endpoint_class):
+        now = time.monotonic()
+        if now - self._state[LAST_DECREASE] < max(self._state[RECENT + ENDPOINT_CLASSES.index(endpoint_class)], 0.1):
+            return
+        self._state[LAST_DECREASE] = now
+        self._state[LIMIT] = max(self._state[LIMIT] * self.backoff_ratio, self.floor)
+        self._state[LOWEST] = min(self._state[LOWEST], self._state[LIMIT])
+
+    def get_limits(self):
+        """
+        Returns the current, lowest and highest limit of the run.
+        """
+        with self._condition:
+            return {"current": int(self._state[LIMIT]), "lowest": int(self._state[LOWEST]), "highest": int(self._state[HIGHEST])}
+
+    @contextmanager
+    def slot(self, endpoint_class, timeout=None):
+        """
+        Holds a slot while the block sends a request. The block sets 'status' of the yielded dictionary to the
+        status code of the response, connection errors and timeouts raised by the block are counted as errors.
+        Raises SlotTimeout, before the block runs, when no slot became free within timeout seconds.
+        """
+        count_sleep("adaptive_limit", self.acquire(timeout))
+        outcome = {"status": None}
+        started = time.monotonic()
+        try:
+            yield outcome
+        except (ConnectionError, Timeout):
+            outcome["status"] = "error"
+            raise
+        finally:
+            self.release(endpoint_class, time.monotonic() - started, outcome["status"])
+
+
+def get_adaptive_config():
+    return CONFIG.get("adaptive_concurrency") or {}
+
+
+def start_adaptive_limit():
+    """
+    Creates the adaptive limit of the run when 'adaptive_concurrency.enabled' is set.
+    """
+    adaptive_config = get_adaptive_config()
+    if not adaptive_config.get("enabled"):
+        set_adaptive_limit(None)
+        return
+    floor, initial, ceiling = adaptive_config.get("floor", 4), adaptive_config.get("initial", 16), adaptive_config.get("ceiling", 64)
+    if not floor <= initial <= ceiling:
+        pi_logger.error(f"ERROR: 'adaptive_concurrency' needs floor <= initial <= ceiling, got {floor}, {initial} and {ceiling}.")
+        sys.exit(1)
+    set_adaptive_limit(
+        AdaptiveLimit(
+            floor=floor,
+            ceiling=ceiling,
+            initial=initial,
+            backoff_ratio=adaptive_config.get("backoff_ratio", 0.7),
+            latency_tolerance=adaptive_config.get("latency_tolerance", 2.0),
+        )
+    )
+    pi_logger.info(f"INFO: Adaptive concurrency between {_adaptive_limit.floor} and {_adaptive_limit.ceiling} requests in flight.")
+
+
+def set_adaptive_limit(adaptive_limit):
+    global _adaptive_limit
+    _adaptive_limit = adaptive_limit
+
+
+def get_adaptive_limit():
+    return _adaptive_limit
+
+
+def adaptive_slot(endpoint_class, timeout=None):
+    """
+    Returns the slot of the adaptive limit for a request, see AdaptiveLimit.slot, or a no-op without adaptive concurrency.
+    """
+    if _adaptive_limit is None:
+        return nullcontext({})
+    return _adaptive_limit.slot(endpoint_class, timeout)
+
+
+def report_adaptive_limit():
+    """
+    Logs the limits reached by the run and adds them to the run metrics.
+    """
+    if _adaptive_limit is None:
+        return
+    limits = _adaptive_limit.get_limits()
+    for name, value in limits.items():
+        get_registry().set_gauge("adaptive_concurrency_limit", {"limit": name}, value)
+    pi_logger.info(f"INFO: Adaptive concurrency ended at {limits['current']} requests in flight, between {limits['lowest']} and {limits['highest']}.")
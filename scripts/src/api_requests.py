@@ -1,44 +1,350 @@
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
 import requests
-from requests.exceptions import HTTPError
-from src.log_utils import *
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+from src.adaptive_limit import SlotTimeout, adaptive_slot
+from src.metrics import count_retry, count_sleep, get_api_call, get_registry, observe_request
+from src.token_cache import token_cache
+from src.constants import CONFIG, get_endpoint
 
 pi_logger = logging.getLogger("logger")
 
+# One pooled session per process. Pool workers are forked from the parent, so the pid is
+# tracked to avoid sharing the parent's sockets with its children.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
 
-def get_request(url, headers=None, params=None):
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        pi_logger.info(f"GET request to {url} successful. Status code: {response.status_code}")
+# Token bucket per API host, shared by all threads of a process
+_rate_limiters = {}
+_rate_limiters_pid = None
+
+# Calls which can be repeated safely after a failure. Other calls are only retried on 429,
+# as the request was rejected before it was processed.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Wall clock time (epoch seconds) at which the run must stop sending requests, None when unlimited
+_run_deadline = None
+DEADLINE_EXCEEDED_ERROR = "Run deadline exceeded."
+
+# Default (connect, read) timeouts in seconds per endpoint class, overridable in the 'timeouts' section of config.yaml
+DEFAULT_TIMEOUTS = {
+    "iam": (5, 30),
+    "enterprise": (5, 30),
+    "powervs": (5, 60),
+    "cos": (5, 30),
+}
+
+
+def get_default_pool_maxsize():
+    """
+    Returns the largest number of threads of one process sending requests at the same time, so that each of them
+    keeps its connection in the pool instead of the pool discarding it after the request.
+    """
+    concurrencies = [
+        (CONFIG.get("status_poll") or {}).get("concurrency", 16),
+        CONFIG.get("discovery_concurrency", 16),
+        CONFIG.get("status_scan_concurrency", 32),
+        CONFIG.get("workspace_concurrency", 4),
+    ]
+    if CONFIG.get("execution_engine", "multiprocessing") == "asyncio":
+        concurrencies.append(CONFIG.get("async_concurrency", 64))
+    return max(concurrencies)
+
+
+def create_session():
+    """
+    Create an HTTP session which keeps connections alive and pools them per host.
+
+    Pool sizes are read from the 'http_pool' section of config.yaml, without pool_maxsize the pools
+    keep as many connections as the process has threads sending requests, see get_default_pool_maxsize.
+    Returns:
+        session: A requests.Session with pooled HTTP adapters mounted.
+    """
+    pool_config = CONFIG.get("http_pool") or {}
+    adapter = HTTPAdapter(
+        pool_connections=pool_config.get("pool_connections", 10),
+        pool_maxsize=pool_config.get("pool_maxsize") or get_default_pool_maxsize(),
+        pool_block=pool_config.get("pool_block", False),
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the HTTP session of the current process, creating it on first use.
+    Returns:
+        session: The pooled requests.Session of this process.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = create_session()
+                _session_pid = pid
+    return _session
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Allows 'rate' requests per second on average with bursts of up to 'burst' requests.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        Returns:
+            Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def set_run_deadline(deadline):
+    """
+    Sets the wall clock time (epoch seconds) after which no more requests are sent, or None for no deadline.
+    Pool workers receive the deadline of the parent through this function as their initializer.
+    """
+    global _run_deadline
+    _run_deadline = deadline
+
+
+def get_run_deadline():
+    return _run_deadline
+
+
+def get_remaining_time():
+    """
+    Returns the seconds left until the run deadline, or None when no deadline is set.
+    """
+    if _run_deadline is None:
+        return None
+    return _run_deadline - time.time()
+
+
+def is_deadline_exceeded():
+    remaining = get_remaining_time()
+    return remaining is not None and remaining <= 0
+
+
+def is_deadline_error(error):
+    """
+    Checks if an error returned by the request functions was caused by the run deadline.
+    """
+    return error == DEADLINE_EXCEEDED_ERROR
+
+
+def get_endpoint_class(url):
+    """
+    Returns the endpoint class (iam, enterprise or powervs) of a request url.
+    """
+    for endpoint_class in ("iam", "enterprise"):
+        if url.startswith(get_endpoint(endpoint_class) + "/"):
+            return endpoint_class
+    return "powervs"
+
+
+def get_timeout(endpoint_class):
+    """
+    Returns the (connect, read) timeout of an endpoint class, shortened to the time left until the run deadline.
+
+    Args:
+        endpoint_class: iam, enterprise, powervs or cos.
+    Returns:
+        (connect_timeout, read_timeout) in seconds.
+    """
+    default_connect, default_read = DEFAULT_TIMEOUTS[endpoint_class]
+    timeout_config = (CONFIG.get("timeouts") or {}).get(endpoint_class) or {}
+    connect_timeout = timeout_config.get("connect", default_connect)
+    read_timeout = timeout_config.get("read", default_read)
+    remaining = get_remaining_time()
+    if remaining is not None:
+        connect_timeout = max(0.1, min(connect_timeout, remaining))
+        read_timeout = max(0.1, min(read_timeout, remaining))
+    return connect_timeout, read_timeout
+
+
+def get_rate_limiter(url):
+    """
+    Return the rate limiter of the host the url points to, creating it on first use.
+
+    Limits are read from the 'rate_limit' section of config.yaml and apply per host and per process.
+    """
+    global _rate_limiters, _rate_limiters_pid
+    host = urlparse(url).netloc
+    with _session_lock:
+        if _rate_limiters_pid != os.getpid():
+            _rate_limiters = {}
+            _rate_limiters_pid = os.getpid()
+        if host not in _rate_limiters:
+            rate_config = CONFIG.get("rate_limit") or {}
+            rate = rate_config.get("requests_per_second", 20)
+            _rate_limiters[host] = TokenBucket(rate, rate_config.get("burst", rate))
+        return _rate_limiters[host]
+
+
+def get_retry_delay(attempt, response=None):
+    """
+    Return the seconds to wait before retrying a request.
+
+    A Retry-After header sent with the response is honoured up to 'retry.max_retry_after' seconds. Otherwise the
+    delay grows exponentially with the attempt number, with full jitter so that throttled workers do not retry in lockstep.
+
+    Args:
+        attempt: Number of the attempt which failed, starting at 1.
+        response: The failed response, if any.
+    Returns:
+        Delay in seconds.
+    """
+    retry_config = CONFIG.get("retry") or {}
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    delay = None
+    if retry_after:
+        try:
+            delay = max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                delay = max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    if delay is not None:
+        # A long Retry-After would stall the worker for every attempt, runs without a deadline included
+        delay = min(delay, retry_config.get("max_retry_after", 120))
+    else:
+        backoff = min(retry_config.get("max_delay", 30), retry_config.get("base_delay", 1) * 2 ** (attempt - 1))
+        delay = random.uniform(0, backoff)
+
+    # Do not sleep past the run deadline
+    remaining = get_remaining_time()
+    if remaining is not None:
+        delay = min(delay, max(0.0, remaining))
+    return delay
+
+
+def send_request(method, url, **kwargs):
+    """
+    Send a request through the pooled session, rate limited per host.
+
+    Connect and read timeouts are set per endpoint class and never exceed the time left until
+    the run deadline. Once the deadline has passed, no request is sent.
+
+    Responses with status 429 or 5xx and connection errors are retried with jittered exponential
+    backoff for idempotent calls. Non-idempotent calls are only retried on 429.
+
+    With adaptive concurrency, requests over the adaptive limit wait for a slot, at most until the run
+    deadline, and the latency and status of every attempt adapt the limit, see src/adaptive_limit.py.
+
+    Every attempt is recorded in the run metrics with its latency and status, along with retries
+    and the time spent waiting on the rate limiter and on backoff. A cached IAM token answered with 401
+    is dropped from the token cache.
+
+    Args:
+        method: HTTP method, e.g. GET, POST or DELETE.
+        url: Request URL.
+        kwargs: Keyword arguments passed on to requests.Session.request.
+    Returns:
+        (response, error): The response and None on success, otherwise None and an error message.
+    """
+    max_attempts = (CONFIG.get("retry") or {}).get("max_attempts", 4)
+    endpoint_class = get_endpoint_class(url)
+    call = get_api_call(url)
+    for attempt in range(1, max_attempts + 1):
+        count_sleep("rate_limit", get_rate_limiter(url).acquire())
+        if is_deadline_exceeded():
+            pi_logger.error(f"{method} request to {url} not sent: {DEADLINE_EXCEEDED_ERROR}")
+            return None, DEADLINE_EXCEEDED_ERROR
+        started = time.monotonic()
+        try:
+            with get_registry().track_in_flight(endpoint_class), adaptive_slot(endpoint_class, get_remaining_time()) as outcome:
+                response = get_session().request(method, url, timeout=get_timeout(endpoint_class), **kwargs)
+                outcome["status"] = response.status_code
+        except SlotTimeout:
+            pi_logger.error(f"{method} request to {url} not sent: {DEADLINE_EXCEEDED_ERROR}")
+            return None, DEADLINE_EXCEEDED_ERROR
+        except (ConnectionError, Timeout) as err:
+            observe_request(endpoint_class, call, method, "error", time.monotonic() - started)
+            if attempt < max_attempts and method in IDEMPOTENT_METHODS:
+                delay = get_retry_delay(attempt)
+                pi_logger.warning(f"{method} request to {url} failed: {err}. Retrying in {delay:.1f} seconds ({attempt} of {max_attempts - 1}).")
+                count_retry(endpoint_class, "connection_error")
+                count_sleep("retry_backoff", delay)
+                time.sleep(delay)
+                continue
+            pi_logger.error(f"Error during {method} request to {url}: {err}")
+            return None, f"Error during {method} request to {url}: {err}"
+        except Exception as err:
+            observe_request(endpoint_class, call, method, "error", time.monotonic() - started)
+            pi_logger.error(f"Error during {method} request to {url}: {err}")
+            return None, f"Error during {method} request to {url}: {err}"
+
+        status_code = response.status_code
+        observe_request(endpoint_class, call, method, status_code, time.monotonic() - started)
+        if status_code == 401:
+            # A rejected token is not reused, neither by this run nor by later daemon jobs
+            authorization = (kwargs.get("headers") or {}).get("Authorization", "")
+            if authorization.startswith("Bearer "):
+                token_cache.invalidate(authorization[len("Bearer ") :])
+        if attempt < max_attempts and status_code in RETRYABLE_STATUS_CODES and (method in IDEMPOTENT_METHODS or status_code == 429):
+            delay = get_retry_delay(attempt, response)
+            pi_logger.warning(f"{method} request to {url} returned {status_code}. Retrying in {delay:.1f} seconds ({attempt} of {max_attempts - 1}).")
+            count_retry(endpoint_class, status_code)
+            count_sleep("retry_backoff", delay)
+            time.sleep(delay)
+            continue
+
+        try:
+            response.raise_for_status()
+        except HTTPError as http_err:
+            return None, f"HTTP error occurred: {http_err}"
+        # Logged for every request, so the message is only built when INFO is enabled
+        if pi_logger.isEnabledFor(logging.INFO):
+            pi_logger.info(f"{method} request to {url} successful. Status code: {status_code}")
         return response, None
-    except HTTPError as http_err:
-        return None, f"HTTP error occurred: {http_err}"
-    except Exception as err:
-        pi_logger.error(f"Error during GET request to {url}: {err}")
-        return None, f"Error during GET request to {url}: {err}"
+
+
+def is_not_found_error(error):
+    """
+    Checks if an error returned by the request functions is a 404 response.
+    """
+    return bool(error) and error.startswith("HTTP error occurred: 404")
+
+
+def get_request(url, headers=None, params=None):
+    return send_request("GET", url, headers=headers, params=params)
 
 
 def post_request(url, headers=None, data=None):
-    try:
-        response = requests.post(url, headers=headers, data=data)
-        response.raise_for_status()
-        pi_logger.info(f"POST request to {url} successful. Status code: {response.status_code}")
-        return response, None
-    except HTTPError as http_err:
-        return None, f"HTTP error occurred: {http_err}"
-    except Exception as err:
-        pi_logger.error(f"Error during GET request to {url}: {err}")
-        return None, f"Error during GET request to {url}: {err}"
+    return send_request("POST", url, headers=headers, data=data)
 
 
 def delete_request(url, headers=None, data=None):
-    try:
-        response = requests.delete(url, headers=headers, data=data)
-        response.raise_for_status()
-        pi_logger.info(f"DELETE request to {url} successful. Status code: {response.status_code}")
-        return response, None
-    except HTTPError as http_err:
-        return None, f"HTTP error occurred: {http_err}"
-    except Exception as err:
-        pi_logger.error(f"Error during GET request to {url}: {err}")
-        return None, f"Error during GET request to {url}: {err}"
+    return send_request("DELETE", url, headers=headers, data=data)
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from src.custom_logger import ImageShareLogger, log_account_level_image_op
+from src.ibmcloud_iam import get_child_account_token
+from src.inventory_cache import list_powervs_workspaces
+from src.log_utils import log_context
+from src.ibmcloud_utils import image_ops_on_account_workspace
+from src.regions import filter_workspaces_by_region, get_endpoint_region, get_region_limit, interleave_by_region
+from src.result_stream import report_results
+from src.run_journal import record_account_workspaces, resume_account
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+
+def image_ops_on_child_accounts_async(image_specs, account_list, enterprise_access_token):
+    """
+    Runs an image operation pass over all child accounts as coroutines on a single event loop.
+
+    Every account and every workspace is a coroutine. The blocking API calls run on a thread pool,
+    and the number of calls in flight across all accounts is capped by 'async_concurrency'.
+    Workspaces of one account are further capped by 'workspace_concurrency', and workspaces behind
+    one regional endpoint by the limit of that region, see src/regions.py.
+
+    Only the operation pass runs on the event loop. The status checks of the accepted requests are done
+    by the threads of the status poller, as with the multiprocessing engine, see StatusPoller.
+
+    Args:
+        image_specs: Images to import or delete, see get_image_specs.
+        account_list: List of account dictionaries containing account details.
+        enterprise_access_token: Enterprise account access token.
+    Returns:
+        List of account level logs, in the same order as account_list.
+    """
+    return asyncio.run(_image_ops_on_child_accounts(image_specs, account_list, enterprise_access_token))
+
+
+async def _image_ops_on_child_accounts(image_specs, account_list, enterprise_access_token):
+    concurrency = CONFIG.get("async_concurrency", 64)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    # Semaphore per regional endpoint, created when the first workspace of the region comes up
+    region_semaphores = {}
+    pi_logger.info(f"Running {len(image_specs)} image operations on {len(account_list)} accounts with asyncio engine, concurrency {concurrency}.")
+    return await asyncio.gather(
+        *(_image_ops_on_child_account(image_specs, account, enterprise_access_token, semaphore, region_semaphores) for account in account_list)
+    )
+
+
+async def _image_ops_on_child_account(image_specs, account, enterprise_access_token, semaphore, region_semaphores):
+    # Each account runs as its own task, the log context set here is copied to its workspace tasks and threads
+    with log_context(account=account["account_id"]):
+        account_logger = ImageShareLogger()
+        workspace_logger = ImageShareLogger()
+        resumed_logger = resume_account(account, image_specs)
+        if resumed_logger:
+            report_results("operation", account, resumed_logger, workspace_logger)
+            return log_account_level_image_op(account_logger, workspace_logger, account)
+
+        async with semaphore:
+            access_token, _error = await asyncio.to_thread(get_child_account_token, account["profile_id"], account["account_id"], enterprise_access_token)
+        if not access_token:
+            failure_logger = ImageShareLogger()
+            failure_logger.log_other(account, f"Failed to retrieve access token for account - {account['account_id']}, {_error}")
+            report_results("operation", account, failure_logger, workspace_logger)
+            return log_account_level_image_op(account_logger, workspace_logger, account)
+
+        bearer_token = f"Bearer {access_token}"
+        async with semaphore:
+            power_workspaces, _error = await asyncio.to_thread(list_powervs_workspaces, account["account_id"], bearer_token)
+        if power_workspaces is not None:
+            power_workspaces = filter_workspaces_by_region(power_workspaces)
+            record_account_workspaces(account, power_workspaces)
+            account_semaphore = asyncio.Semaphore(CONFIG.get("workspace_concurrency", 4))
+            for workspace in power_workspaces:
+                region = get_endpoint_region(workspace["location"]["url"])
+                if region not in region_semaphores:
+                    region_semaphores[region] = asyncio.Semaphore(get_region_limit(region))
+            await asyncio.gather(
+                *(
+                    _image_ops_on_workspace(
+                        image_specs,
+                        account,
+                        workspace,
+                        bearer_token,
+                        workspace_logger,
+                        account_semaphore,
+                        region_semaphores[get_endpoint_region(workspace["location"]["url"])],
+                        semaphore,
+                    )
+                    for workspace in interleave_by_region(power_workspaces)
+                )
+            )
+        else:
+            failure_logger = ImageShareLogger()
+            failure_logger.log_other(account, f"Failed to fetch the Power Virtual Server workspaces for {account}, {_error}")
+            report_results("operation", account, failure_logger, workspace_logger)
+        return log_account_level_image_op(account_logger, workspace_logger, account)
+
+
+async def _image_ops_on_workspace(image_specs, account, workspace, bearer_token, logger, account_semaphore, region_semaphore, semaphore):
+    with log_context(workspace=workspace["name"]):
+        async with account_semaphore, region_semaphore, semaphore:
+            await asyncio.to_thread(image_ops_on_account_workspace, image_specs, account, workspace, bearer_token, logger)
@@ -1,26 +1,125 @@
 import yaml
 import os.path
-from jsonschema import validate
+from functools import lru_cache
 from src.log_utils import pi_logger
 import sys
 
+# The libyaml loader parses several times faster than the pure Python one, use it when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 CONFIG = {}
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-# Open and read the YAML file
-with open(parent_dir + "/config.yaml") as file:
-    CONFIG = yaml.safe_load(file)
+
+
+def load_config():
+    """
+    Reads config.yaml into CONFIG, IMAGE_SHARING_CONFIG points to another config file than scripts/config.yaml.
+    CONFIG is filled in place, so the modules which imported it see the values.
+    """
+    with open(os.getenv("IMAGE_SHARING_CONFIG", parent_dir + "/config.yaml")) as file:
+        CONFIG.update(yaml.load(file, Loader=YAML_LOADER))
+
+
+# Read once per process. Pool workers forked from main.py inherit it, workers started by spawn read it here.
+load_config()
+
+# IBM Cloud API endpoints, overridable in the 'endpoints' section of config.yaml. The COS endpoint takes the bucket region.
+DEFAULT_ENDPOINTS = {
+    "iam": "https://iam.cloud.ibm.com",
+    "enterprise": "https://enterprise.cloud.ibm.com",
+    "powervs": "https://us-east.power-iaas.cloud.ibm.com",
+    "cos": "https://s3.{region}.cloud-object-storage.appdomain.cloud",
+}
+
+
+def get_endpoint(name):
+    return ((CONFIG.get("endpoints") or {}).get(name) or DEFAULT_ENDPOINTS[name]).rstrip("/")
+
+
+def get_image_specs():
+    """
+    Returns the images to work on in this run, each with its own operation.
+
+    The images are taken from the 'images' list of config.yaml. Without it, the single image of
+    'image_details' is used with 'image_operation' and 'cos_bucket_details'.
+
+    Returns:
+        List of dictionaries with image_name, operation (import, delete or status), license_type, product, vendor
+        and cos_bucket_details.
+    """
+    if CONFIG.get("images"):
+        images = CONFIG.get("images")
+    else:
+        images = [dict(CONFIG.get("image_details") or {}, operation=CONFIG.get("image_operation"))]
+    return [
+        {
+            "image_name": image["image_name"],
+            "operation": str(image.get("operation") or "").lower(),
+            "license_type": image.get("license_type") or "",
+            "product": image.get("product") or "",
+            "vendor": image.get("vendor") or "",
+            # An image without its own bucket details is imported from the bucket set in cos_bucket_details
+            "cos_bucket_details": image.get("cos_bucket_details") or CONFIG.get("cos_bucket_details"),
+        }
+        for image in images
+    ]
+
+
+def get_daemon_url():
+    """
+    Returns the url of the daemon runs are handed to: IMAGE_SHARING_DAEMON_URL, otherwise 'daemon.url'.
+    Empty when the run is done in this process. Kept here, so local runs do not load src/daemon.py to find out.
+    """
+    return (os.getenv("IMAGE_SHARING_DAEMON_URL") or (CONFIG.get("daemon") or {}).get("url") or "").rstrip("/")
+
+
+def is_plan_run():
+    """
+    Plan runs discover the workspaces and decide like a real run, but change nothing, see src/plan.py.
+    """
+    return bool((CONFIG.get("plan") or {}).get("enabled"))
+
+
+@lru_cache(maxsize=None)
+def get_config_validator():
+    """
+    Returns the validator of config_schema.yaml. The schema is read, checked and compiled once per process.
+    """
+    # jsonschema is slow to import and only needed for validation
+    from jsonschema.validators import validator_for
+
+    with open(os.path.dirname(__file__) + "/config_schema.yaml") as file:
+        schema = yaml.load(file, Loader=YAML_LOADER)
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
 
 
 def validate_config():
+    from jsonschema.exceptions import best_match
+
     pi_logger.info("Start: Validating the config.yaml")
-    # Open and read the YAML file
-    with open(os.path.dirname(__file__) + "/config_schema.yaml") as file:
-        schema = yaml.safe_load(file)
-        validate(CONFIG, schema)
+    # Raise the most relevant error, as jsonschema.validate does
+    error = best_match(get_config_validator().iter_errors(CONFIG))
+    if error is not None:
+        raise error
 
-    licenseType = CONFIG.get("image_details")["license_type"]
-    product = CONFIG.get("image_details")["product"]
-    vendor = CONFIG.get("image_details")["vendor"]
+    image_names = [image_spec["image_name"] for image_spec in get_image_specs()]
+    if len(set(image_names)) != len(image_names):
+        pi_logger.error(f"ERROR: Every image can only be listed once in images, got {image_names}.")
+        sys.exit(1)
+    for image_spec in get_image_specs():
+        validate_import_details(image_spec)
+    pi_logger.info("End: Validation successful for config.yaml")
+
+
+def validate_import_details(image_spec):
+    """
+    Checks the license type, product and vendor of an image, which must be set together or left empty together.
+    """
+    licenseType = image_spec["license_type"]
+    product = image_spec["product"]
+    vendor = image_spec["vendor"]
 
     # Accepted values
     valid_licenseTypes = ["byol"]
@@ -39,10 +138,10 @@ def validate_config():
                 valid_licenseType = licenseType
                 valid_product = product
                 valid_vendor = vendor
-                pi_logger.info(f"License Type: {valid_licenseType}, Product: {valid_product}, Vendor: {valid_vendor}")
+                pi_logger.info(f"Image {image_spec['image_name']}: License Type: {valid_licenseType}, Product: {valid_product}, Vendor: {valid_vendor}")
             else:
                 valid_licenseType = valid_product = valid_vendor = None
-                pi_logger.info("LicenseType, product and vendor are null or empty.")
+                pi_logger.info(f"Image {image_spec['image_name']}: LicenseType, product and vendor are null or empty.")
         else:
             pi_logger.error(
                 "ERROR: LicenseType, product and vendor has invalid values. Supported values are license_type:byol, product:Hana,Netweaver, vendor:SAP"
@@ -51,4 +150,3 @@ def validate_config():
     else:
         pi_logger.error("Warning: All three attributes LicenseType, product and vendor must be set together or be null/empty together.")
         sys.exit(1)
-    pi_logger.info("End: Validation successful for config.yaml")
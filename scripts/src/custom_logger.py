@@ -1,81 +1,210 @@
+from enum import Enum
+
+
+class ResultStatus(Enum):
+    """
+    Outcome of an image operation in a workspace. The value is the key of the result list in the log files.
+    QUEUED imports wait for an earlier import into the same workspace and are started by the status poller.
+    """
+
+    SUCCESS = "success"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+    TIMED_OUT = "timed_out"
+    QUEUED = "queued"
+
+
+class ImageStatus(Enum):
+    """
+    State of the boot image in a workspace. The value is the key of the result list in the status log file.
+    """
+
+    ACTIVE = "active_images"
+    INACTIVE = "inactive_images"
+    MISSING = "missing_images"
+
+
+class WorkspaceResult:
+    """
+    Compact record of the outcome of the operation on one image in one workspace.
+    """
+
+    __slots__ = ("status", "name", "id", "crn", "base_url", "image_name", "message")
+
+    def __init__(self, status, name, id, crn, base_url, image_name, message=None):
+        self.status = status
+        self.name = name
+        self.id = id
+        self.crn = crn
+        self.base_url = base_url
+        self.image_name = image_name
+        self.message = message
+
+    @classmethod
+    def from_workspace(cls, status, workspace, image_name, message=None):
+        return cls(status, workspace["name"], workspace["id"], workspace["details"]["crn"], workspace["location"]["url"], image_name, message)
+
+    def __reduce__(self):
+        # Pickle as a plain tuple, results are sent back from every pool worker
+        return (WorkspaceResult, (self.status, self.name, self.id, self.crn, self.base_url, self.image_name, self.message))
+
+    def get_details(self):
+        return {"name": self.name, "id": self.id, "crn": self.crn, "base_url": self.base_url, "image_name": self.image_name}
+
+    def to_dict(self):
+        result = self.get_details()
+        if self.status is ResultStatus.FAILED:
+            result["error"] = self.message
+        elif self.status is not ResultStatus.SUCCESS or self.message:
+            result["message"] = self.message
+        return result
+
+
+class WorkspaceImageStatus:
+    """
+    Compact record of the boot image state in one workspace, with the state of the latest image import job there.
+    """
+
+    __slots__ = ("status", "name", "id", "crn", "base_url", "image_name", "image_state", "job_state")
+
+    def __init__(self, status, name, id, crn, base_url, image_name, image_state, job_state):
+        self.status = status
+        self.name = name
+        self.id = id
+        self.crn = crn
+        self.base_url = base_url
+        self.image_name = image_name
+        self.image_state = image_state
+        self.job_state = job_state
+
+    @classmethod
+    def from_workspace(cls, status, workspace, image_name, image_state, job_state):
+        return cls(status, workspace["name"], workspace["id"], workspace["details"]["crn"], workspace["location"]["url"], image_name, image_state, job_state)
+
+    def __reduce__(self):
+        return (WorkspaceImageStatus, (self.status, self.name, self.id, self.crn, self.base_url, self.image_name, self.image_state, self.job_state))
+
+    def to_dict(self):
+        result = {"name": self.name, "id": self.id, "crn": self.crn, "base_url": self.base_url, "image_name": self.image_name, "job_state": self.job_state}
+        if self.status is ImageStatus.INACTIVE:
+            result["image_state"] = self.image_state
+        return result
+
+
+class AccountError:
+    """
+    Compact record of an error which stopped the work on a whole account.
+    """
+
+    __slots__ = ("account_id", "account_name", "error")
+
+    def __init__(self, account_id, account_name, error):
+        self.account_id = account_id
+        self.account_name = account_name
+        self.error = error
+
+    def __reduce__(self):
+        return (AccountError, (self.account_id, self.account_name, self.error))
+
+    def to_dict(self):
+        return {"account_id": self.account_id, "account_name": self.account_name, "error": self.error}
+
+
 class ImageShareLogger:
     """
-    A logger for tracking image import/delete operations with success, skipped or failure states.
+    A logger for tracking image import/delete operations with success, skipped, failure, timed out or queued states.
     """
 
+    __slots__ = ("account_id", "account_name", "results", "other")
+
     def __init__(self):
-        self.success_list = []
-        self.skipped_list = []
-        self.failed_list = []
+        self.account_id = None
+        self.account_name = None
+        self.results = []
         self.other = []
 
-    def log_success(self, workspace):
-        self.success_list.append(
-            {
-                "name": workspace["name"],
-                "id": workspace["id"],
-                "crn": workspace["details"]["crn"],
-                "base_url": workspace["location"]["url"],
-            }
-        )
-
-    def log_skipped(self, workspace, message):
-        self.skipped_list.append(
-            {
-                "name": workspace["name"],
-                "id": workspace["id"],
-                "crn": workspace["details"]["crn"],
-                "base_url": workspace["location"]["url"],
-                "message": message,
-            }
-        )
-
-    def log_failure(self, workspace, error):
-        self.failed_list.append(
-            {
-                "name": workspace["name"],
-                "id": workspace["id"],
-                "crn": workspace["details"]["crn"],
-                "base_url": workspace["location"]["url"],
-                "error": error,
-            }
-        )
+    def log_success(self, workspace, image_name, message=None):
+        self.results.append(WorkspaceResult.from_workspace(ResultStatus.SUCCESS, workspace, image_name, message))
+
+    def log_skipped(self, workspace, image_name, message):
+        self.results.append(WorkspaceResult.from_workspace(ResultStatus.SKIPPED, workspace, image_name, message))
+
+    def log_failure(self, workspace, image_name, error):
+        self.results.append(WorkspaceResult.from_workspace(ResultStatus.FAILED, workspace, image_name, error))
+
+    def log_timeout(self, workspace, image_name, message):
+        self.results.append(WorkspaceResult.from_workspace(ResultStatus.TIMED_OUT, workspace, image_name, message))
+
+    def log_queued(self, workspace, image_name, message):
+        self.results.append(WorkspaceResult.from_workspace(ResultStatus.QUEUED, workspace, image_name, message))
 
     def log_other(self, account, error):
-        log = {
-            "account_id": account["account_id"],
-            "account_name": account["name"],
-            "error": error,
-        }
-        self.other.append(log)
+        self.other.append(AccountError(account["account_id"], account["name"], error))
+
+    def extend(self, other):
+        """
+        Adds the entries logged by another ImageShareLogger.
+        """
+        self.results.extend(other.results)
+        self.other.extend(other.other)
+
+    def get_results(self, status):
+        return [result for result in self.results if result.status is status]
 
     def get_log(self):
-        return {
-            "success": self.success_list,
-            "skipped": self.skipped_list,
-            "failed": self.failed_list,
-            "other": self.other,
-        }
+        """
+        Returns the log in the format of the log files. Results are grouped per account once the logger
+        belongs to an account, see log_account_level_image_op.
+        """
+        log = {}
+        for status in ResultStatus:
+            workspaces = [result.to_dict() for result in self.get_results(status)]
+            if self.account_id is None:
+                log[status.value] = workspaces
+            else:
+                log[status.value] = [{"id": self.account_id, "name": self.account_name, "workspaces": workspaces}] if workspaces else []
+        log["other"] = [error.to_dict() for error in self.other]
+        return log
 
 
 class ImageStatusLogger:
     """
-    A logger for tracking boot image states(active/inactive) and other issues.
+    A logger for tracking boot image states(active/inactive/missing) and other issues.
     """
 
+    __slots__ = ("account_id", "account_name", "results", "other")
+
     def __init__(self):
-        self.active = []
-        self.inactive = []
+        self.account_id = None
+        self.account_name = None
+        self.results = []
         self.other = []
 
-    def log_active(self, account):
-        self.success_list.append(account)
+    def log_active(self, workspace, image_name, job_state):
+        self.results.append(WorkspaceImageStatus.from_workspace(ImageStatus.ACTIVE, workspace, image_name, "active", job_state))
 
-    def log_inactive(self, account):
-        self.failed_list.append(account)
+    def log_inactive(self, workspace, image_name, image_state, job_state):
+        self.results.append(WorkspaceImageStatus.from_workspace(ImageStatus.INACTIVE, workspace, image_name, image_state, job_state))
+
+    def log_missing(self, workspace, image_name, job_state):
+        self.results.append(WorkspaceImageStatus.from_workspace(ImageStatus.MISSING, workspace, image_name, None, job_state))
+
+    def log_other(self, account, error):
+        self.other.append(AccountError(account["account_id"], account["name"], error))
+
+    def get_results(self, status):
+        return [result for result in self.results if result.status is status]
 
     def get_log(self):
-        return {"active_images": self.active, "inactive_images": self.inactive}
+        log = {}
+        for status in ImageStatus:
+            workspaces = [result.to_dict() for result in self.get_results(status)]
+            if self.account_id is None:
+                log[status.value] = workspaces
+            else:
+                log[status.value] = [{"id": self.account_id, "name": self.account_name, "workspaces": workspaces}] if workspaces else []
+        log["other"] = [error.to_dict() for error in self.other]
+        return log
 
 
 def merge_image_op_logs(account_level_logs):
@@ -83,22 +212,17 @@ def merge_image_op_logs(account_level_logs):
     Merge logs from multiprocessing into a final log dictionary.
 
     Args:
-        logs (list): A list of dictionaries containing logs to be merged.
+        logs (list): A list of account level ImageShareLoggers to be merged.
 
     Returns:
-        dict: A dictionary containing merged active and inactive logs.
-    """
-    final_log = {
-        "success": [],
-        "skipped": [],
-        "failed": [],
-        "other": [],
-    }
-    for log in account_level_logs:
-        final_log["success"].extend(log["success"])
-        final_log["skipped"].extend(log["skipped"])
-        final_log["failed"].extend(log["failed"])
-        final_log["other"].extend(log["other"])
+        dict: A dictionary containing merged success, skipped, failed, timed out, queued and other logs.
+    """
+    final_log = {status.value: [] for status in ResultStatus}
+    final_log["other"] = []
+    for account_logger in account_level_logs:
+        log = account_logger.get_log()
+        for key in final_log:
+            final_log[key].extend(log[key])
     return final_log
 
 
@@ -112,34 +236,13 @@ def log_account_level_image_op(account_logger, workspace_logger, account):
         account (dict): The account information.
 
     Returns:
-        dict: The updated account-level log.
+        ImageShareLogger: The account-level logger, see merge_image_op_logs.
     """
+    account_logger.account_id = account["account_id"]
+    account_logger.account_name = account["name"]
     if workspace_logger:
-        if workspace_logger.success_list:
-            account_logger.success_list.append(
-                {
-                    "id": account["account_id"],
-                    "name": account["name"],
-                    "workspaces": workspace_logger.success_list,
-                }
-            )
-        if workspace_logger.skipped_list:
-            account_logger.skipped_list.append(
-                {
-                    "id": account["account_id"],
-                    "name": account["name"],
-                    "workspaces": workspace_logger.skipped_list,
-                }
-            )
-        if workspace_logger.failed_list:
-            account_logger.failed_list.append(
-                {
-                    "id": account["account_id"],
-                    "name": account["name"],
-                    "workspaces": workspace_logger.failed_list,
-                }
-            )
-    return account_logger.get_log()
+        account_logger.extend(workspace_logger)
+    return account_logger
 
 
 def merge_status_logs(account_level_logs):
@@ -147,21 +250,23 @@ def merge_status_logs(account_level_logs):
     Merge logs from multiprocessing into a final log dictionary.
 
     Args:
-        logs (list): A list of dictionaries containing logs to be merged.
+        logs (list): A list of account level ImageStatusLoggers to be merged.
 
     Returns:
-        dict: A dictionary containing merged active and inactive logs.
+        dict: A dictionary containing merged active, inactive, missing and other logs.
     """
-    final_log = {"active_images": [], "inactive_images": []}
-    for log in account_level_logs:
-        final_log["active_images"].extend(log["active_images"])
-        final_log["inactive_images"].extend(log["inactive_images"])
+    final_log = {status.value: [] for status in ImageStatus}
+    final_log["other"] = []
+    for account_logger in account_level_logs:
+        log = account_logger.get_log()
+        for key in final_log:
+            final_log[key].extend(log[key])
     return final_log
 
 
 def log_account_level_status(account_logger, workspace_logger, account):
     """
-    Group the image import statuses from workspaces of an account with account information.
+    Group the image states from workspaces of an account with account information.
 
     Args:
         account_logger (Logger): The logger to log account-level statuses.
@@ -169,23 +274,11 @@ def log_account_level_status(account_logger, workspace_logger, account):
         account (dict): The account information.
 
     Returns:
-        dict: The updated account-level log.
+        ImageStatusLogger: The account-level logger, see merge_status_logs.
     """
+    account_logger.account_id = account["account_id"]
+    account_logger.account_name = account["name"]
     if workspace_logger:
-        if workspace_logger.active:
-            account_logger.active.append(
-                {
-                    "id": account["account_id"],
-                    "name": account["name"],
-                    "workspaces": workspace_logger.active,
-                }
-            )
-        if workspace_logger.inactive:
-            account_logger.inactive.append(
-                {
-                    "id": account["account_id"],
-                    "name": account["name"],
-                    "workspaces": workspace_logger.inactive,
-                }
-            )
-    return account_logger.get_log()
+        account_logger.results.extend(workspace_logger.results)
+        account_logger.other.extend(workspace_logger.other)
+    return account_logger
@@ -0,0 +1,413 @@
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from src.log_utils import configure_logging, stop_logging
+from src.metrics import get_progress, restart_run_clock
+from src.sharding import SHARD_FILES
+from src.token_cache import token_cache
+from src.constants import CONFIG, DEFAULT_ENDPOINTS
+
+pi_logger = logging.getLogger("logger")
+
+# Job states reported by the daemon
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Environment variables the client hands to a job, the credentials of the run
+JOB_ENVIRONMENT = ("IBMCLOUD_API_KEY", "COS_ACCESS_KEY", "COS_SECRET_KEY")
+# Seconds between the progress reports of a running job, and between the job requests of the client
+PROGRESS_INTERVAL = 2
+# Finished jobs kept for GET /jobs, older ones are dropped
+MAX_FINISHED_JOBS = 100
+# Paths in the config of a job which the run writes to, they must stay below the job root of the daemon
+JOB_OUTPUT_PATHS = SHARD_FILES + (("inventory_cache", "directory"),)
+# Addresses the daemon may listen on, as in config_schema.yaml. The daemon config is not validated as a run config.
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def get_daemon_config():
+    return CONFIG.get("daemon") or {}
+
+
+def get_daemon_token():
+    """
+    Returns the token a client sends to the daemon: IMAGE_SHARING_DAEMON_TOKEN, otherwise the content of
+    'daemon.token_file', which the daemon writes when it starts. None when there is neither.
+    """
+    token = os.getenv("IMAGE_SHARING_DAEMON_TOKEN")
+    if token:
+        return token
+    token_file = get_daemon_config().get("token_file")
+    if not token_file or not os.path.exists(token_file):
+        return None
+    with open(token_file, encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def write_daemon_token(token_file):
+    """
+    Writes a new random token to token_file, readable by the user running the daemon only, and returns it.
+    """
+    token = secrets.token_urlsafe(32)
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+    # The mode of open only applies to a new file
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    return token
+
+
+def is_below(path, root):
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    return os.path.commonpath([path, root]) == root
+
+
+def get_token_scope(config, environment):
+    """
+    Returns the key under which the daemon keeps the IAM tokens of a job: jobs share tokens only when
+    they run with the same API key against the same IAM endpoint.
+    """
+    iam_endpoint = (config.get("endpoints") or {}).get("iam") or DEFAULT_ENDPOINTS["iam"]
+    return hashlib.sha256(f"{environment.get('IBMCLOUD_API_KEY')}\n{iam_endpoint}".encode()).hexdigest()
+
+
+class JobDaemon:
+    """
+    Runs the jobs submitted to the daemon, up to 'daemon.max_jobs' at the same time, later ones wait queued.
+
+    Every job runs in its own process, forked from the fork server of the daemon, so it starts with the modules
+    already loaded, and the run keeps its own CONFIG, journal, result stream and pool workers. Jobs are not
+    forked from the daemon itself: a lock held by one of its threads at fork time would stay locked in the job.
+    The IAM tokens minted by a job are sent back to the daemon and handed to the next jobs with the same
+    API key. Jobs of one API key share the workspace inventory cache below the daemon directory, see
+    get_job_config. HTTP connection pools cannot be shared between processes, each job opens its own.
+    """
+
+    def __init__(self, run, max_jobs, job_root=None, job_context=None):
+        self.run = run
+        self.job_context = job_context or multiprocessing.get_context()
+        self.directory = os.getcwd()
+        self.job_root = os.path.realpath(job_root or self.directory)
+        self.jobs = {}
+        self.tokens = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_jobs)
+
+    def submit(self, job_request):
+        """
+        Queues a job and returns it.
+
+        Args:
+            job_request: Dictionary with the 'config' of the run, the 'environment' variables of JOB_ENVIRONMENT
+                and the 'directory' the run works in, where its log files are written.
+        Raises:
+            ValueError: The request is not a job, or it would write outside the job root, see check_job_paths.
+        """
+        if not isinstance(job_request, dict) or not isinstance(job_request.get("config"), dict):
+            raise ValueError("The job needs the 'config' of the run.")
+        environment = {name: value for name, value in (job_request.get("environment") or {}).items() if name in JOB_ENVIRONMENT}
+        directory = job_request.get("directory") or self.directory
+        if not isinstance(directory, str) or not os.path.isdir(directory):
+            raise ValueError(f"The job directory {directory} does not exist.")
+        directory = os.path.realpath(directory)
+        self.check_job_paths(job_request["config"], directory)
+
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "state": QUEUED,
+            "directory": directory,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "exit_code": None,
+            "progress": {},
+        }
+        with self._lock:
+            self.jobs[job["id"]] = job
+            self.drop_finished_jobs()
+        threading.Thread(target=self.supervise, args=(job, job_request["config"], environment), daemon=True).start()
+        pi_logger.info(f"INFO: Queued job {job['id']} in {directory}.")
+        return dict(job)
+
+    def check_job_paths(self, config, directory):
+        """
+        Checks that a job only writes below the job root, 'daemon.job_root' or the daemon directory: its directory and
+        the output files of its config, see JOB_OUTPUT_PATHS. A relative inventory cache directory is placed below the
+        daemon directory, see get_job_config, so it must stay below that one.
+
+        Raises:
+            ValueError: A path of the job is outside the job root.
+        """
+        if not is_below(directory, self.job_root):
+            raise ValueError(f"The job directory {directory} is outside the job root {self.job_root} of the daemon.")
+        for keys in JOB_OUTPUT_PATHS:
+            value = config
+            for key in keys:
+                value = value.get(key) if isinstance(value, dict) else None
+            if not value:
+                continue
+            if not isinstance(value, str):
+                raise ValueError(f"The '{'.'.join(keys)}' of the job is not a path.")
+            if keys == ("inventory_cache", "directory") and not os.path.isabs(value):
+                outside = not is_below(os.path.join(self.directory, value), self.directory)
+            else:
+                outside = not is_below(os.path.join(directory, value), self.job_root)
+            if outside:
+                raise ValueError(f"The '{'.'.join(keys)}' of the job, {value}, is outside the job root {self.job_root} of the daemon.")
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list_jobs(self):
+        with self._lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def drop_finished_jobs(self):
+        finished = [job["id"] for job in self.jobs.values() if job["state"] in (SUCCEEDED, FAILED)]
+        for job_id in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    def get_job_config(self, config, token_scope):
+        """
+        Returns the config of a job, with a relative inventory cache directory placed below the daemon directory,
+        per API key, so later jobs find the workspaces and images listed by earlier ones.
+        """
+        cache_config = config.get("inventory_cache") or {}
+        if cache_config.get("directory") and not os.path.isabs(cache_config["directory"]):
+            directory = os.path.join(self.directory, cache_config["directory"], token_scope[:16])
+            config = {**config, "inventory_cache": {**cache_config, "directory": directory}}
+        return config
+
+    def supervise(self, job, config, environment):
+        """
+        Runs a job in its own process once a slot is free, and records its progress and result.
+        """
+        with self._slots:
+            token_scope = get_token_scope(config, environment)
+            with self._lock:
+                tokens = dict(self.tokens.get(token_scope, {}))
+                job.update({"state": RUNNING, "started_at": time.time()})
+            pi_logger.info(f"INFO: Starting job {job['id']} with {len(tokens)} cached tokens.")
+
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = self.job_context.Process(
+                target=run_job, args=(self.run, self.get_job_config(config, token_scope), environment, job["directory"], tokens, sender)
+            )
+            process.start()
+            sender.close()
+            # Pool workers of the job hold the pipe open too, so the end of the job is taken from the process
+            while process.is_alive() or receiver.poll():
+                try:
+                    if not receiver.poll(1):
+                        continue
+                    kind, data = receiver.recv()
+                except EOFError:
+                    break
+                with self._lock:
+                    if kind == "progress":
+                        job["progress"] = data
+                    elif kind == "tokens":
+                        self.tokens.setdefault(token_scope, {}).update(data)
+            process.join()
+            receiver.close()
+
+            with self._lock:
+                job.update({"state": SUCCEEDED if process.exitcode == 0 else FAILED, "exit_code": process.exitcode, "finished_at": time.time()})
+            pi_logger.info(f"INFO: Job {job['id']} {job['state']} with exit code {job['exit_code']}.")
+
+
+def run_job(run, config, environment, directory, tokens, connection):
+    """
+    Runs a daemon job in the job process: the run works in directory with the config and credentials
+    of the job, and starts with the cached tokens. Progress is sent over connection while the run goes,
+    then the tokens to keep for the next jobs. The process exits with the exit code of the run.
+    """
+    os.chdir(directory)
+    os.environ.update(environment)
+    CONFIG.clear()
+    CONFIG.update(config)
+    # Log to the console.log of the job directory
+    configure_logging(level=CONFIG.get("log_level", "DEBUG"))
+    restart_run_clock()
+    token_cache.load(tokens)
+
+    connection_lock = threading.Lock()
+    done = threading.Event()
+
+    def report_progress():
+        while not done.wait(PROGRESS_INTERVAL):
+            with connection_lock:
+                connection.send(("progress", get_progress()))
+
+    threading.Thread(target=report_progress, daemon=True).start()
+    try:
+        run()
+    except Exception as e:
+        pi_logger.exception(f"ERROR: Job failed, {e}")
+        sys.exit(1)
+    finally:
+        done.set()
+        with connection_lock:
+            connection.send(("progress", get_progress()))
+            connection.send(("tokens", token_cache.export()))
+        connection.close()
+        stop_logging()
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    Job API of the daemon:
+
+        POST /jobs       Submits a job, see JobDaemon.submit. Returns the queued job.
+        GET  /jobs       Returns all jobs.
+        GET  /jobs/<id>  Returns a job: its state, exit code, times and progress, see get_progress.
+    """
+
+    def do_POST(self):
+        if not self.is_authorized():
+            return
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": f"Unknown path {self.path}."})
+            return
+        try:
+            job_request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+            job = self.server.job_daemon.submit(job_request)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(202, job)
+
+    def do_GET(self):
+        if not self.is_authorized():
+            return
+        path = self.path.rstrip("/")
+        if path == "/jobs":
+            self.send_json(200, {"jobs": self.server.job_daemon.list_jobs()})
+            return
+        job = self.server.job_daemon.get_job(path[len("/jobs/") :]) if path.startswith("/jobs/") else None
+        if job:
+            self.send_json(200, job)
+        else:
+            self.send_json(404, {"error": f"Unknown job {self.path}."})
+
+    def is_authorized(self):
+        """
+        Checks the token of the request, sent as "Authorization: Bearer <token>", and answers 401 when it is wrong.
+        """
+        authorization = self.headers.get("Authorization", "")
+        if hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {self.server.token}".encode("utf-8")):
+            return True
+        self.send_json(401, {"error": "Missing or wrong daemon token."})
+        return False
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pi_logger.debug(f"Daemon request from {self.address_string()}: {format % args}")
+
+
+def serve(run):
+    """
+    Runs the daemon until it is interrupted: a local HTTP job API on 'daemon.host' and 'daemon.port',
+    which runs the submitted jobs with run, see JobDaemon. The API takes the credentials of the runs, so it
+    only listens on the loopback interface, and it only takes requests with the daemon token: the value of
+    IMAGE_SHARING_DAEMON_TOKEN, otherwise a new token written to 'daemon.token_file' for the clients.
+    """
+    daemon_config = get_daemon_config()
+    host = daemon_config.get("host", "127.0.0.1")
+    port = daemon_config.get("port", 8787)
+    max_jobs = daemon_config.get("max_jobs", 4)
+    if host not in LOOPBACK_HOSTS:
+        pi_logger.error(f"ERROR: The daemon only listens on a loopback address, one of {', '.join(LOOPBACK_HOSTS)}, got 'daemon.host' {host}.")
+        sys.exit(1)
+    token = os.getenv("IMAGE_SHARING_DAEMON_TOKEN")
+    if not token:
+        if not daemon_config.get("token_file"):
+            pi_logger.error("ERROR: The daemon needs a token, set IMAGE_SHARING_DAEMON_TOKEN or 'daemon.token_file'.")
+            sys.exit(1)
+        token = write_daemon_token(daemon_config["token_file"])
+        pi_logger.info(f"INFO: Wrote the daemon token to {os.path.abspath(daemon_config['token_file'])}.")
+    # Jobs are forked from a single threaded fork server, which imports main.py and its modules once for all jobs,
+    # along with the ones main.py only imports for the kind of run it does
+    job_context = multiprocessing.get_context("forkserver")
+    job_context.set_forkserver_preload(["__main__", "src.plan", "src.sharding", "src.status_scan", "boto3", "jsonschema"])
+
+    server = ThreadingHTTPServer((host, port), JobRequestHandler)
+    server.token = token
+    server.job_daemon = JobDaemon(run, max_jobs, daemon_config.get("job_root"), job_context)
+    pi_logger.info(f"INFO: Daemon listening on http://{host}:{server.server_port}, running up to {max_jobs} jobs at the same time.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pi_logger.info("INFO: Daemon stopped.")
+    finally:
+        server.server_close()
+
+
+def format_progress(progress):
+    results = ", ".join(f"{phase} {states}" for phase, states in progress.get("results", {}).items())
+    return f"{progress.get('requests', 0)} requests" + (f", results: {results}" if results else "")
+
+
+def submit_job(daemon_url):
+    """
+    Runs config.yaml on the daemon at daemon_url, with the credentials of this process, and follows the job until it ends.
+    The run works in the current directory, so its log files are written where a local run would write them.
+
+    Returns:
+        Exit code of the run, 1 when the daemon could not be reached or refused the job.
+    """
+    token = get_daemon_token()
+    if not token:
+        pi_logger.error("ERROR: No daemon token, set IMAGE_SHARING_DAEMON_TOKEN or 'daemon.token_file' to the token file of the daemon.")
+        return 1
+    headers = {"Authorization": f"Bearer {token}"}
+    job_request = {
+        "config": CONFIG,
+        "environment": {name: os.environ[name] for name in JOB_ENVIRONMENT if name in os.environ},
+        "directory": os.getcwd(),
+    }
+    try:
+        response = requests.post(f"{daemon_url}/jobs", json=job_request, headers=headers, timeout=30)
+        if response.status_code in (400, 401):
+            pi_logger.error(f"ERROR: The daemon at {daemon_url} refused the job, {response.json()['error']}")
+            return 1
+        response.raise_for_status()
+        job = response.json()
+        pi_logger.info(f"INFO: Submitted job {job['id']} to the daemon at {daemon_url}.")
+        reported = None
+        while job["state"] in (QUEUED, RUNNING):
+            time.sleep(PROGRESS_INTERVAL)
+            response = requests.get(f"{daemon_url}/jobs/{job['id']}", headers=headers, timeout=30)
+            response.raise_for_status()
+            job = response.json()
+            if (job["state"], job["progress"]) != reported:
+                pi_logger.info(f"INFO: Job {job['id']} {job['state']}: {format_progress(job['progress'])}.")
+                reported = (job["state"], job["progress"])
+    except requests.exceptions.RequestException as e:
+        pi_logger.error(f"ERROR: Lost the job on the daemon at {daemon_url}, {e}")
+        return 1
+    pi_logger.info(f"INFO: Job {job['id']} {job['state']} with exit code {job['exit_code']}.")
+    return 0 if job["state"] == SUCCEEDED else 1
@@ -1,29 +1,43 @@
-import boto3
-from botocore.exceptions import ClientError
-from src.log_utils import *
+import logging
 import sys
+import time
+
+from src.api_requests import get_timeout
+from src.metrics import get_registry, observe_request
+from src.constants import get_endpoint
 
 pi_logger = logging.getLogger("logger")
 
 
 def object_exists_in_ibm_cos(access_key, secret_key, region, bucket, object_key):
+    # boto3 takes longer to load than the rest of the scripts, so it is only imported by runs which check a COS object
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+
     # Initialize the S3 client with HMAC credentials
-    endpoint_url = f"https://s3.{region}.cloud-object-storage.appdomain.cloud"
+    endpoint_url = get_endpoint("cos").format(region=region)
     standardized_resource = f"/{bucket}/{object_key}"
     request_url = endpoint_url + standardized_resource
+    connect_timeout, read_timeout = get_timeout("cos")
     s3 = boto3.client(
         "s3",
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
         endpoint_url=endpoint_url,
+        config=Config(connect_timeout=connect_timeout, read_timeout=read_timeout),
     )
     pi_logger.info(f"Start: Checking if s3 credentials are correct and object exists in bucket. Sending requestURL = {request_url}")
 
+    started = time.monotonic()
     try:
         # Attempt to retrieve metadata for the object
-        s3.head_object(Bucket=bucket, Key=object_key)
+        with get_registry().track_in_flight("cos"):
+            s3.head_object(Bucket=bucket, Key=object_key)
+        observe_request("cos", "head_object", "HEAD", 200, time.monotonic() - started)
         pi_logger.info(f"End: Checked s3 credentials are correct and object exists in bucket.")
     except ClientError as e:
+        observe_request("cos", "head_object", "HEAD", e.response["ResponseMetadata"]["HTTPStatusCode"], time.monotonic() - started)
         error_code = e.response["Error"]["Code"]
         if error_code == "404":
             pi_logger.error(f"Object '{object_key}' does not exist in bucket '{bucket}'. Status code: 404")
@@ -33,3 +47,7 @@ def object_exists_in_ibm_cos(access_key, secret_key, region, bucket, object_key)
                 f"Error checking object in S3: {e.response['Error']['Message']}. Status code: {e.response['ResponseMetadata']['HTTPStatusCode']}"
             )
             sys.exit(1)
+    except BotoCoreError as e:
+        observe_request("cos", "head_object", "HEAD", "error", time.monotonic() - started)
+        pi_logger.error(f"Error checking object in S3: {e}")
+        sys.exit(1)
@@ -1,12 +1,17 @@
+import logging
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urljoin, urlparse
 from src.api_requests import get_request, post_request
-from src.log_utils import *
+from src.token_cache import token_cache
+from src.constants import get_endpoint
 
 pi_logger = logging.getLogger("logger")
 
 
 def generate_bearer_token(ibmcloud_api_key):
-    req_url = "https://iam.cloud.ibm.com/identity/token"
+    req_url = f"{get_endpoint('iam')}/identity/token"
     req_headers = {
         "Content-Type": "application/x-www-form-urlencoded",
         "Accept": "application/json",
@@ -20,22 +25,49 @@ def generate_bearer_token(ibmcloud_api_key):
 
 
 def get_trusted_profiles(access_token):
-    req_url = "https://iam.cloud.ibm.com/identity/profiles"
+    """
+    Returns all trusted profiles, following the 'next' page links of the profiles API.
+    """
+    req_url = f"{get_endpoint('iam')}/identity/profiles"
     req_headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    req_params = {"access_token": access_token}
+    req_params = {"access_token": access_token, "pagesize": 100}
     pi_logger.info(f"Start: Fetching the trusted profiles ...")
-    response, error = get_request(req_url, req_headers, req_params)
+    trusted_profiles = []
+    while True:
+        response, error = get_request(req_url, req_headers, req_params)
+        if not response:
+            pi_logger.error(f"Error Failed to get trusted profiles: {error}")
+            sys.exit(1)
+        profiles_page = response.json()
+        trusted_profiles.extend(profiles_page["profiles"])
+        # The page token is carried by the 'next' link, the remaining parameters stay the same
+        pagetoken = parse_qs(urlparse(profiles_page.get("next") or "").query).get("pagetoken")
+        if not pagetoken:
+            break
+        req_params["pagetoken"] = pagetoken[0]
 
-    if response:
-        pi_logger.info(f"End: Fetched all trusted profiles.")
-        return response.json()["profiles"]
-    else:
-        pi_logger.error(f"Error Failed to get trusted profiles: {error}")
-        sys.exit(1)
+    pi_logger.info(f"End: Fetched all trusted profiles.")
+    return trusted_profiles
+
+
+def build_trusted_profile_index(trusted_profiles):
+    """
+    Indexes trusted profiles by the account they belong to.
+
+    Args:
+        trusted_profiles: List of trusted profiles.
+    Returns:
+        Dictionary mapping account IDs to their trusted profile. When an account has several
+        trusted profiles, the first one listed is used.
+    """
+    trusted_profile_index = {}
+    for profile in trusted_profiles:
+        trusted_profile_index.setdefault(profile["account_id"], profile)
+    return trusted_profile_index
 
 
 def get_account_details(account_id, iam_token):
-    req_url = f"https://enterprise.cloud.ibm.com/v1/accounts/{account_id}"
+    req_url = f"{get_endpoint('enterprise')}/v1/accounts/{account_id}"
     req_headers = {
         "Authorization": f"Bearer {iam_token}",
         "Content-Type": "application/json",
@@ -51,7 +83,27 @@ def get_account_details(account_id, iam_token):
 
 
 def get_account_list(enterprise_id, account_group_id, iam_token):
-    req_url = "https://enterprise.cloud.ibm.com/v1/accounts"
+    """
+    Returns all accounts under the account group, following the pagination of the enterprise API.
+    """
+    return [account for accounts_page in iter_account_list(enterprise_id, account_group_id, iam_token) for account in accounts_page]
+
+
+def iter_account_list(enterprise_id, account_group_id, iam_token):
+    """
+    Yields the accounts under the account group one page at a time.
+
+    The next page is requested as soon as a page arrives, so the caller can process a page
+    while the following one is still being fetched.
+
+    Args:
+        enterprise_id: Enterprise id.
+        account_group_id: ID of the account group.
+        iam_token: Enterprise account access token.
+    Yields:
+        List of accounts of one response page.
+    """
+    req_url = f"{get_endpoint('enterprise')}/v1/accounts"
     req_headers = {
         "Authorization": f"Bearer {iam_token}",
         "Content-Type": "application/json",
@@ -63,17 +115,23 @@ def get_account_list(enterprise_id, account_group_id, iam_token):
     }
 
     pi_logger.info(f"Start: Fetching list of accounts under the account group id {account_group_id} ...")
-    response, error = get_request(req_url, req_headers, req_params)
-    if response:
-        pi_logger.info(f"End: Fetched list of accounts under the account group id {account_group_id} ...")
-        return response.json()["resources"]
-    else:
-        pi_logger.error(f"Error fetching list of accounts under the account group id {account_group_id}: {error}")
-        sys.exit(1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page_future = executor.submit(get_request, req_url, req_headers, req_params)
+        while page_future:
+            response, error = page_future.result()
+            if not response:
+                pi_logger.error(f"Error fetching list of accounts under the account group id {account_group_id}: {error}")
+                sys.exit(1)
+            accounts_page = response.json()
+            # next_url is relative to the API host and already carries the query parameters
+            next_url = accounts_page.get("next_url")
+            page_future = executor.submit(get_request, urljoin(req_url, next_url), req_headers, None) if next_url else None
+            yield accounts_page["resources"]
+    pi_logger.info(f"End: Fetched list of accounts under the account group id {account_group_id} ...")
 
 
 def get_child_account_access_token(profile_id, account_id, enterprise_access_token):
-    req_url = "https://iam.cloud.ibm.com/identity/token"
+    req_url = f"{get_endpoint('iam')}/identity/token"
     req_headers = {
         "Content-Type": "application/x-www-form-urlencoded",
         "Accept": "application/json",
@@ -86,3 +144,30 @@ def get_child_account_access_token(profile_id, account_id, enterprise_access_tok
     }
     response, error = post_request(req_url, req_headers, data=req_data)
     return response, error
+
+
+def get_enterprise_access_token(ibmcloud_api_key):
+    """
+    Returns the enterprise access token from the token cache, minting it with the API key when missing or expiring.
+    """
+    return token_cache.get_token((None, None), lambda: generate_bearer_token(ibmcloud_api_key))
+
+
+def get_child_account_token(profile_id, account_id, enterprise_access_token):
+    """
+    Returns the access token of a child account from the token cache, running the trusted profile
+    'assume' exchange only when the cached token is missing or about to expire.
+
+    When IBMCLOUD_API_KEY is set, the enterprise token used for the exchange is taken from the cache
+    as well, so it is refreshed during long status polls instead of expiring.
+    """
+
+    def exchange():
+        current_enterprise_token = enterprise_access_token
+        if os.getenv("IBMCLOUD_API_KEY"):
+            current_enterprise_token, error = get_enterprise_access_token(os.getenv("IBMCLOUD_API_KEY"))
+            if error:
+                return None, error
+        return get_child_account_access_token(profile_id, account_id, current_enterprise_token)
+
+    return token_cache.get_token((profile_id, account_id), exchange)
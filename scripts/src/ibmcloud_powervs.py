@@ -1,8 +1,7 @@
 import json
 import os
-from src.api_requests import *
-from src.log_utils import *
-from src.constants import CONFIG
+from src.api_requests import delete_request, get_request, post_request
+from src.constants import get_endpoint
 
 
 def get_powervs_workspaces(bearer_token):
@@ -10,7 +9,7 @@ def get_powervs_workspaces(bearer_token):
         "Authorization": bearer_token,
         "Content-Type": "application/json",
     }
-    request_url = "https://us-east.power-iaas.cloud.ibm.com/v1/workspaces"
+    request_url = f"{get_endpoint('powervs')}/v1/workspaces"
     response, _err = get_request(request_url, request_headers, None)
     return response, _err
 
@@ -28,7 +27,7 @@ def get_boot_images(workspace, bearer_token):
     return response, _err
 
 
-def import_boot_image(workspace, bearer_token):
+def import_boot_image(workspace, bearer_token, image_spec):
     workspace_id = workspace["id"]
     base_url = workspace["location"]["url"]
     request_url = f"{base_url}/pcloud/v1/cloud-instances/{workspace_id}/cos-images"
@@ -38,19 +37,19 @@ def import_boot_image(workspace, bearer_token):
         "CRN": workspace["details"]["crn"],
     }
     request_data = {
-        "imageName": CONFIG.get("image_details")["image_name"],
-        "region": CONFIG.get("cos_bucket_details")["cos_region"],
-        "imageFilename": CONFIG.get("cos_bucket_details")["cos_image_file_name"],
-        "bucketName": CONFIG.get("cos_bucket_details")["cos_bucket"],
+        "imageName": image_spec["image_name"],
+        "region": image_spec["cos_bucket_details"]["cos_region"],
+        "imageFilename": image_spec["cos_bucket_details"]["cos_image_file_name"],
+        "bucketName": image_spec["cos_bucket_details"]["cos_bucket"],
         "accessKey": os.getenv("COS_ACCESS_KEY"),
         "secretKey": os.getenv("COS_SECRET_KEY"),
         "storageType": "tier3",
     }
 
     import_details = {
-        "licenseType": CONFIG.get("image_details", {}).get("license_type", ""),
-        "product": CONFIG.get("image_details", {}).get("product", ""),
-        "vendor": CONFIG.get("image_details", {}).get("vendor", ""),
+        "licenseType": image_spec["license_type"],
+        "product": image_spec["product"],
+        "vendor": image_spec["vendor"],
     }
 
     # Check if any of the import details are empty
@@ -85,3 +84,20 @@ def get_cos_image_import_status(workspace_details, bearer_token):
     }
     response, _err = get_request(request_url, request_headers)
     return response, _err
+
+
+def workspace_from_details(workspace_details):
+    """
+    Rebuilds the workspace structure returned by the PowerVS API from logged workspace details.
+
+    Args:
+        workspace_details: Dictionary with the name, id, crn and base_url of the workspace.
+    Returns:
+        Workspace dictionary accepted by the PowerVS request functions and ImageShareLogger.
+    """
+    return {
+        "name": workspace_details["name"],
+        "id": workspace_details["id"],
+        "details": {"crn": workspace_details["crn"]},
+        "location": {"url": workspace_details["base_url"]},
+    }
@@ -1,17 +1,27 @@
 import json
+import logging
 import multiprocessing
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
+from src.adaptive_limit import get_adaptive_limit, set_adaptive_limit
+from src.api_requests import DEADLINE_EXCEEDED_ERROR, get_run_deadline, is_deadline_error, is_deadline_exceeded, set_run_deadline
 from src.custom_logger import (
     ImageShareLogger,
     log_account_level_image_op,
     merge_image_op_logs,
 )
-from src.ibmcloud_iam import *
-from src.ibmcloud_powervs import *
-from src.log_utils import *
-from src.constants import CONFIG
+from src.ibmcloud_iam import get_account_details, get_child_account_token, get_enterprise_access_token
+from src.ibmcloud_powervs import delete_boot_image, get_cos_image_import_status, import_boot_image
+from src.inventory_cache import invalidate_boot_images, list_boot_images, list_powervs_workspaces
+from src.log_utils import configure_logging, get_log_context, get_log_queue, log_context
+from src.metrics import collect_worker_metrics, get_registry, track_phase
+from src.regions import filter_workspaces_by_region, get_region_slots, interleave_by_region, region_slot, set_region_slots
+from src.result_stream import get_poll_queue, is_streaming, read_stream_log, report_results, set_poll_queue
+from src.run_journal import get_journal_state, record_account_workspaces, record_workspace_outcome, resume_account, resume_workspace, set_journal_state
+from src.status_poller import StatusPoller
+from src.constants import CONFIG, is_plan_run
 
 pi_logger = logging.getLogger("logger")
 
@@ -26,10 +36,10 @@ def get_enterprise_bearer_token(api_key):
     """
 
     pi_logger.info("Start: Generating bearer token for enterprise account using IBMCLOUD API Key...")
-    response, error = generate_bearer_token(api_key)
-    if response:
+    access_token, error = get_enterprise_access_token(api_key)
+    if access_token:
         pi_logger.info("End: Generated bearer token for enterprise account using IBMCLOUD API Key.")
-        return response.json()["access_token"]
+        return access_token
     else:
         pi_logger.error(f"Error generating bearer token for enterprise account. Invalid IBMCLOUD API Key for enterprise account: {error}")
         sys.exit(1)
@@ -45,146 +55,243 @@ def create_account_identity_map(access_token, account_list):
     Returns:
         account_identity_map: Map of account id and their names.
     """
-    relevant_account_info = {}
-    for account_id in account_list:
-        response = get_account_details(account_id, access_token)
-        relevant_account_info[account_id] = response["name"]
+    # Account details are independent of each other, fetch up to 'discovery_concurrency' of them at a time
+    with ThreadPoolExecutor(max_workers=CONFIG.get("discovery_concurrency", 16)) as executor:
+        responses = executor.map(lambda account_id: get_account_details(account_id, access_token), account_list)
+        return {account_id: response["name"] for account_id, response in zip(account_list, responses)}
 
-    return relevant_account_info
 
-
-def filter_trusted_profiles(trusted_profiles, relevant_accounts_dict):
+def filter_trusted_profiles(trusted_profile_index, relevant_accounts_dict):
     """
     Filter trusted profiles to include account ID, profile ID, and account name.
     Args:
-        trusted_profiles: List of trusted profiles.
+        trusted_profile_index: Dictionary mapping account IDs to trusted profiles, see build_trusted_profile_index.
         relevant_accounts_dict: Dictionary mapping account IDs to account names of all accounts in an Account Group.
     Returns:
         filtered_profiles: List of filtered trusted profiles.
     """
     return [
         {
-            "account_id": profile["account_id"],
-            "profile_id": profile["id"],
-            "name": relevant_accounts_dict.get(profile["account_id"], "Unknown"),
+            "account_id": account_id,
+            "profile_id": trusted_profile_index[account_id]["id"],
+            "name": account_name,
         }
-        for profile in trusted_profiles
-        if profile["account_id"] in relevant_accounts_dict
+        for account_id, account_name in relevant_accounts_dict.items()
+        if account_id in trusted_profile_index
     ]
 
 
-def image_ops_on_child_accounts(action, account_list, enterprise_access_token, ops_log_file, ops_status_log_file):
+def image_ops_on_child_accounts(image_specs, account_list, enterprise_access_token, ops_log_file, ops_status_log_file):
     """
     Deploys/Deletes images to /from child accounts using multiprocessing.
+    All images are handled in one pass, so every account and workspace is discovered only once.
+    The status poller runs alongside the pass and polls each workspace as soon as its request was accepted,
+    so the run lasts as long as the slowest workspace rather than the slowest account plus all the polling.
     Args:
-        action: delete, import. Tells what operation to perform.
+        image_specs: Images to import or delete, see get_image_specs.
         account_list: List of account dictionaries containing account details.
         enterprise_access_token: Enterprise account access token.
         ops_log_file: Filename to store logs.
     """
-    operation = {
-        "delete": {"err_message": "ERROR: Delete image failed for following accounts", "sleep": 180, "status": "status-delete"},
-        "import": {"err_message": "ERROR: Import image failed for following accounts", "sleep": 600, "status": "status-import"},
-    }
-
     if account_list:
-        # Perform Delete/Import operation
-        args = [(action, account, enterprise_access_token) for account in account_list]
-        with multiprocessing.Pool(processes=CONFIG.get("processes")) as pool:
-            results = pool.starmap(image_ops_on_child_account, args)
-
-        image_ops_log = merge_image_op_logs(results)
+        status_poller = StatusPoller(image_specs, account_list, enterprise_access_token)
+        status_poller.open()
+        # Perform Delete/Import operation, the poller threads are started once the workers exist
+        with track_phase("operation"):
+            results = run_image_ops_pass(image_specs, account_list, enterprise_access_token, on_started=status_poller.start)
+
+        # In streaming mode the workers keep no results, the log is built from the result stream instead
+        image_ops_log = read_stream_log("operation") if is_streaming() else merge_image_op_logs(results)
         write_logs_to_file(image_ops_log, ops_log_file)
 
-        # Perform Image Operation status checks
+        # Wait for the status checks still running after the operation pass
+        with track_phase("status_poll"):
+            image_ops_status_log = status_poller.finish()
         if image_ops_log and image_ops_log["success"]:
-            pi_logger.info(f"Initiating sleep for {operation[action]['sleep']} seconds before status check.")
-            time.sleep(operation[action]["sleep"])
-            pi_logger.info(f"Initiating status checks ...")
-            count = 0
-            args = [(operation[action]["status"], account, enterprise_access_token) for account in account_list]
+            if image_ops_status_log["failed"]:
+                pi_logger.error(f"ERROR: Image operation failed for following accounts '{image_ops_status_log['failed']}'.")
+            if image_ops_status_log["timed_out"]:
+                pi_logger.error(f"ERROR: Image operation not completed before the deadline for following accounts '{image_ops_status_log['timed_out']}'.")
+            if not image_ops_status_log["failed"] and not image_ops_status_log["timed_out"]:
+                pi_logger.info(f"INFO: Status Check Completed.")
+        else:
+            pi_logger.info(f"No active request/changes done.")
 
-            # Check status every 5 mins with 6 retires
-            while count < 6:
-                with multiprocessing.Pool(processes=CONFIG.get("processes")) as pool:
-                    status_results = pool.starmap(image_ops_on_child_account, args)
-                image_ops_status_log = merge_image_op_logs(status_results)
+        # Also written without changes, so no status log of an earlier run is taken for the one of this run
+        write_logs_to_file(image_ops_status_log, ops_status_log_file)
+        pi_logger.info(f"INFO: Log file written to {ops_status_log_file}.")
 
-                if not image_ops_status_log["failed"]:
-                    pi_logger.info(f"INFO: Status Check Completed.")
-                    pi_logger.info(f"INFO: Log file written to {CONFIG.get('log_operation_file_name')}.")
-                    break
+        if image_ops_log is not None and image_ops_log["timed_out"]:
+            pi_logger.error(f"ERROR: Run deadline exceeded before the operation completed for following accounts '{image_ops_log['timed_out']}'.")
 
-                count += 1
-                pi_logger.info(f"INFO: Initiating sleep for 5 mins. Retrying {count} of 6 times....")
-                time.sleep(300)
+        if image_ops_log is not None and (image_ops_log["failed"] or image_ops_log["timed_out"]):
+            if image_ops_log["failed"]:
+                pi_logger.error(f"ERROR: Image operation failed for following accounts '{image_ops_log['failed']}'.")
+            sys.exit(1)
 
-            if image_ops_status_log is not None and image_ops_status_log["failed"]:
-                pi_logger.error(f"{operation[action]['err_message']} '{image_ops_status_log['failed']}'.")
 
-            write_logs_to_file(image_ops_status_log, ops_status_log_file)
+def run_image_ops_pass(image_specs, account_list, enterprise_access_token, on_started=None):
+    """
+    Runs one image operation pass over all child accounts with the execution engine set in config.yaml.
 
-        else:
-            pi_logger.info(f"No active request/changes done.")
+    The 'multiprocessing' engine fans accounts out over a pool of 'processes' workers. The 'asyncio'
+    engine runs every account and workspace as a coroutine in this process, see src/async_engine.py.
+    The engine only applies to this pass, status polling runs in the threads of the status poller either way.
 
-        if image_ops_log is not None and image_ops_log["failed"]:
-            pi_logger.error(f"{operation[action]['err_message']} '{image_ops_log['failed']}'.")
-            sys.exit(1)
+    Args:
+        image_specs: Images to import or delete, see get_image_specs.
+        account_list: List of account dictionaries containing account details.
+        enterprise_access_token: Enterprise account access token.
+        on_started: Called once the workers exist and before the first account is handed out, e.g. to start
+            threads which must not be running while the workers are forked.
+    Returns:
+        List of account level logs.
+    """
+    if CONFIG.get("execution_engine", "multiprocessing") == "asyncio":
+        # Imported here so multiprocessing runs do not load the event loop machinery
+        from src.async_engine import image_ops_on_child_accounts_async
+
+        if on_started:
+            on_started()
+        return image_ops_on_child_accounts_async(image_specs, account_list, enterprise_access_token)
+
+    account_loggers = []
+    with multiprocessing.Pool(processes=CONFIG.get("processes"), initializer=init_worker, initargs=(get_run_deadline(), get_poll_queue(), get_log_queue(), get_adaptive_limit(), get_region_slots(), get_journal_state())) as pool:
+        # The pool forks all of its workers when it is created
+        if on_started:
+            on_started()
+        # Accounts are collected in the order they finish, so a slow account does not hold back the others
+        for account_logger, worker_metrics in pool.imap_unordered(partial(run_account_pass, image_specs, enterprise_access_token), account_list):
+            # Each worker returns the metrics it recorded for the account along with the account log
+            get_registry().merge(worker_metrics)
+            account_loggers.append(account_logger)
+            pi_logger.info(f"Operation pass completed for {len(account_loggers)} of {len(account_list)} accounts.")
+    return account_loggers
+
+
+def init_worker(run_deadline, poll_queue, log_queue, adaptive_limit, region_slots, journal_state):
+    """
+    Prepares a pool worker. Workers forked from main.py keep its logging setup, workers started by spawn send their
+    log records to the log queue of the parent. Workers stop sending requests at the same run deadline as the parent,
+    share its adaptive concurrency limit and region slots, resume from the journal states it loaded and hand accepted
+    requests to its status poller.
+    """
+    configure_logging(level=CONFIG.get("log_level", "DEBUG"), log_queue=log_queue)
+    set_run_deadline(run_deadline)
+    set_adaptive_limit(adaptive_limit)
+    set_region_slots(region_slots)
+    set_journal_state(journal_state)
+    set_poll_queue(poll_queue)
+
+
+def run_account_pass(image_specs, enterprise_access_token, account):
+    with log_context(account=account["account_id"]):
+        return collect_worker_metrics(image_ops_on_child_account, image_specs, account, enterprise_access_token)
 
 
-def image_ops_on_child_account(action, account, enterprise_access_token):
+def image_ops_on_child_account(image_specs, account, enterprise_access_token):
     """
-    Deletes/Imports image from/to a single child account.
+    Deletes/Imports images from/to a single child account.
 
     Args:
-        action: delete, import. Tells what operation to perform.
+        image_specs: Images to import or delete, see get_image_specs.
         account: Dictionary containing account details.
         enterprise_access_token: Enterprise account access token.
     Returns:
         account_logger
     """
     account_logger = ImageShareLogger()
-    access_token_response, _error = get_child_account_access_token(account["profile_id"], account["account_id"], enterprise_access_token)
-    if access_token_response:
-        bearer_token = f"Bearer {access_token_response.json()['access_token']}"
-        workspace_logger = image_ops_on_workspaces(action, account, bearer_token)
+    workspace_logger = ImageShareLogger()
+    # When resuming, accounts whose workspaces were all handled already are not queried again
+    resumed_logger = resume_account(account, image_specs)
+    if resumed_logger:
+        report_results("operation", account, resumed_logger, workspace_logger)
         return log_account_level_image_op(account_logger, workspace_logger, account)
+
+    access_token, _error = get_child_account_token(account["profile_id"], account["account_id"], enterprise_access_token)
+    if access_token:
+        bearer_token = f"Bearer {access_token}"
+        workspace_logger = image_ops_on_workspaces(image_specs, account, bearer_token)
     else:
-        account_logger.log_other(account, f"Failed to retrieve access token for account - {account['id']}")
-        return account_logger
+        failure_logger = ImageShareLogger()
+        failure_logger.log_other(account, f"Failed to retrieve access token for account - {account['account_id']}, {_error}")
+        report_results("operation", account, failure_logger, workspace_logger)
+    return log_account_level_image_op(account_logger, workspace_logger, account)
 
 
-def image_ops_on_workspaces(action, account, bearer_token):
+def image_ops_on_workspaces(image_specs, account, bearer_token):
     """
-    Deletes/Imports image to all workspaces under an account.
+    Deletes/Imports images to all workspaces under an account in the selected regions.
+    Up to 'workspace_concurrency' workspaces of the account are processed at the same time, and no more
+    than the limit of each regional endpoint, see src/regions.py.
 
     Args:
-        action: delete, import. Tells what operation to perform.
+        image_specs: Images to import or delete, see get_image_specs.
         account: Dictionary containing account details.
         bearer_token: Bearer token for the account.
     Returns:
         logger
     """
     logger = ImageShareLogger()
-    powervs_workspaces_response, _error = get_powervs_workspaces(bearer_token)
-    if powervs_workspaces_response:
-        power_workspaces = powervs_workspaces_response.json()["workspaces"]
-        for workspace in power_workspaces:
-            image_ops_on_workspace(action, workspace, bearer_token, logger)
+    power_workspaces, _error = list_powervs_workspaces(account["account_id"], bearer_token)
+    if power_workspaces is not None:
+        power_workspaces = filter_workspaces_by_region(power_workspaces)
+        record_account_workspaces(account, power_workspaces)
+        if power_workspaces:
+            # The workspace threads start without the log context of the account
+            context_fields = get_log_context()
+
+            def image_ops_in_region(workspace):
+                with log_context(**context_fields, workspace=workspace["name"]), region_slot(workspace["location"]["url"]):
+                    image_ops_on_account_workspace(image_specs, account, workspace, bearer_token, logger)
+
+            max_workers = min(CONFIG.get("workspace_concurrency", 4), len(power_workspaces))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(image_ops_in_region, interleave_by_region(power_workspaces)))
     else:
-        logger.log_other(account, f"Failed to fetch the Power Virtual Server workspaces for {account}, {_error}")
+        failure_logger = ImageShareLogger()
+        failure_logger.log_other(account, f"Failed to fetch the Power Virtual Server workspaces for {account}, {_error}")
+        report_results("operation", account, failure_logger, logger)
     return logger
 
 
-def image_ops_on_workspace(action, workspace, bearer_token, logger):
+def image_ops_on_account_workspace(image_specs, account, workspace, bearer_token, logger):
+    """
+    Runs the image operations on a workspace of an account, records their outcome in the checkpoint journal
+    and reports them to the result stream. Images already handled by a resumed run are logged from the journal instead.
+
+    Args:
+        image_specs: Images to import or delete, see get_image_specs.
+        account: Dictionary containing account details.
+        workspace: Dictionary containing workspace details.
+        bearer_token: Bearer token for the account.
+        logger: Logger object of the account.
+    """
+    resumed_logger = ImageShareLogger()
+    remaining_specs = resume_workspace(account, workspace, image_specs, resumed_logger)
+    report_results("operation", account, resumed_logger, logger)
+    if remaining_specs:
+        # Only the results of this run are recorded, the resumed ones are in the journal already
+        workspace_logger = ImageShareLogger()
+        image_ops_on_workspace(remaining_specs, workspace, bearer_token, workspace_logger)
+        record_workspace_outcome(account, workspace_logger)
+        report_results("operation", account, workspace_logger, logger)
+
+
+def image_ops_on_workspace(image_specs, workspace, bearer_token, logger):
     """
-    Manages image in a single workspace by importing or deleting it.
+    Imports or deletes the images in a single workspace.
+
+    The image list is fetched once and indexed by name for all images. Deletes are sent right away.
+    PowerVS runs one image import job per workspace at a time, so only the first import which is needed
+    is sent and the following ones are logged as queued, the status poller starts them in turn.
+    In plan runs the same decisions are taken, but the requests which would be sent are only logged as success.
 
     Args:
+        image_specs: Images to import or delete, see get_image_specs.
         workspace: Dictionary containing workspace details.
         bearer_token: Bearer token for the account.
         logger: Logger object for logging operations.
-        operation: String specifying the operation ('import' or 'delete').
     """
     workspace_details = {
         "name": workspace["name"],
@@ -193,85 +300,102 @@ def image_ops_on_workspace(action, workspace, bearer_token, logger):
         "base_url": workspace["location"]["url"],
     }
 
-    boot_images_response, _error = get_boot_images(workspace, bearer_token)
-    if not boot_images_response:
-        logger.log_failure(workspace, _error)
+    if is_deadline_exceeded():
+        for image_spec in image_specs:
+            logger.log_timeout(workspace, image_spec["image_name"], DEADLINE_EXCEEDED_ERROR)
         return
 
-    # Check image status in a workspace
-    image_found, is_active = process_image(CONFIG.get("image_details")["image_name"], boot_images_response.json()["images"])
+    latest_job_status = None
+    if any(image_spec["operation"] == "import" for image_spec in image_specs):
+        # The image list and the latest import job are independent, so fetch both at the same time
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            latest_job_future = executor.submit(get_cos_image_import_status, workspace_details, bearer_token)
+            boot_images, _error = list_boot_images(workspace, bearer_token)
+            latest_job_status, _job_error = latest_job_future.result()
+    else:
+        boot_images, _error = list_boot_images(workspace, bearer_token)
 
-    if action == "import":
-        # check if there is already an image import job running
-        latest_job_status, _error = get_cos_image_import_status(workspace_details, bearer_token)
+    if boot_images is None:
+        for image_spec in image_specs:
+            log_workspace_error(logger, workspace, image_spec["image_name"], _error)
+        return
 
-        if image_found and is_active:
-            logger.log_skipped(workspace, "Image with the same name exists in this workspace.")
-        elif (latest_job_status and latest_job_status.json()["status"]["state"]) == "running":
-            logger.log_skipped(workspace, "Another import job already running.")
-        else:
-            # Import boot image
-            response, _error = import_boot_image(workspace, bearer_token)
-            if response:
-                logger.log_success(workspace)
+    # One name index for all requested images, instead of a scan of the image list per image
+    images_by_name = index_boot_images(boot_images)
+    import_running = (latest_job_status and latest_job_status.json()["status"]["state"]) == "running"
+    submitted_import = None
+    images_changed = False
+
+    for image_spec in image_specs:
+        image_name = image_spec["image_name"]
+        image_found = images_by_name.get(image_name)
+        is_active = bool(image_found) and image_found["state"] == "active"
+
+        if image_spec["operation"] == "import":
+            # check if there is already an image import job running
+            if is_active:
+                logger.log_skipped(workspace, image_name, "Image with the same name exists in this workspace.")
+            elif import_running:
+                logger.log_skipped(workspace, image_name, "Another import job already running.")
+            elif submitted_import:
+                logger.log_queued(workspace, image_name, f"Waiting for the import of {submitted_import}.")
+            elif is_plan_run():
+                submitted_import = image_name
+                logger.log_success(workspace, image_name, "The image would be imported.")
             else:
-                logger.log_failure(workspace, _error)
-
-    elif action == "delete":
-        if image_found and is_active:
-            # Delete boot image from workspace
-            response, _error = delete_boot_image(image_found["imageID"], workspace, bearer_token)
-            if response:
-                logger.log_success(workspace)
+                # Import boot image
+                response, _error = import_boot_image(workspace, bearer_token, image_spec)
+                if response:
+                    images_changed = True
+                    submitted_import = image_name
+                    logger.log_success(workspace, image_name)
+                else:
+                    log_workspace_error(logger, workspace, image_name, _error)
+
+        elif image_spec["operation"] == "delete":
+            if is_active and is_plan_run():
+                logger.log_success(workspace, image_name, "The image would be deleted.")
+            elif is_active:
+                # Delete boot image from workspace
+                response, _error = delete_boot_image(image_found["imageID"], workspace, bearer_token)
+                if response:
+                    images_changed = True
+                    logger.log_success(workspace, image_name)
+                else:
+                    log_workspace_error(logger, workspace, image_name, _error)
             else:
-                logger.log_failure(workspace, _error)
-        else:
-            logger.log_skipped(workspace, "The image does not exist.")
-
-    elif action == "status-import":
-        # Check status of image import job running in a workspace
-        response, _err = get_cos_image_import_status(workspace_details, bearer_token)
-        if response:
-            if response.json()["status"]["state"] != "completed":
-                pi_logger.error(f"Status: Image Operation not completed for workspace: {workspace_details}")
-                logger.log_failure(workspace, _error)
-            elif response.json()["status"]["state"] == "completed":
-                pi_logger.info(f"Status: Image Operation completed for workspace: {workspace_details}")
-                logger.log_success(workspace)
-        else:
-            pi_logger.error(f"Error fetching status: {_err}")
+                logger.log_skipped(workspace, image_name, "The image does not exist.")
 
-    elif action == "status-delete":
-        # Check image status in a workspace
-        if image_found and is_active:
-            pi_logger.error(f"Status: Image Operation not completed for workspace: {workspace_details}")
-            logger.log_failure(workspace, _error)
         else:
-            pi_logger.info(f"Status: Image Operation completed for workspace: {workspace_details}")
-            logger.log_success(workspace)
+            logger.log_failure(workspace, image_name, "Invalid operation specified.")
+
+    if images_changed:
+        invalidate_boot_images(workspace["id"])
 
+
+def log_workspace_error(logger, workspace, image_name, error):
+    """
+    Logs a failed request for an image in a workspace, as timed out when the run deadline stopped it.
+    """
+    if is_deadline_error(error):
+        logger.log_timeout(workspace, image_name, error)
     else:
-        logger.log_failure(workspace, "Invalid operation specified.")
+        logger.log_failure(workspace, image_name, error)
 
 
-def process_image(boot_image_name, boot_images):
+def index_boot_images(boot_images):
     """
-    Filter the concerned image from the list of boot images and checks if it's status is active.
+    Indexes the boot images of a workspace by name.
 
     Args:
-        boot_image_name: Name of the boot image to be imported or deleted.
         boot_images: List of boot images.
     Returns:
-        The concerned image dictionary or None.
+        Dictionary mapping image names to images. When several images share a name, the first one listed is used.
     """
-    concerned_image = list(filter(lambda image: image.get("name", "") == boot_image_name, boot_images))
-    if concerned_image:
-        if concerned_image[0]["state"] == "active":
-            return concerned_image[0], True
-        else:
-            return concerned_image[0], False
-    else:
-        return None, False
+    images_by_name = {}
+    for image in boot_images:
+        images_by_name.setdefault(image.get("name", ""), image)
+    return images_by_name
 
 
 def write_logs_to_file(logger, file_name):
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from src.ibmcloud_powervs import get_boot_images, get_powervs_workspaces
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+
+def get_cache_config():
+    return CONFIG.get("inventory_cache") or {}
+
+
+def get_cache_path(kind, key):
+    """
+    Returns the cache file of an entry, or None when the inventory cache is disabled.
+
+    Args:
+        kind: 'accounts' for the workspace list of an account, 'workspaces' for the image list of a workspace.
+        key: Account ID or workspace ID.
+    """
+    directory = get_cache_config().get("directory")
+    if not directory:
+        return None
+    return os.path.join(directory, kind, f"{key}.json")
+
+
+def read_entry(kind, key, ttl):
+    """
+    Returns the cached items of an entry, or None when it is missing, unreadable or older than ttl seconds.
+    """
+    path = get_cache_path(kind, key)
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry["fetched_at"] > ttl:
+        return None
+    return entry["items"]
+
+
+def write_entry(kind, key, items):
+    """
+    Stores the items of an entry. The file is replaced atomically, so readers never see a partial entry.
+    """
+    path = get_cache_path(kind, key)
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"fetched_at": time.time(), "items": items}, f)
+    os.replace(temp_path, path)
+
+
+def invalidate_entry(kind, key):
+    path = get_cache_path(kind, key)
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # Already dropped, e.g. by another daemon job or by the status poller
+        pass
+
+
+def list_powervs_workspaces(account_id, bearer_token):
+    """
+    Returns the Power Virtual Server workspaces of an account, from the inventory cache when fresh.
+
+    Args:
+        account_id: ID of the account the bearer token belongs to.
+        bearer_token: Bearer token for the account.
+    Returns:
+        (workspaces, error): The list of workspaces and None on success, otherwise None and an error message.
+    """
+    workspaces = read_entry("accounts", account_id, get_cache_config().get("workspaces_ttl", 3600))
+    if workspaces is not None:
+        return workspaces, None
+    response, _error = get_powervs_workspaces(bearer_token)
+    if not response:
+        return None, _error
+    workspaces = response.json()["workspaces"]
+    write_entry("accounts", account_id, workspaces)
+    return workspaces, None
+
+
+def list_boot_images(workspace, bearer_token):
+    """
+    Returns the boot images of a workspace, from the inventory cache when fresh.
+
+    Args:
+        workspace: Dictionary containing workspace details.
+        bearer_token: Bearer token for the account.
+    Returns:
+        (images, error): The list of images and None on success, otherwise None and an error message.
+    """
+    images = read_entry("workspaces", workspace["id"], get_cache_config().get("images_ttl", 300))
+    if images is not None:
+        return images, None
+    response, _error = get_boot_images(workspace, bearer_token)
+    if not response:
+        return None, _error
+    images = response.json()["images"]
+    write_entry("workspaces", workspace["id"], images)
+    return images, None
+
+
+def invalidate_boot_images(workspace_id):
+    """
+    Drops the cached image list of a workspace after the tool changed its images.
+    """
+    invalidate_entry("workspaces", workspace_id)
+
+
+def invalidate_powervs_workspaces(account_id):
+    """
+    Drops the cached workspace list of an account, e.g. after a workspace turned out to be gone.
+    """
+    invalidate_entry("accounts", account_id)
@@ -1,32 +1,135 @@
+import atexit
+import contextvars
 import logging
+import multiprocessing
+import os
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 
 pi_logger = logging.getLogger("logger")
 
+# Fields added to every log record, set for the block of code working on them with log_context
+CONTEXT_FIELDS = ("phase", "account", "workspace")
+_log_context = contextvars.ContextVar("log_context", default={})
 
-def configure_logging(log_file_path="console.log"):
+# Queue of the log records of this process and its pool workers, written by the listener of the main process
+_log_queue = None
+_log_listener = None
+_log_listener_pid = None
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Adds fields of CONTEXT_FIELDS to the records logged by the block, e.g. log_context(account=account_id).
+    The fields follow the thread or coroutine they were set in, threads started by the block start without them.
+    """
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def get_log_context():
+    """
+    Returns the log_context fields of the caller, to set them again in the threads it starts.
+    """
+    return dict(_log_context.get())
+
+
+class LogContextFilter(logging.Filter):
+    """
+    Sets the CONTEXT_FIELDS attributes of a record from log_context, and 'context', the fields which are set
+    as text for the log line, e.g. "[phase=operation account=a1b2 workspace=ws-dal10] ".
+    """
+
+    def filter(self, record):
+        fields = _log_context.get()
+        for name in CONTEXT_FIELDS:
+            setattr(record, name, fields.get(name))
+        context = " ".join(f"{name}={fields[name]}" for name in CONTEXT_FIELDS if fields.get(name))
+        record.context = f"[{context}] " if context else ""
+        return True
+
+
+class ProcessQueueHandler(QueueHandler):
+    """
+    Sends records to a multiprocessing.SimpleQueue. A put is written to the pipe right away, so no record is
+    lost when a pool worker is terminated, unlike with the feeder thread of a multiprocessing.Queue.
+    """
+
+    def enqueue(self, record):
+        self.queue.put(record)
+
+
+class ProcessQueueListener(QueueListener):
+    """
+    Writes the records of a multiprocessing.SimpleQueue to its handlers from a single thread.
+    """
+
+    def dequeue(self, block):
+        return self.queue.get()
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def configure_logging(log_file_path="console.log", level="DEBUG", log_queue=None):
+    """
+    Logs to the console and to log_file_path through a queue: log calls only put the record on the queue,
+    and one listener thread of the main process formats and writes the records of all processes, so lines
+    of concurrent workers never interleave and no worker waits on the log file. Records below level are
+    dropped by the logger before they are built.
+
+    Called once by main.py, pool workers forked from it inherit the queue handler. Workers started by spawn
+    pass the queue of the main process as log_queue, see get_log_queue, and only send their records to it.
+    """
+    global _log_queue, _log_listener, _log_listener_pid
     # Create a custom logger
     logger = logging.getLogger("logger")
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(level if isinstance(logging.getLevelName(level), int) else logging.DEBUG)
+    if logger.hasHandlers():
+        return logger
+
+    if log_queue is None:
+        # Create handlers
+        c_handler = logging.StreamHandler()
+        f_handler = logging.FileHandler(log_file_path)
+        c_handler.setLevel(logging.DEBUG)
+        f_handler.setLevel(logging.DEBUG)
 
-    # Create handlers
-    c_handler = logging.StreamHandler()
-    f_handler = logging.FileHandler(log_file_path)
-    c_handler.setLevel(logging.DEBUG)
-    f_handler.setLevel(logging.DEBUG)
+        # Create formatters and add it to handlers
+        c_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(context)s%(message)s")
+        f_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(context)s%(message)s")
+        c_handler.setFormatter(c_format)
+        f_handler.setFormatter(f_format)
 
-    # Create formatters and add it to handlers
-    c_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    f_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    c_handler.setFormatter(c_format)
-    f_handler.setFormatter(f_format)
+        log_queue = multiprocessing.SimpleQueue()
+        _log_listener = ProcessQueueListener(log_queue, c_handler, f_handler)
+        _log_listener.start()
+        _log_listener_pid = os.getpid()
+        atexit.register(stop_logging)
+    _log_queue = log_queue
 
-    # Add handlers to the logger if they haven't been added yet
-    if not logger.hasHandlers():
-        logger.addHandler(c_handler)
-        logger.addHandler(f_handler)
+    q_handler = ProcessQueueHandler(log_queue)
+    q_handler.addFilter(LogContextFilter())
+    logger.addHandler(q_handler)
 
     return logger
 
 
-# Configure logging when the module is imported
-configure_logging()
+def get_log_queue():
+    return _log_queue
+
+
+def stop_logging():
+    """
+    Writes the records still queued and stops the listener. Runs at exit of the main process, forked
+    processes which end without running atexit handlers, e.g. daemon jobs, call it themselves.
+    """
+    global _log_listener
+    # Forked processes inherit the listener of their parent, but not its thread
+    if _log_listener is not None and _log_listener_pid == os.getpid():
+        _log_listener.stop()
+        _log_listener = None
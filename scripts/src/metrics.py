@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from src.log_utils import log_context
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+# Prefix of the metric names in the Prometheus output
+METRIC_PREFIX = "pi_image_ops_"
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# API call of a request, by the first path fragment of its url that matches
+API_CALLS = (
+    ("/identity/token", "token"),
+    ("/identity/profiles", "profiles"),
+    ("/v1/accounts/", "account"),
+    ("/v1/accounts", "accounts"),
+    ("/v1/workspaces", "workspaces"),
+    ("/cos-images", "cos_images"),
+    ("/images", "images"),
+)
+METRIC_HELP = {
+    "http_requests_total": ("counter", "HTTP requests sent, by endpoint class, API call, method and status."),
+    "http_request_duration_seconds": ("histogram", "HTTP request latency in seconds, by endpoint class and API call."),
+    "http_retries_total": ("counter", "Retried HTTP requests, by endpoint class and reason."),
+    "http_requests_in_flight_peak": ("gauge", "Peak number of HTTP requests in flight, summed over the worker processes."),
+    "sleep_seconds_total": ("counter", "Seconds spent waiting, by reason."),
+    "phase_duration_seconds": ("gauge", "Duration of the run phases in seconds."),
+    "workspace_results_total": ("counter", "Workspace results, by phase and state."),
+    "run_duration_seconds": ("gauge", "Duration of the run in seconds."),
+    "adaptive_concurrency_limit": ("gauge", "Current, lowest and highest adaptive limit of the requests in flight."),
+}
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and latency histograms of one process, keyed by metric name and label values.
+
+    Pool workers hand their registry back with their results through snapshot(), and the parent
+    adds it to its own with merge(). Counters and histograms are summed. A worker sends one snapshot
+    per task, so its gauges (peaks) are kept at their largest value per worker and then summed over workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [count per bucket..., count above the last bucket, sum of observed values]
+        self.histograms = {}
+        self._in_flight = {}
+        # pid -> gauges of a pool worker
+        self._worker_gauges = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, labels, value):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+            bucket = next((index for index, bound in enumerate(LATENCY_BUCKETS) if value <= bound), len(LATENCY_BUCKETS))
+            histogram[bucket] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def track_in_flight(self, endpoint_class):
+        """
+        Counts a request as in flight while the block runs and keeps the peak per endpoint class.
+        """
+        key = ("http_requests_in_flight_peak", (("endpoint", endpoint_class),))
+        with self._lock:
+            self._in_flight[endpoint_class] = self._in_flight.get(endpoint_class, 0) + 1
+            self.gauges[key] = max(self.gauges.get(key, 0), self._in_flight[endpoint_class])
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[endpoint_class] -= 1
+
+    def snapshot(self):
+        """
+        Returns the metrics collected so far as plain data, which can be sent back from a pool worker.
+        """
+        with self._lock:
+            gauges = dict(self.gauges)
+            for worker_gauges in self._worker_gauges.values():
+                for key, value in worker_gauges.items():
+                    gauges[key] = gauges.get(key, 0) + value
+            return {"pid": os.getpid(), "counters": dict(self.counters), "gauges": gauges, "histograms": {key: list(value) for key, value in self.histograms.items()}}
+
+    def merge(self, snapshot):
+        """
+        Adds the metrics of a snapshot, e.g. one returned by a pool worker.
+        """
+        with self._lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            worker_gauges = self._worker_gauges.setdefault(snapshot["pid"], {})
+            for key, value in snapshot["gauges"].items():
+                worker_gauges[key] = max(worker_gauges.get(key, 0), value)
+            for key, value in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(key, [0] * len(value))
+                for index, count in enumerate(value):
+                    histogram[index] += count
+
+
+# One registry per process. Pool workers are forked from the parent, so the pid is tracked to start
+# each worker with an empty registry instead of a copy of the parent's.
+_registry = MetricsRegistry()
+_registry_pid = os.getpid()
+_registry_lock = threading.Lock()
+# Start of the run, the metrics module is loaded by main.py on startup
+_started_at = time.monotonic()
+
+
+def get_registry():
+    global _registry, _registry_pid
+    if _registry_pid != os.getpid():
+        with _registry_lock:
+            if _registry_pid != os.getpid():
+                _registry = MetricsRegistry()
+                _registry_pid = os.getpid()
+    return _registry
+
+
+def get_api_call(url):
+    """
+    Returns the name of the API call a request url belongs to, e.g. 'token' or 'images'.
+    """
+    path = urlparse(url).path
+    return next((call for fragment, call in API_CALLS if fragment in path), "other")
+
+
+def observe_request(endpoint_class, call, method, status, duration):
+    """
+    Records one HTTP request attempt.
+
+    Args:
+        endpoint_class: iam, enterprise, powervs or cos.
+        call: API call of the request, see get_api_call.
+        method: HTTP method.
+        status: HTTP status code, or 'error' when no response was received.
+        duration: Seconds the request took.
+    """
+    registry = get_registry()
+    registry.inc("http_requests_total", {"endpoint": endpoint_class, "call": call, "method": method, "status": str(status)})
+    registry.observe("http_request_duration_seconds", {"endpoint": endpoint_class, "call": call}, duration)
+
+
+def count_retry(endpoint_class, reason):
+    get_registry().inc("http_retries_total", {"endpoint": endpoint_class, "reason": str(reason)})
+
+
+def count_sleep(reason, seconds):
+    """
+    Records time spent waiting instead of working, e.g. on the rate limiter, retry backoff or status polling.
+    """
+    if seconds > 0:
+        get_registry().inc("sleep_seconds_total", {"reason": reason}, seconds)
+
+
+def count_results(phase, logger):
+    """
+    Counts the workspace results of an ImageShareLogger per state.
+    """
+    registry = get_registry()
+    for result in logger.results:
+        registry.inc("workspace_results_total", {"phase": phase, "state": result.status.value})
+
+
+@contextmanager
+def track_phase(phase):
+    """
+    Records the duration of a phase of the run, e.g. discovery, operation or status_poll.
+    The phase is added to the records logged by the block, see log_context.
+    """
+    started = time.monotonic()
+    try:
+        with log_context(phase=phase):
+            yield
+    finally:
+        get_registry().set_gauge("phase_duration_seconds", {"phase": phase}, time.monotonic() - started)
+
+
+def collect_worker_metrics(function, *args):
+    """
+    Runs function in a pool worker and returns its result with the metrics it recorded.
+    The worker registry is emptied, so the next task of the worker reports only its own metrics.
+
+    Returns:
+        (result, snapshot): The return value of function and the metrics snapshot to merge in the parent.
+    """
+    registry = get_registry()
+    registry.reset()
+    result = function(*args)
+    snapshot = registry.snapshot()
+    registry.reset()
+    return result, snapshot
+
+
+def restart_run_clock():
+    """
+    Starts the run duration over, for a run in a process loaded before it, e.g. a daemon job.
+    """
+    global _started_at
+    _started_at = time.monotonic()
+
+
+def get_progress():
+    """
+    Returns a short summary of the run so far: the workspace results per phase and state, the durations
+    of the finished phases and the number of requests sent, as reported by the daemon for a running job.
+    """
+    snapshot = get_registry().snapshot()
+    progress = {"results": {}, "phases": {}, "requests": 0}
+    for (name, labels), value in snapshot["counters"].items():
+        labels = dict(labels)
+        if name == "workspace_results_total":
+            progress["results"].setdefault(labels["phase"], {})[labels["state"]] = int(value)
+        elif name == "http_requests_total":
+            progress["requests"] += int(value)
+    for (name, labels), value in snapshot["gauges"].items():
+        if name == "phase_duration_seconds":
+            progress["phases"][dict(labels)["phase"]] = round(value, 1)
+    return progress
+
+
+def get_metrics_log():
+    """
+    Returns the metrics of the run in the format of the JSON metrics file.
+    """
+    snapshot = get_registry().snapshot()
+    metrics_log = {}
+    for (name, labels), value in sorted(list(snapshot["counters"].items()) + list(snapshot["gauges"].items())):
+        metrics_log.setdefault(name, []).append({"labels": dict(labels), "value": round(value, 6)})
+    for (name, labels), histogram in sorted(snapshot["histograms"].items()):
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram[:-1]):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        metrics_log.setdefault(name, []).append({"labels": dict(labels), "count": cumulative, "sum": round(histogram[-1], 6), "buckets": buckets})
+    return metrics_log
+
+
+def format_prometheus(metrics_log):
+    """
+    Formats the metrics log in the Prometheus text exposition format, for the node exporter textfile collector.
+    """
+
+    def format_labels(labels):
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}" if labels else ""
+
+    lines = []
+    for name, series in metrics_log.items():
+        metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+        full_name = METRIC_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        for sample in series:
+            if metric_type != "histogram":
+                lines.append(f"{full_name}{format_labels(sample['labels'])} {sample['value']}")
+                continue
+            for bound, count in sample["buckets"].items():
+                lines.append(f"{full_name}_bucket{format_labels({**sample['labels'], 'le': bound})} {count}")
+            lines.append(f"{full_name}_sum{format_labels(sample['labels'])} {sample['sum']}")
+            lines.append(f"{full_name}_count{format_labels(sample['labels'])} {sample['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics():
+    """
+    Writes the metrics of the run to the files set in the 'metrics' section of config.yaml.
+    The Prometheus file is replaced atomically, as the textfile collector may read it at any time.
+    """
+    metrics_config = CONFIG.get("metrics") or {}
+    get_registry().set_gauge("run_duration_seconds", {}, time.monotonic() - _started_at)
+    metrics_log = get_metrics_log()
+    if metrics_config.get("json_file_name"):
+        with open(metrics_config["json_file_name"], "w", encoding="utf-8") as f:
+            json.dump(metrics_log, f, ensure_ascii=False, indent=4)
+        pi_logger.info(f"INFO: Metrics written to {metrics_config['json_file_name']}.")
+    if metrics_config.get("prometheus_file_name"):
+        temp_path = f"{metrics_config['prometheus_file_name']}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(format_prometheus(metrics_log))
+        os.replace(temp_path, metrics_config["prometheus_file_name"])
+        pi_logger.info(f"INFO: Prometheus metrics written to {metrics_config['prometheus_file_name']}.")
@@ -0,0 +1,152 @@
+import logging
+import time
+
+from src.custom_logger import merge_image_op_logs
+from src.ibmcloud_utils import run_image_ops_pass, write_logs_to_file
+from src.metrics import get_registry, track_phase
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+
+def plan_image_ops_on_child_accounts(image_specs, account_list, enterprise_access_token, plan_file):
+    """
+    Works out what an import/delete run would do, without changing anything.
+
+    The operation pass runs as in a real run, with the configured engine and concurrency, so accounts,
+    workspaces, images and import jobs are discovered and every image gets the same decision it would get.
+    The import and delete requests are only logged, no journal is written and nothing is polled.
+    The plan file lists the workspaces which would be imported, deleted, queued or skipped, with the reason,
+    and an estimate of the requests and duration of the real run, see estimate_run.
+
+    Args:
+        image_specs: Images to import or delete, see get_image_specs.
+        account_list: List of account dictionaries containing account details.
+        enterprise_access_token: Enterprise account access token.
+        plan_file: Filename to store the plan.
+    """
+    started = time.monotonic()
+    with track_phase("plan"):
+        results = run_image_ops_pass(image_specs, account_list, enterprise_access_token)
+    plan_seconds = time.monotonic() - started
+
+    plan_log = split_by_operation(image_specs, merge_image_op_logs(results))
+    plan = {"summary": {"accounts": len(account_list), **count_workspaces(plan_log), **estimate_run(plan_log, plan_seconds)}, **plan_log}
+    write_logs_to_file(plan, plan_file)
+
+    summary = plan["summary"]
+    pi_logger.info(
+        f"INFO: Plan: {summary['import']} imports, {summary['delete']} deletes, {summary['queued']} queued imports and "
+        f"{summary['skipped']} skipped images in {summary['workspaces']} workspaces of {summary['accounts']} accounts."
+    )
+    pi_logger.info(
+        f"INFO: Plan: about {summary['estimated_requests']['total']} requests and "
+        f"{summary['estimated_duration_seconds']['total']} seconds for the run."
+    )
+    if plan_log["failed"] or plan_log["timed_out"] or plan_log["other"]:
+        pi_logger.error(f"ERROR: Some workspaces could not be planned, see {plan_file}.")
+    pi_logger.info(f"INFO: Plan written to {plan_file}.")
+
+
+def split_by_operation(image_specs, image_ops_log):
+    """
+    Replaces the 'success' list of a plan run log by an 'import' and a 'delete' list.
+    """
+    operations = {image_spec["image_name"]: image_spec["operation"] for image_spec in image_specs}
+    plan_log = {"import": [], "delete": []}
+    for account_log in image_ops_log["success"]:
+        for operation in plan_log:
+            workspaces = [workspace for workspace in account_log["workspaces"] if operations[workspace["image_name"]] == operation]
+            if workspaces:
+                plan_log[operation].append({"id": account_log["id"], "name": account_log["name"], "workspaces": workspaces})
+    plan_log.update({key: value for key, value in image_ops_log.items() if key != "success"})
+    return plan_log
+
+
+def count_workspaces(plan_log):
+    """
+    Returns the number of image decisions per list of the plan log, and the number of workspaces they are in.
+    """
+    keys = [key for key in plan_log if key != "other"]
+    counts = {"workspaces": len({workspace["id"] for key in keys for account_log in plan_log[key] for workspace in account_log["workspaces"]})}
+    counts.update({key: sum(len(account_log["workspaces"]) for account_log in plan_log[key]) for key in keys})
+    counts["other"] = len(plan_log["other"])
+    return counts
+
+
+def get_poll_time(operation_seconds, time_left):
+    """
+    Returns the number of status requests and the seconds the status poller needs to see an operation
+    which takes operation_seconds complete, following the backoff of 'status_poll'. Polling stops after time_left seconds.
+    """
+    poll_config = CONFIG.get("status_poll") or {}
+    interval = poll_config.get("initial_interval", 15)
+    elapsed = interval
+    polls = 1
+    while elapsed < min(operation_seconds, time_left):
+        interval = min(interval * poll_config.get("backoff_factor", 2), poll_config.get("max_interval", 120))
+        elapsed += interval
+        polls += 1
+    return polls, elapsed
+
+
+def estimate_run(plan_log, plan_seconds):
+    """
+    Estimates the requests and the duration of the real run from the plan run.
+
+    The real run sends the same read requests as the plan run, plus the import and delete requests, at the
+    same concurrency, so the operation phase is the plan run time scaled by the extra requests. The status
+    poll phase is the poll schedule of the slowest workspace, where queued imports run one after the other,
+    for jobs taking 'plan.expected_import_seconds' and 'plan.expected_delete_seconds'. It is capped by
+    'status_poll.deadline'.
+
+    Args:
+        plan_log: Plan log, see split_by_operation.
+        plan_seconds: Duration of the plan run operation pass.
+    Returns:
+        Dictionary with the estimated_requests and estimated_duration_seconds per phase.
+    """
+    plan_config = CONFIG.get("plan") or {}
+    read_requests = sum(value for (name, _labels), value in get_registry().snapshot()["counters"].items() if name == "http_requests_total")
+    operation_requests = sum(len(account_log["workspaces"]) for key in ("import", "delete") for account_log in plan_log[key])
+    queued_requests = sum(len(account_log["workspaces"]) for account_log in plan_log["queued"])
+
+    poll_deadline = (CONFIG.get("status_poll") or {}).get("deadline", 2400)
+    imports_per_workspace = {}
+    for key in ("import", "queued"):
+        for account_log in plan_log[key]:
+            for workspace in account_log["workspaces"]:
+                imports_per_workspace[workspace["id"]] = imports_per_workspace.get(workspace["id"], 0) + 1
+    poll_requests = 0
+    poll_seconds = 0
+    # The imports of a workspace run one after the other
+    for imports in imports_per_workspace.values():
+        workspace_seconds = 0
+        for _import in range(imports):
+            if workspace_seconds >= poll_deadline:
+                break
+            polls, seconds = get_poll_time(plan_config.get("expected_import_seconds", 900), poll_deadline - workspace_seconds)
+            poll_requests += polls
+            workspace_seconds += seconds
+        poll_seconds = max(poll_seconds, workspace_seconds)
+    # Deletes are polled all at the same time
+    if plan_log["delete"]:
+        polls, seconds = get_poll_time(plan_config.get("expected_delete_seconds", 30), poll_deadline)
+        poll_requests += polls * sum(len(account_log["workspaces"]) for account_log in plan_log["delete"])
+        poll_seconds = max(poll_seconds, seconds)
+    poll_seconds = min(poll_seconds, poll_deadline)
+
+    operation_seconds = plan_seconds * (read_requests + operation_requests) / read_requests if read_requests else plan_seconds
+    return {
+        "estimated_requests": {
+            "read": read_requests,
+            "import_delete": operation_requests + queued_requests,
+            "status_poll": poll_requests,
+            "total": read_requests + operation_requests + queued_requests + poll_requests,
+        },
+        "estimated_duration_seconds": {
+            "operation": round(operation_seconds, 1),
+            "status_poll": round(poll_seconds, 1),
+            "total": round(operation_seconds + poll_seconds, 1),
+        },
+    }
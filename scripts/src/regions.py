@@ -0,0 +1,186 @@
+import logging
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain, zip_longest
+from urllib.parse import urlparse
+
+from src.metrics import count_sleep
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+# Regional endpoints the slots of a run can hold, more than PowerVS has, and the bytes kept of each endpoint name
+MAX_REGIONS = 64
+REGION_NAME_SIZE = 128
+
+# Slots of the run, created by main.py before the pool workers are forked. Workers get them from the pool initializer.
+_region_slots = None
+_region_slots_lock = threading.Lock()
+
+
+def get_regions_config():
+    return CONFIG.get("regions") or {}
+
+
+def get_endpoint_region(url):
+    """
+    Returns the region of a PowerVS endpoint url, e.g. 'us-south' for https://us-south.power-iaas.cloud.ibm.com.
+    Other hosts, e.g. a local mock server, are their own region.
+    """
+    url = urlparse(url)
+    if url.hostname and url.hostname.endswith(".power-iaas.cloud.ibm.com"):
+        return url.hostname.split(".")[0]
+    return url.netloc
+
+
+def get_workspace_regions(workspace):
+    """
+    Returns the names a workspace can be filtered by: its location region (data center, e.g. 'dal10')
+    and the region of its endpoint (e.g. 'us-south').
+    """
+    return {workspace["location"].get("region"), get_endpoint_region(workspace["location"]["url"])} - {None}
+
+
+def filter_workspaces_by_region(workspaces):
+    """
+    Drops the workspaces outside 'regions.include', or inside 'regions.exclude', so they are never queried.
+
+    Args:
+        workspaces: Workspaces as returned by the PowerVS API.
+    Returns:
+        The workspaces to work on.
+    """
+    include = set(get_regions_config().get("include") or [])
+    exclude = set(get_regions_config().get("exclude") or [])
+    if not include and not exclude:
+        return workspaces
+    selected = [
+        workspace
+        for workspace in workspaces
+        if (not include or get_workspace_regions(workspace) & include) and not get_workspace_regions(workspace) & exclude
+    ]
+    if len(selected) != len(workspaces):
+        pi_logger.info(f"Skipping {len(workspaces) - len(selected)} of {len(workspaces)} workspaces outside the selected regions.")
+    return selected
+
+
+def interleave_by_region(workspaces):
+    """
+    Orders workspaces round robin over their regional endpoints, so workers spread over all regions
+    instead of queueing up behind the limit of the region listed first.
+    """
+    groups = {}
+    for workspace in workspaces:
+        groups.setdefault(get_endpoint_region(workspace["location"]["url"]), []).append(workspace)
+    return [workspace for workspace in chain.from_iterable(zip_longest(*groups.values())) if workspace is not None]
+
+
+def get_region_limit(region):
+    """
+    Returns the number of workspaces of a regional endpoint worked on at the same time by the whole run.
+    'regions.limits' overrides 'regions.max_concurrency' per region.
+    """
+    regions_config = get_regions_config()
+    return (regions_config.get("limits") or {}).get(region, regions_config.get("max_concurrency", 8))
+
+
+class RegionSlots:
+    """
+    Concurrency slots per regional endpoint, shared by main.py and all its pool workers, so the region limits hold
+    for the run and not once per process.
+
+    The regional endpoints are only known once the workspaces are discovered, so each one takes the next free row
+    of a shared table the first time any process works on it. Endpoints beyond MAX_REGIONS are not limited.
+    """
+
+    def __init__(self):
+        # Shared memory and a process-shared lock, like AdaptiveLimit
+        self._condition = multiprocessing.Condition()
+        self._names = multiprocessing.RawArray("c", MAX_REGIONS * REGION_NAME_SIZE)
+        self._limits = multiprocessing.RawArray("i", MAX_REGIONS)
+        self._in_use = multiprocessing.RawArray("i", MAX_REGIONS)
+        self._count = multiprocessing.RawValue("i", 0)
+
+    def get_row(self, region):
+        """
+        Returns the row of region in the shared table, adding it on first use, or None when the table is full.
+        Called with the condition held.
+        """
+        name = region.encode("utf-8")[:REGION_NAME_SIZE]
+        for row in range(self._count.value):
+            if self._names[row * REGION_NAME_SIZE : (row + 1) * REGION_NAME_SIZE].rstrip(b"\0") == name:
+                return row
+        if self._count.value == MAX_REGIONS:
+            pi_logger.warning(f"WARNING: More than {MAX_REGIONS} regional endpoints, region {region} is not limited.")
+            return None
+        row = self._count.value
+        self._names[row * REGION_NAME_SIZE : row * REGION_NAME_SIZE + len(name)] = name
+        self._limits[row] = get_region_limit(region)
+        self._count.value += 1
+        return row
+
+    def acquire(self, region):
+        """
+        Blocks until a slot of region is free.
+
+        Returns:
+            (row, waited): The row of the slot to release, None for an unlimited region, and the seconds spent
+            waiting, None when a slot was free right away.
+        """
+        waited = None
+        with self._condition:
+            row = self.get_row(region)
+            if row is None:
+                return None, None
+            if self._in_use[row] >= self._limits[row]:
+                started = time.monotonic()
+                while self._in_use[row] >= self._limits[row]:
+                    self._condition.wait()
+                waited = time.monotonic() - started
+            self._in_use[row] += 1
+        return row, waited
+
+    def release(self, row):
+        if row is None:
+            return
+        with self._condition:
+            self._in_use[row] -= 1
+            self._condition.notify_all()
+
+
+def start_region_slots():
+    """
+    Creates the region slots of the run.
+    """
+    set_region_slots(RegionSlots())
+
+
+def set_region_slots(region_slots):
+    global _region_slots
+    _region_slots = region_slots
+
+
+def get_region_slots():
+    return _region_slots
+
+
+@contextmanager
+def region_slot(url):
+    """
+    Holds one of the concurrency slots of the regional endpoint of url while the block runs.
+    Time spent waiting for a slot is recorded in the run metrics.
+    """
+    with _region_slots_lock:
+        if _region_slots is None:
+            # Callers outside main.py, e.g. the tests, get slots of their own process
+            start_region_slots()
+        region_slots = _region_slots
+    row, waited = region_slots.acquire(get_endpoint_region(url))
+    if waited is not None:
+        count_sleep("region_limit", waited)
+    try:
+        yield
+    finally:
+        region_slots.release(row)
@@ -0,0 +1,105 @@
+import json
+import logging
+import threading
+
+from src.custom_logger import ResultStatus
+from src.metrics import count_results
+from src.constants import CONFIG, is_plan_run
+
+pi_logger = logging.getLogger("logger")
+
+_stream_lock = threading.Lock()
+# Queue of the status poller while it runs next to the operation pass, see StatusPoller. Pool workers get it from the pool initializer.
+_poll_queue = None
+
+
+def get_stream_file():
+    return CONFIG.get("result_stream_file_name")
+
+
+def is_streaming():
+    # Plan runs report nothing to the stream, it keeps the results of the last real run
+    return bool(get_stream_file()) and not is_plan_run()
+
+
+def set_poll_queue(poll_queue):
+    global _poll_queue
+    _poll_queue = poll_queue
+
+
+def get_poll_queue():
+    return _poll_queue
+
+
+def start_stream():
+    """
+    Starts the result stream of this run over.
+    """
+    if is_streaming():
+        open(get_stream_file(), "w").close()
+
+
+def report_results(phase, account, source_logger, target_logger):
+    """
+    Reports the results logged for one workspace or account.
+
+    Accepted and queued operation results are handed to the status poller right away, when one is running.
+    In streaming mode every result is appended to the result stream as one JSON line right away and is
+    not kept in memory. Otherwise the results are added to target_logger.
+
+    Args:
+        phase: operation or status.
+        account: Dictionary containing account details.
+        source_logger: ImageShareLogger holding the new results.
+        target_logger: ImageShareLogger collecting the results of the account.
+    """
+    count_results(phase, source_logger)
+    if phase == "operation" and _poll_queue is not None:
+        accepted = [
+            (result.status.value, result.get_details()) for result in source_logger.results if result.status in (ResultStatus.SUCCESS, ResultStatus.QUEUED)
+        ]
+        if accepted:
+            _poll_queue.put((account, accepted))
+    if not is_streaming():
+        target_logger.extend(source_logger)
+        return
+
+    lines = []
+    for result in source_logger.results:
+        record = {"phase": phase, "state": result.status.value, "account_id": account["account_id"], "account_name": account["name"], "entry": result.to_dict()}
+        lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+    for error in source_logger.other:
+        record = {"phase": phase, "state": "other", "account_id": account["account_id"], "account_name": account["name"], "entry": error.to_dict()}
+        lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+    if lines:
+        # One write per batch on a file opened for appending, so lines of concurrent pool workers do not interleave
+        with _stream_lock, open(get_stream_file(), "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+
+
+def read_stream_log(phase):
+    """
+    Builds the merged log of a phase from the result stream.
+
+    Args:
+        phase: operation or status.
+    Returns:
+        dict: Log in the format of merge_image_op_logs, with workspaces grouped per account.
+    """
+    final_log = {status.value: [] for status in ResultStatus}
+    final_log["other"] = []
+    account_groups = {}
+    with open(get_stream_file(), encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["phase"] != phase:
+                continue
+            if record["state"] == "other":
+                final_log["other"].append(record["entry"])
+                continue
+            group_key = (record["state"], record["account_id"])
+            if group_key not in account_groups:
+                account_groups[group_key] = {"id": record["account_id"], "name": record["account_name"], "workspaces": []}
+                final_log[record["state"]].append(account_groups[group_key])
+            account_groups[group_key]["workspaces"].append(record["entry"])
+    return final_log
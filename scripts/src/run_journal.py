@@ -0,0 +1,212 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from src.custom_logger import ImageShareLogger, ResultStatus
+from src.ibmcloud_powervs import workspace_from_details
+from src.constants import CONFIG, is_plan_run
+
+pi_logger = logging.getLogger("logger")
+
+# Workspace states recorded in the journal
+SUBMITTED = "submitted"
+COMPLETED = "completed"
+SKIPPED = "skipped"
+FAILED = "failed"
+QUEUED = "queued"
+# Account state recorded once its workspaces were listed
+LISTED = "listed"
+# Journal state of each operation outcome. Timed out workspaces are left unfinished.
+OUTCOME_STATES = {ResultStatus.SUCCESS: SUBMITTED, ResultStatus.SKIPPED: SKIPPED, ResultStatus.FAILED: FAILED, ResultStatus.QUEUED: QUEUED}
+# States of images which need no new request when resuming
+HANDLED_STATES = (SUBMITTED, COMPLETED, SKIPPED)
+
+_journal_lock = threading.Lock()
+# Latest journal record per (account_id, workspace_id, image_name) and the listed workspace ids per account_id,
+# loaded from the journal of the interrupted run when resuming
+_workspace_states = {}
+_account_workspaces = {}
+
+
+def get_journal_file():
+    return (CONFIG.get("journal") or {}).get("file_name")
+
+
+def get_config_fingerprint():
+    """
+    Returns a fingerprint of the config values that define what a run does.
+    A journal written with a different fingerprint is not resumed.
+    """
+    run_config = {
+        key: CONFIG.get(key) for key in ("enterprise_id", "account_group_id", "account_list", "image_operation", "image_details", "cos_bucket_details", "images", "regions")
+    }
+    return hashlib.sha256(json.dumps(run_config, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def start_journal():
+    """
+    Prepares the checkpoint journal for this run.
+
+    With 'journal.resume' set, the states recorded by an earlier run with the same config fingerprint
+    are loaded and new records are appended. Otherwise the journal is started over.
+    Plan runs only load the journal to plan the resumed run, they never write it.
+    """
+    journal_file = get_journal_file()
+    if not journal_file:
+        return
+    if not (CONFIG.get("journal") or {}).get("resume"):
+        if not is_plan_run():
+            open(journal_file, "w").close()
+        return
+    if not os.path.exists(journal_file):
+        pi_logger.info(f"No journal found at {journal_file}, starting a new run.")
+        return
+
+    fingerprint = get_config_fingerprint()
+    ignored = 0
+    with open(journal_file, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A run killed mid-write can leave a partial last line
+                continue
+            if record["fingerprint"] != fingerprint:
+                ignored += 1
+            elif record["state"] == LISTED:
+                _account_workspaces[record["account_id"]] = record["workspace_ids"]
+            else:
+                _workspace_states[(record["account_id"], record["workspace"]["id"], record["workspace"]["image_name"])] = record
+    if ignored:
+        pi_logger.warning(f"Ignored {ignored} journal records written with a different config.")
+    pi_logger.info(f"Resuming from {journal_file}: {len(_workspace_states)} workspaces in {len(_account_workspaces)} accounts already handled.")
+
+
+def get_journal_state():
+    """
+    Returns the journal states loaded by start_journal, handed to the pool workers, see set_journal_state.
+    """
+    return _workspace_states, _account_workspaces
+
+
+def set_journal_state(journal_state):
+    """
+    Sets the journal states loaded by the parent in a pool worker. Workers started by spawn or forkserver do not
+    inherit the memory of the parent, without them every workspace of the interrupted run would be handled again.
+    """
+    global _workspace_states, _account_workspaces
+    _workspace_states, _account_workspaces = journal_state
+
+
+def append_record(record):
+    """
+    Appends one record to the journal as a single JSON line.
+    """
+    journal_file = get_journal_file()
+    if not journal_file or is_plan_run():
+        return
+    record["fingerprint"] = get_config_fingerprint()
+    record["time"] = time.time()
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    # One write per line on a file opened for appending, so lines of concurrent pool workers do not interleave
+    with _journal_lock, open(journal_file, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def record_account_workspaces(account, workspaces):
+    append_record({"account_id": account["account_id"], "state": LISTED, "workspace_ids": [workspace["id"] for workspace in workspaces]})
+
+
+def record_workspace_state(account, workspace_details, state, message=None):
+    """
+    Records the state of an image in a workspace of an account.
+
+    Args:
+        account: Dictionary containing account details.
+        workspace_details: Dictionary with the name, id, crn, base_url and image_name of the workspace result.
+        state: submitted, completed, skipped, failed or queued.
+        message: Optional reason for the state.
+    """
+    append_record({"account_id": account["account_id"], "workspace": workspace_details, "state": state, "message": message})
+
+
+def record_workspace_outcome(account, workspace_logger):
+    """
+    Records the outcome of the import/delete request of a workspace from its ImageShareLogger.
+    """
+    for result in workspace_logger.results:
+        if result.status in OUTCOME_STATES:
+            record_workspace_state(account, result.get_details(), OUTCOME_STATES[result.status], result.message)
+
+
+def get_resumed_state(account, workspace_id, image_specs, image_spec):
+    """
+    Returns the journal state of an image in a workspace which needs no new request, otherwise None.
+    A queued import is only resumed as queued while an earlier import into the workspace is still submitted.
+    """
+    record = _workspace_states.get((account["account_id"], workspace_id, image_spec["image_name"]))
+    if not record:
+        return None
+    if record["state"] in HANDLED_STATES:
+        return record["state"]
+    if record["state"] == QUEUED:
+        other_states = [_workspace_states.get((account["account_id"], workspace_id, other["image_name"])) for other in image_specs if other is not image_spec]
+        if any(other and other["state"] == SUBMITTED for other in other_states):
+            return QUEUED
+    return None
+
+
+def resume_workspace(account, workspace, image_specs, logger):
+    """
+    Logs the images of a workspace handled by the resumed run without querying the workspace again.
+
+    Images with a submitted request are logged as success, so they go straight to status polling.
+    Queued imports are logged as queued again. Completed and skipped images are logged as skipped.
+
+    Args:
+        account: Dictionary containing account details.
+        workspace: Workspace dictionary as returned by the PowerVS API.
+        image_specs: Images of the run, see get_image_specs.
+        logger: ImageShareLogger of the account.
+    Returns:
+        The image specs still to be handled in the workspace.
+    """
+    remaining_specs = []
+    for image_spec in image_specs:
+        state = get_resumed_state(account, workspace["id"], image_specs, image_spec)
+        if state == SUBMITTED:
+            logger.log_success(workspace, image_spec["image_name"])
+        elif state == QUEUED:
+            logger.log_queued(workspace, image_spec["image_name"], "Queued in a previous run.")
+        elif state:
+            logger.log_skipped(workspace, image_spec["image_name"], f"Already {state} in a previous run.")
+        else:
+            remaining_specs.append(image_spec)
+    return remaining_specs
+
+
+def resume_account(account, image_specs):
+    """
+    Rebuilds the workspace log of an account from the journal when all images in all its workspaces were
+    handled already, so neither a token nor the workspace list is requested for it.
+
+    Args:
+        account: Dictionary containing account details.
+        image_specs: Images of the run, see get_image_specs.
+    Returns:
+        ImageShareLogger of the account, or None when the account still has unfinished workspaces.
+    """
+    workspace_ids = _account_workspaces.get(account["account_id"])
+    if workspace_ids is None:
+        return None
+    if not all(get_resumed_state(account, workspace_id, image_specs, image_spec) for workspace_id in workspace_ids for image_spec in image_specs):
+        return None
+
+    logger = ImageShareLogger()
+    for workspace_id in workspace_ids:
+        record = _workspace_states[(account["account_id"], workspace_id, image_specs[0]["image_name"])]
+        resume_workspace(account, workspace_from_details(record["workspace"]), image_specs, logger)
+    return logger
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+
+from src.custom_logger import merge_image_op_logs, merge_status_logs
+from src.ibmcloud_utils import write_logs_to_file
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+# Output files written per shard, by their place in config.yaml
+SHARD_FILES = (
+    ("log_operation_file_name",),
+    ("log_status_file_name",),
+    ("result_stream_file_name",),
+    ("journal", "file_name"),
+    ("metrics", "json_file_name"),
+    ("metrics", "prometheus_file_name"),
+    ("plan", "file_name"),
+)
+
+
+def get_shard():
+    """
+    Returns (index, count) of the shard this run works on, (0, 1) when the run is not sharded.
+    """
+    sharding_config = CONFIG.get("sharding") or {}
+    return sharding_config.get("index", 0), sharding_config.get("count", 1)
+
+
+def is_sharded():
+    return get_shard()[1] > 1
+
+
+def get_account_shard(account_id, count):
+    """
+    Returns the shard of an account. The account ID is hashed, so every runner assigns the same accounts
+    to the same shard without talking to the others, and the shards come out about the same size.
+    """
+    return int(hashlib.sha256(account_id.encode("utf-8")).hexdigest()[:16], 16) % count
+
+
+def in_shard(account_id):
+    index, count = get_shard()
+    return count <= 1 or get_account_shard(account_id, count) == index
+
+
+def get_shard_file_name(file_name, index=None):
+    """
+    Returns the file name of a shard, e.g. pi_image_ops_log.shard-2-of-4.json for shard 2 of 4.
+
+    Args:
+        file_name: File name of an unsharded run.
+        index: Shard index, the one of this run when not given.
+    """
+    shard_index, count = get_shard()
+    root, extension = os.path.splitext(file_name)
+    return f"{root}.shard-{shard_index if index is None else index}-of-{count}{extension}"
+
+
+def start_shard():
+    """
+    Points the output files of config.yaml to the files of this shard, so runners sharing a directory do not
+    overwrite each other's logs, journal and metrics. Does nothing when the run is not sharded.
+    """
+    index, count = get_shard()
+    if count <= 1:
+        return
+    if index >= count:
+        pi_logger.error(f"ERROR: Shard index {index} is out of range for {count} shards, use 0 to {count - 1}.")
+        sys.exit(1)
+    for path in SHARD_FILES:
+        section = CONFIG
+        for key in path[:-1]:
+            section = section.get(key) or {}
+        if section.get(path[-1]):
+            section[path[-1]] = get_shard_file_name(section[path[-1]])
+    pi_logger.info(f"INFO: Running shard {index} of {count} shards (0 to {count - 1}).")
+
+
+def read_shard_logs(file_name):
+    """
+    Returns the logs written by the shards to file_name, by shard index, and the indexes of the shards without one.
+    """
+    logs = {}
+    missing = []
+    for index in range(get_shard()[1]):
+        shard_file_name = get_shard_file_name(file_name, index)
+        if not os.path.exists(shard_file_name):
+            missing.append(index)
+            continue
+        with open(shard_file_name, encoding="utf-8") as f:
+            logs[index] = json.load(f)
+    return logs, missing
+
+
+def merge_logs(logs):
+    """
+    Merges shard logs into one log in the format of merge_image_op_logs, or of merge_status_logs for STATUS runs.
+    Every account is in exactly one shard, so the account entries are only put together.
+    """
+    merged_log = merge_status_logs([]) if any("active_images" in log for log in logs) else merge_image_op_logs([])
+    for log in logs:
+        for key in merged_log:
+            merged_log[key].extend(log.get(key, []))
+    return merged_log
+
+
+def merge_shard_logs():
+    """
+    Merges the operation and status logs written by the shards of a sharded run into 'log_operation_file_name'
+    and 'log_status_file_name', as one unsharded run would have written them. Exits with 1 when a shard log is missing.
+
+    Every shard of an import/delete run writes an operation log and a status log, also when it changed nothing.
+    Every shard of a STATUS run writes a status log only.
+    """
+    _, count = get_shard()
+    if count <= 1:
+        pi_logger.error("ERROR: Nothing to merge, set 'sharding.count' to the number of shards of the run.")
+        sys.exit(1)
+
+    operation_file = CONFIG.get("log_operation_file_name")
+    status_file = CONFIG.get("log_status_file_name")
+    operation_logs, missing_operation_logs = read_shard_logs(operation_file)
+    status_logs, missing_status_logs = read_shard_logs(status_file)
+    # Operation logs come from all shards of an import/delete run, or from none of a STATUS run
+    missing = sorted(set(missing_status_logs + (missing_operation_logs if operation_logs else [])))
+    if missing:
+        pi_logger.error(f"ERROR: No logs found for shards {missing} of {count}, run them before merging.")
+        sys.exit(1)
+
+    for file_name, logs in ((operation_file, operation_logs), (status_file, status_logs)):
+        if not logs:
+            continue
+        write_logs_to_file(merge_logs([logs[index] for index in sorted(logs)]), file_name)
+        pi_logger.info(f"INFO: Merged the logs of {len(logs)} of {count} shards into {file_name}.")
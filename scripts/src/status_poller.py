@@ -0,0 +1,343 @@
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.api_requests import get_remaining_time, is_not_found_error
+from src.custom_logger import ImageShareLogger, ResultStatus, log_account_level_image_op, merge_image_op_logs
+from src.ibmcloud_iam import get_child_account_token
+from src.ibmcloud_powervs import get_boot_images, get_cos_image_import_status, import_boot_image, workspace_from_details
+from src.log_utils import log_context
+from src.inventory_cache import invalidate_boot_images, invalidate_powervs_workspaces
+from src.metrics import count_sleep
+from src.regions import region_slot
+from src.result_stream import is_streaming, read_stream_log, report_results, set_poll_queue
+from src import run_journal
+from src.run_journal import record_workspace_state
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+COMPLETED = "completed"
+PENDING = "pending"
+FAILED = "failed"
+GONE = "gone"
+
+
+class StatusPoller:
+    """
+    Polls the workspace images with an accepted import/delete request until each one completes.
+
+    The poller runs in a thread of main.py while the operation pass is still going. report_results puts every
+    accepted or queued workspace image into its queue as soon as its request is accepted, also from pool workers,
+    so polling starts per workspace instead of after the slowest account.
+
+    Only pending images are polled. Each one starts at 'status_poll.initial_interval' seconds and backs
+    off exponentially up to 'status_poll.max_interval'. An image is dropped as soon as its operation
+    completed, failed or the workspace is gone. Once an import completed or failed, the next import queued
+    for the same workspace is sent and polled in turn. Requests to a regional endpoint are capped by its
+    region limit, see src/regions.py. Images still pending 'status_poll.deadline' seconds after their request
+    was accepted, or at the run deadline if that comes first, are logged as timed out. An image whose check
+    raises, e.g. on a response without the expected fields, stays pending, and a queued import whose request
+    raises is logged as failed, so one bad response does not stop the poller.
+    """
+
+    def __init__(self, image_specs, account_list, enterprise_access_token):
+        """
+        Args:
+            image_specs: Images of the run, see get_image_specs.
+            account_list: List of account dictionaries containing account details.
+            enterprise_access_token: Enterprise account access token.
+        """
+        self.poll_config = CONFIG.get("status_poll") or {}
+        self.image_specs_by_name = {image_spec["image_name"]: image_spec for image_spec in image_specs}
+        self.accounts = {account["account_id"]: account for account in account_list}
+        self.loggers = {account_id: ImageShareLogger() for account_id in self.accounts}
+        self.enterprise_access_token = enterprise_access_token
+        self.pending = []
+        # Queued imports per (account_id, workspace_id), in the order they are started
+        self.queued = {}
+        # Written by report_results in any process of the run. A SimpleQueue writes to its pipe right away, so the
+        # workspaces of an account are in the pipe before the account result reaches the parent.
+        self.inbox = multiprocessing.SimpleQueue()
+        self.arrivals = queue.Queue()
+        # Set when the poller thread stopped on an error, finish then ends the run with exit code 1
+        self.error = None
+        self.closed = False
+        self.threads = [threading.Thread(target=self.read_inbox, daemon=True), threading.Thread(target=self.run, daemon=True)]
+
+    def open(self):
+        """
+        Lets report_results hand accepted workspace images to the poller. Called before the worker pool is created,
+        so the workers get the inbox with their initargs.
+        """
+        set_poll_queue(self.inbox)
+
+    def start(self):
+        """
+        Starts the poller threads. Called once the worker pool exists, a worker forked while a poller thread holds a
+        lock, e.g. the one of the logging handlers, would otherwise keep it locked forever.
+        """
+        for thread in self.threads:
+            thread.start()
+
+    def finish(self):
+        """
+        Tells the poller that the operation pass is done and waits until the last workspace image completed or timed out.
+
+        Returns:
+            Merged status log in the same format as the operation log.
+        """
+        set_poll_queue(None)
+        self.inbox.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error:
+            pi_logger.error(f"ERROR: Status polling stopped before all workspace images were checked, {self.error}")
+            sys.exit(1)
+        if is_streaming():
+            return read_stream_log("status")
+        return merge_image_op_logs(
+            [log_account_level_image_op(ImageShareLogger(), self.loggers[account_id], account) for account_id, account in self.accounts.items()]
+        )
+
+    def read_inbox(self):
+        # Hands the batches over to the poller thread, which waits on them with a timeout
+        while True:
+            batch = self.inbox.get()
+            self.arrivals.put(batch)
+            if batch is None:
+                return
+
+    def run(self):
+        try:
+            self.poll()
+        except Exception as e:
+            pi_logger.exception(f"Status: Polling stopped, {e}")
+            self.error = e
+            # Keep taking the batches of the operation pass until it is done
+            while not self.closed:
+                self.closed = self.arrivals.get() is None
+
+    def poll(self):
+        with log_context(phase="status_poll"), ThreadPoolExecutor(max_workers=self.poll_config.get("concurrency", 16)) as self.executor:
+            closed = False
+            while not closed or self.pending:
+                closed = self.receive(closed, block=False)
+                now = time.monotonic()
+                self.expire(now)
+                due = [item for item in self.pending if item["next_poll"] <= now]
+                if due:
+                    self.check_due(due)
+                    pi_logger.info(f"Status: {len(self.pending)} workspace images still pending.")
+                    continue
+                # Wait for the next poll, or for new workspaces while the operation pass is running
+                delay = min((min(item["next_poll"], item["deadline"]) for item in self.pending), default=None)
+                started = time.monotonic()
+                if closed:
+                    time.sleep(max(delay - started, 0))
+                else:
+                    closed = self.receive(closed, block=True, timeout=None if delay is None else max(delay - started, 0))
+                count_sleep("status_poll", time.monotonic() - started)
+
+        for (account_id, _workspace_id), queued_workspaces in self.queued.items():
+            for workspace_details in queued_workspaces:
+                pi_logger.error(f"Status: Queued image import not started for workspace: {workspace_details}")
+                self.log_timeout(self.accounts[account_id], workspace_details, "Queued image import not started before the status check deadline.")
+
+    def receive(self, closed, block, timeout=None):
+        """
+        Adds the workspace images which arrived from the operation pass. Returns True once the pass is done.
+        """
+        while not closed:
+            try:
+                batch = self.arrivals.get(block=block, timeout=timeout)
+            except queue.Empty:
+                break
+            if batch is None:
+                self.closed = True
+                return True
+            self.add(*batch)
+            block = False
+        return closed
+
+    def add(self, account, accepted):
+        """
+        Starts polling the accepted images of a workspace or account, and starts its queued imports when no
+        import of their workspace is pending.
+
+        Args:
+            account: Dictionary containing account details.
+            accepted: List of (state, workspace_details) with state success or queued.
+        """
+        initial_interval = self.poll_config.get("initial_interval", 15)
+        queue_keys = []
+        for state, workspace_details in accepted:
+            if state == ResultStatus.SUCCESS.value:
+                self.pending.append(self.create_item(account, workspace_details, initial_interval))
+            else:
+                queue_key = (account["account_id"], workspace_details["id"])
+                self.queued.setdefault(queue_key, []).append(workspace_details)
+                queue_keys.append(queue_key)
+        importing = {
+            (item["account"]["account_id"], item["workspace"]["id"])
+            for item in self.pending
+            if self.image_specs_by_name[item["workspace"]["image_name"]]["operation"] == "import"
+        }
+        self.start_queued_imports([queue_key for queue_key in dict.fromkeys(queue_keys) if queue_key not in importing])
+        pi_logger.info(f"Status: {len(self.pending)} workspace images pending, {sum(map(len, self.queued.values()))} imports queued.")
+
+    def create_item(self, account, workspace_details, initial_interval):
+        item = create_poll_item(account, workspace_details, initial_interval)
+        poll_time = self.poll_config.get("deadline", 2400)
+        if get_remaining_time() is not None:
+            poll_time = min(poll_time, get_remaining_time())
+        item["deadline"] = time.monotonic() + poll_time
+        return item
+
+    def get_bearer_token(self, account):
+        access_token, _error = get_child_account_token(account["profile_id"], account["account_id"], self.enterprise_access_token)
+        return (f"Bearer {access_token}", None) if access_token else (None, _error)
+
+    def check(self, item):
+        with log_context(phase="status_poll", account=item["account"]["account_id"], workspace=item["workspace"]["name"]):
+            try:
+                bearer_token, _error = self.get_bearer_token(item["account"])
+                if not bearer_token:
+                    return PENDING, _error
+                with region_slot(item["workspace"]["base_url"]):
+                    return get_image_op_status(self.image_specs_by_name[item["workspace"]["image_name"]], item["workspace"], bearer_token)
+            except Exception as e:
+                pi_logger.exception(f"Status: Could not check the image operation for workspace: {item['workspace']}, {e}")
+                return PENDING, str(e)
+
+    def start_next_import(self, queue_key):
+        # Sends the queued imports of a workspace until one is accepted
+        account = self.accounts[queue_key[0]]
+        failures = []
+        while self.queued.get(queue_key):
+            workspace_details = self.queued[queue_key].pop(0)
+            with log_context(phase="status_poll", account=account["account_id"], workspace=workspace_details["name"]):
+                try:
+                    bearer_token, _error = self.get_bearer_token(account)
+                    if bearer_token:
+                        image_spec = self.image_specs_by_name[workspace_details["image_name"]]
+                        with region_slot(workspace_details["base_url"]):
+                            response, _error = import_boot_image(workspace_from_details(workspace_details), bearer_token, image_spec)
+                        if response:
+                            return workspace_details, failures
+                except Exception as e:
+                    pi_logger.exception(f"Status: Could not start the queued image import for workspace: {workspace_details}, {e}")
+                    _error = str(e)
+            failures.append((workspace_details, _error))
+        return None, failures
+
+    def start_queued_imports(self, queue_keys):
+        for queue_key, (started, failures) in zip(queue_keys, self.executor.map(self.start_next_import, queue_keys)):
+            account = self.accounts[queue_key[0]]
+            if not self.queued.get(queue_key):
+                self.queued.pop(queue_key, None)
+            for workspace_details, _error in failures:
+                pi_logger.error(f"Status: Queued image import could not be started for workspace: {workspace_details}")
+                logger = ImageShareLogger()
+                logger.log_failure(workspace_from_details(workspace_details), workspace_details["image_name"], _error)
+                record_workspace_state(account, workspace_details, run_journal.FAILED, _error)
+                report_results("status", account, logger, self.loggers[account["account_id"]])
+            if started:
+                pi_logger.info(f"Status: Started queued image import for workspace: {started}")
+                invalidate_boot_images(started["id"])
+                record_workspace_state(account, started, run_journal.SUBMITTED)
+                self.pending.append(self.create_item(account, started, self.poll_config.get("initial_interval", 15)))
+
+    def check_due(self, due):
+        next_imports = []
+        for item, (state, message) in zip(due, self.executor.map(self.check, due)):
+            workspace_details = item["workspace"]
+            workspace = workspace_from_details(workspace_details)
+            image_name = workspace_details["image_name"]
+            queue_key = (item["account"]["account_id"], workspace_details["id"])
+            logger = ImageShareLogger()
+            if state == COMPLETED:
+                pi_logger.info(f"Status: Image Operation completed for workspace: {workspace_details}")
+                logger.log_success(workspace, image_name)
+                invalidate_boot_images(workspace_details["id"])
+                record_workspace_state(item["account"], workspace_details, run_journal.COMPLETED)
+            elif state == GONE:
+                pi_logger.info(f"Status: Workspace no longer exists: {workspace_details}")
+                logger.log_skipped(workspace, image_name, message)
+                for queued_details in self.queued.pop(queue_key, []):
+                    logger.log_skipped(workspace_from_details(queued_details), queued_details["image_name"], message)
+                    record_workspace_state(item["account"], queued_details, run_journal.SKIPPED, message)
+                invalidate_powervs_workspaces(item["account"]["account_id"])
+                record_workspace_state(item["account"], workspace_details, run_journal.SKIPPED, message)
+            elif state == FAILED:
+                pi_logger.error(f"Status: Image Operation failed for workspace: {workspace_details}")
+                logger.log_failure(workspace, image_name, message)
+                record_workspace_state(item["account"], workspace_details, run_journal.FAILED, message)
+            else:
+                item["interval"] = min(item["interval"] * self.poll_config.get("backoff_factor", 2), self.poll_config.get("max_interval", 120))
+                item["next_poll"] = time.monotonic() + item["interval"]
+                continue
+            if self.queued.get(queue_key):
+                next_imports.append(queue_key)
+            report_results("status", item["account"], logger, self.loggers[item["account"]["account_id"]])
+            self.pending.remove(item)
+        self.start_queued_imports(next_imports)
+
+    def expire(self, now):
+        # Images past their deadline are logged as timed out, along with the imports queued behind them
+        for item in [item for item in self.pending if item["deadline"] <= now]:
+            pi_logger.error(f"Status: Image Operation not completed for workspace: {item['workspace']}")
+            self.log_timeout(item["account"], item["workspace"], "Image operation not completed before the status check deadline.")
+            for workspace_details in self.queued.pop((item["account"]["account_id"], item["workspace"]["id"]), []):
+                pi_logger.error(f"Status: Queued image import not started for workspace: {workspace_details}")
+                self.log_timeout(item["account"], workspace_details, "Queued image import not started before the status check deadline.")
+            self.pending.remove(item)
+
+    def log_timeout(self, account, workspace_details, message):
+        logger = ImageShareLogger()
+        logger.log_timeout(workspace_from_details(workspace_details), workspace_details["image_name"], message)
+        report_results("status", account, logger, self.loggers[account["account_id"]])
+
+
+def create_poll_item(account, workspace_details, initial_interval):
+    return {
+        "account": account,
+        "workspace": workspace_details,
+        "interval": initial_interval,
+        "next_poll": time.monotonic() + initial_interval,
+    }
+
+
+def get_image_op_status(image_spec, workspace_details, bearer_token):
+    """
+    Checks whether the import/delete operation of an image in a single workspace has completed.
+
+    Args:
+        image_spec: Image whose operation is checked, see get_image_specs.
+        workspace_details: Dictionary with the name, id, crn and base_url of the workspace.
+        bearer_token: Bearer token for the account.
+    Returns:
+        (state, message): state is one of completed, pending, failed or gone.
+    """
+    if image_spec["operation"] == "import":
+        response, _error = get_cos_image_import_status(workspace_details, bearer_token)
+        if not response:
+            return (GONE, "The workspace no longer exists.") if is_not_found_error(_error) else (PENDING, _error)
+        state = response.json()["status"]["state"]
+        if state == "completed":
+            return COMPLETED, None
+        if state == "failed":
+            return FAILED, response.json()["status"].get("message", "Image import job failed.")
+        return PENDING, f"Image import job is {state}."
+
+    response, _error = get_boot_images(workspace_from_details(workspace_details), bearer_token)
+    if not response:
+        return (GONE, "The workspace no longer exists.") if is_not_found_error(_error) else (PENDING, _error)
+    image_name = image_spec["image_name"]
+    if any(image.get("name", "") == image_name and image["state"] == "active" for image in response.json()["images"]):
+        return PENDING, "Image is still active."
+    return COMPLETED, None
@@ -0,0 +1,123 @@
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.api_requests import is_not_found_error
+from src.custom_logger import ImageStatusLogger, log_account_level_status, merge_status_logs
+from src.ibmcloud_iam import get_child_account_token
+from src.ibmcloud_powervs import get_boot_images, get_cos_image_import_status
+from src.ibmcloud_utils import index_boot_images, write_logs_to_file
+from src.log_utils import log_context
+from src.inventory_cache import list_powervs_workspaces
+from src.metrics import track_phase
+from src.regions import filter_workspaces_by_region, interleave_by_region, region_slot
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+# Job state reported for workspaces without any image import job
+NO_JOB = "none"
+
+
+def image_status_on_child_accounts(image_specs, account_list, enterprise_access_token, status_log_file):
+    """
+    Reports the state of the images in every workspace of the child accounts without changing anything.
+
+    The scan is read-only: no image is imported or deleted, the checkpoint journal is left untouched and
+    nothing is polled. Accounts and workspaces are scanned by one pool of 'status_scan_concurrency' threads,
+    the workspaces of an account are queued as soon as they are listed. Requests to a regional endpoint
+    are capped by its region limit, see src/regions.py.
+
+    Args:
+        image_specs: Images to report on, see get_image_specs.
+        account_list: List of account dictionaries containing account details.
+        enterprise_access_token: Enterprise account access token.
+        status_log_file: Filename to store the image states.
+    """
+    loggers = {account["account_id"]: ImageStatusLogger() for account in account_list}
+    with track_phase("status_scan"), ThreadPoolExecutor(max_workers=CONFIG.get("status_scan_concurrency", 32)) as executor:
+        listings = {executor.submit(list_account_workspaces, account, enterprise_access_token): account for account in account_list}
+        scans = []
+        for listing in as_completed(listings):
+            account = listings[listing]
+            bearer_token, workspaces, _error = listing.result()
+            if _error:
+                loggers[account["account_id"]].log_other(account, _error)
+                continue
+            for workspace in workspaces:
+                scans.append(executor.submit(scan_workspace, image_specs, account, workspace, bearer_token, loggers[account["account_id"]]))
+        for scan in scans:
+            scan.result()
+
+    image_status_log = merge_status_logs(
+        [log_account_level_status(ImageStatusLogger(), loggers[account["account_id"]], account) for account in account_list]
+    )
+    write_logs_to_file(image_status_log, status_log_file)
+    pi_logger.info(
+        f"INFO: Image status: {sum(len(account['workspaces']) for account in image_status_log['active_images'])} active, "
+        f"{sum(len(account['workspaces']) for account in image_status_log['inactive_images'])} inactive, "
+        f"{sum(len(account['workspaces']) for account in image_status_log['missing_images'])} missing."
+    )
+    pi_logger.info(f"INFO: Log file written to {status_log_file}.")
+    if image_status_log["other"]:
+        pi_logger.error(f"ERROR: Image status could not be checked for following accounts '{image_status_log['other']}'.")
+        sys.exit(1)
+
+
+def list_account_workspaces(account, enterprise_access_token):
+    """
+    Returns the bearer token of a child account and its workspaces in the selected regions.
+
+    Returns:
+        (bearer_token, workspaces, error): error is None on success, otherwise a message for the status log.
+    """
+    with log_context(phase="status_scan", account=account["account_id"]):
+        access_token, _error = get_child_account_token(account["profile_id"], account["account_id"], enterprise_access_token)
+        if not access_token:
+            return None, None, f"Failed to retrieve access token for account - {account['account_id']}, {_error}"
+        bearer_token = f"Bearer {access_token}"
+        workspaces, _error = list_powervs_workspaces(account["account_id"], bearer_token)
+        if workspaces is None:
+            return None, None, f"Failed to fetch the Power Virtual Server workspaces for {account}, {_error}"
+        return bearer_token, interleave_by_region(filter_workspaces_by_region(workspaces)), None
+
+
+def scan_workspace(image_specs, account, workspace, bearer_token, logger):
+    """
+    Logs the state of every image of the run in a single workspace, along with the state of the latest
+    image import job there. The image list is always fetched fresh, as images change outside this tool.
+
+    Args:
+        image_specs: Images to report on, see get_image_specs.
+        account: Dictionary containing account details.
+        workspace: Dictionary containing workspace details.
+        bearer_token: Bearer token for the account.
+        logger: ImageStatusLogger of the account.
+    """
+    with log_context(phase="status_scan", account=account["account_id"], workspace=workspace["name"]):
+        workspace_details = {"id": workspace["id"], "crn": workspace["details"]["crn"], "base_url": workspace["location"]["url"]}
+        with region_slot(workspace["location"]["url"]):
+            # Read past the inventory cache, which is neither read nor written by the scan
+            response, _error = get_boot_images(workspace, bearer_token)
+            if not response:
+                logger.log_other(account, f"Failed to fetch the boot images of workspace {workspace['name']} ({workspace['id']}), {_error}")
+                return
+            boot_images = response.json()["images"]
+            response, _error = get_cos_image_import_status(workspace_details, bearer_token)
+        if response:
+            job_state = response.json()["status"]["state"]
+        elif is_not_found_error(_error):
+            job_state = NO_JOB
+        else:
+            logger.log_other(account, f"Failed to fetch the image import job of workspace {workspace['name']} ({workspace['id']}), {_error}")
+            return
+
+        images_by_name = index_boot_images(boot_images)
+        for image_spec in image_specs:
+            image = images_by_name.get(image_spec["image_name"])
+            if image is None:
+                logger.log_missing(workspace, image_spec["image_name"], job_state)
+            elif image["state"] == "active":
+                logger.log_active(workspace, image_spec["image_name"], job_state)
+            else:
+                logger.log_inactive(workspace, image_spec["image_name"], image["state"], job_state)
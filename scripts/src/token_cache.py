@@ -0,0 +1,92 @@
+import logging
+import os
+import threading
+import time
+
+from src.constants import CONFIG
+
+pi_logger = logging.getLogger("logger")
+
+
+class TokenCache:
+    """
+    Caches IAM access tokens per (profile_id, account_id) until shortly before they expire.
+
+    The expiry is read from 'expires_in' of the IAM response, and a token is refreshed once less than
+    'token_refresh_margin' seconds of its lifetime are left. Concurrent callers asking for the same key
+    wait for a single in-flight token exchange instead of each running their own.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get_token(self, key, exchange):
+        """
+        Returns a cached access token for key, running exchange to mint a new one when needed.
+
+        Args:
+            key: (profile_id, account_id) tuple identifying the token.
+            exchange: Callable that performs the IAM token request and returns (response, error).
+        Returns:
+            (access_token, error): The access token and None on success, otherwise None and an error message.
+        """
+        access_token = self._get_valid(key)
+        if access_token:
+            return access_token, None
+
+        with self._get_key_lock(key):
+            # Another caller may have refreshed the token while this one was waiting
+            access_token = self._get_valid(key)
+            if access_token:
+                return access_token, None
+
+            response, error = exchange()
+            if not response:
+                return None, error
+            token_details = response.json()
+            expires_at = time.monotonic() + token_details.get("expires_in", 3600)
+            self._tokens[key] = (token_details["access_token"], expires_at)
+            pi_logger.debug(f"Cached access token for {key}, expires in {token_details.get('expires_in', 3600)} seconds.")
+            return token_details["access_token"], None
+
+    def invalidate(self, access_token):
+        """
+        Drops a cached token which IAM or an API rejected, e.g. one revoked before it expired,
+        so the next caller mints a new one instead of reusing it until it expires.
+        """
+        for key, cached in list(self._tokens.items()):
+            if cached[0] == access_token and self._tokens.pop(key, None):
+                pi_logger.warning(f"Dropped the cached access token for {key}, it was rejected.")
+
+    def export(self):
+        """
+        Returns the cached tokens which are still valid, as plain data which can be sent to another process.
+        The expiry is kept on the monotonic clock, which is shared by all processes of a host.
+        """
+        return {key: cached for key, cached in list(self._tokens.items()) if self._get_valid(key)}
+
+    def load(self, tokens):
+        """
+        Adds tokens returned by export, e.g. the ones the daemon kept from earlier jobs.
+        """
+        self._tokens.update(tokens)
+
+    def _get_valid(self, key):
+        cached = self._tokens.get(key)
+        if cached and cached[1] - time.monotonic() > CONFIG.get("token_refresh_margin", 300):
+            return cached[0]
+        return None
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            # Locks copied into a forked pool worker may be held by threads that do not exist there
+            if self._pid != os.getpid():
+                self._key_locks = {}
+                self._pid = os.getpid()
+            return self._key_locks.setdefault(key, threading.Lock())
+
+
+token_cache = TokenCache()
@@ -0,0 +1,27 @@
+import copy
+import os
+import sys
+
+import pytest
+
+# The scripts import their modules as src.*, and the tests run against the mock server of benchmark/
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SCRIPTS_DIR, os.path.join(SCRIPTS_DIR, "benchmark")]
+
+from src.constants import CONFIG  # noqa: E402
+from src.regions import set_region_slots  # noqa: E402
+from src.run_journal import set_journal_state  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def config():
+    """
+    Gives every test the CONFIG of config.yaml and restores it afterwards, along with the loaded journal states
+    and the region slots.
+    """
+    saved = copy.deepcopy(CONFIG)
+    yield CONFIG
+    CONFIG.clear()
+    CONFIG.update(saved)
+    set_journal_state(({}, {}))
+    set_region_slots(None)
@@ -0,0 +1,187 @@
+"""
+Tests of the request layer: connection pools, retries, Retry-After, the run deadline and the per host rate limit.
+Requests go to a scripted session, so every attempt and every backoff sleep is known.
+"""
+
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import pytest
+import requests
+from requests.exceptions import ConnectionError
+
+from src import api_requests
+from src.api_requests import DEADLINE_EXCEEDED_ERROR, TokenBucket, create_session, get_request, get_retry_delay, get_timeout, post_request
+
+URL = "http://127.0.0.1:1/pcloud/v1/cloud-instances/ws-0/images"
+
+
+def make_response(status_code, retry_after=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = URL
+    response._content = b"{}"
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return response
+
+
+class ScriptedSession:
+    """
+    Answers the requests in turn with the given status codes, or raises the given exceptions.
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.requests.append((method, timeout))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return make_response(outcome)
+
+
+@pytest.fixture
+def session(config, monkeypatch):
+    """
+    Sends the requests to a ScriptedSession, records the backoff sleeps instead of sleeping and lifts the rate limit.
+    """
+    config["retry"] = {"max_attempts": 4, "base_delay": 1, "max_delay": 30, "max_retry_after": 120}
+    config["rate_limit"] = {"requests_per_second": 10000, "burst": 10000}
+    monkeypatch.setattr(api_requests, "_rate_limiters", {})
+    monkeypatch.setattr(api_requests, "_run_deadline", None)
+    sleeps = []
+    monkeypatch.setattr(api_requests, "time", SimpleNamespace(monotonic=time.monotonic, time=time.time, sleep=sleeps.append))
+
+    def use(*outcomes):
+        scripted_session = ScriptedSession(outcomes)
+        scripted_session.sleeps = sleeps
+        monkeypatch.setattr(api_requests, "get_session", lambda: scripted_session)
+        return scripted_session
+
+    return use
+
+
+def get_pool_maxsize(session):
+    return session.get_adapter("https://").poolmanager.connection_pool_kw["maxsize"]
+
+
+def test_connection_pools_hold_a_connection_per_thread_by_default(config):
+    config.update({"http_pool": {"pool_maxsize": None}, "status_scan_concurrency": 32, "discovery_concurrency": 16, "status_poll": {"concurrency": 48}})
+    assert get_pool_maxsize(create_session()) == 48
+
+    config.update({"execution_engine": "asyncio", "async_concurrency": 64})
+    assert get_pool_maxsize(create_session()) == 64
+
+    config["http_pool"] = {"pool_maxsize": 5}
+    assert get_pool_maxsize(create_session()) == 5
+
+
+def test_retry_after_in_seconds_is_honoured(config):
+    assert get_retry_delay(1, make_response(429, "7")) == 7
+
+
+def test_retry_after_as_http_date_is_honoured(config):
+    delay = get_retry_delay(1, make_response(503, formatdate(time.time() + 30, usegmt=True)))
+    assert 28 <= delay <= 30
+
+
+def test_retry_after_is_capped_at_max_retry_after(config):
+    config["retry"] = {"max_retry_after": 5}
+    assert get_retry_delay(1, make_response(429, "600")) == 5
+    assert get_retry_delay(1, make_response(429, formatdate(time.time() + 600, usegmt=True))) == 5
+
+
+def test_backoff_without_retry_after_doubles_up_to_max_delay(config):
+    config["retry"] = {"base_delay": 1, "max_delay": 6}
+    assert all(0 <= get_retry_delay(3) <= 4 for _ in range(50))
+    assert all(0 <= get_retry_delay(10, make_response(503)) <= 6 for _ in range(50))
+
+
+def test_retry_delay_ends_at_the_run_deadline(config, monkeypatch):
+    monkeypatch.setattr(api_requests, "_run_deadline", time.time() + 2)
+    assert get_retry_delay(1, make_response(429, "60")) <= 2
+
+    monkeypatch.setattr(api_requests, "_run_deadline", time.time() - 1)
+    assert get_retry_delay(1, make_response(429, "60")) == 0
+
+
+def test_timeouts_end_at_the_run_deadline(config, monkeypatch):
+    config["timeouts"] = {"powervs": {"connect": 5, "read": 60}}
+    assert get_timeout("powervs") == (5, 60)
+
+    monkeypatch.setattr(api_requests, "_run_deadline", time.time() + 3)
+    connect_timeout, read_timeout = get_timeout("powervs")
+    assert 2 < connect_timeout <= 3 and 2 < read_timeout <= 3
+
+
+def test_get_is_retried_on_5xx_and_connection_errors(session):
+    scripted_session = session(503, ConnectionError("reset"), 200)
+
+    response, error = get_request(URL)
+
+    assert response.status_code == 200 and error is None
+    assert len(scripted_session.requests) == 3
+    assert len(scripted_session.sleeps) == 2
+
+
+def test_post_is_retried_on_429(session):
+    scripted_session = session(429, 200)
+
+    response, error = post_request(URL, data={})
+
+    assert response.status_code == 200 and error is None
+    assert [method for method, _timeout in scripted_session.requests] == ["POST", "POST"]
+
+
+@pytest.mark.parametrize("outcome", [500, 503, ConnectionError("reset")])
+def test_post_is_not_retried_on_5xx_or_connection_errors(session, outcome):
+    # The import may have been accepted, sending it again would start a second one
+    scripted_session = session(outcome, 200)
+
+    response, error = post_request(URL, data={})
+
+    assert response is None and error
+    assert len(scripted_session.requests) == 1
+    assert not scripted_session.sleeps
+
+
+def test_retries_end_after_max_attempts(session, config):
+    config["retry"]["max_attempts"] = 3
+    scripted_session = session(503, 503, 503, 200)
+
+    response, error = get_request(URL)
+
+    assert response is None and "503" in error
+    assert len(scripted_session.requests) == 3
+
+
+def test_no_request_is_sent_after_the_run_deadline(session, monkeypatch):
+    scripted_session = session(200)
+    monkeypatch.setattr(api_requests, "_run_deadline", time.time() - 1)
+
+    assert get_request(URL) == (None, DEADLINE_EXCEEDED_ERROR)
+    assert not scripted_session.requests
+
+
+def test_request_timeouts_end_at_the_run_deadline(session, monkeypatch):
+    scripted_session = session(200)
+    monkeypatch.setattr(api_requests, "_run_deadline", time.time() + 3)
+
+    get_request(URL)
+
+    (_method, (connect_timeout, read_timeout)), = scripted_session.requests
+    assert connect_timeout <= 3 and read_timeout <= 3
+
+
+def test_token_bucket_allows_the_burst_then_the_rate():
+    token_bucket = TokenBucket(rate=20, burst=5)
+    started = time.monotonic()
+    waited = [token_bucket.acquire() for _ in range(15)]
+
+    # The first 5 requests pass at once, the next 10 at 20 per second
+    assert waited[:5] == [0.0] * 5
+    assert 0.4 <= time.monotonic() - started < 0.8
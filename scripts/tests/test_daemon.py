@@ -0,0 +1,120 @@
+"""
+Tests of the daemon: its token, the paths a job may write to, the listen address and a job handed to it
+by a client, run against the mock server of benchmark/mock_ibmcloud.py.
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+from jsonschema.exceptions import ValidationError
+from mock_ibmcloud import MockIBMCloud
+from run_benchmark import build_config
+
+import main
+from src import daemon
+from src.constants import validate_config
+from src.daemon import SUCCEEDED, JobDaemon, JobRequestHandler, serve, submit_job
+
+TOKEN = "daemon-token"
+
+
+@pytest.fixture
+def job_daemon(tmp_path):
+    """
+    Runs the job API of a daemon in a thread, with the job root tmp_path/root. Yields its url and the JobDaemon.
+    """
+    (tmp_path / "root").mkdir()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), JobRequestHandler)
+    server.token = TOKEN
+    server.job_daemon = JobDaemon(main.run, 1, str(tmp_path / "root"), multiprocessing.get_context("forkserver"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", server.job_daemon
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("headers", [{}, {"Authorization": "Bearer wrong-token"}, {"Authorization": TOKEN}])
+def test_daemon_answers_requests_without_its_token_with_401(job_daemon, tmp_path, headers):
+    url, daemon_jobs = job_daemon
+
+    assert requests.get(f"{url}/jobs", headers=headers, timeout=5).status_code == 401
+    response = requests.post(f"{url}/jobs", json={"config": {}, "directory": str(tmp_path / "root")}, headers=headers, timeout=5)
+    assert response.status_code == 401
+    assert not daemon_jobs.list_jobs()
+
+
+@pytest.fixture
+def job_paths(monkeypatch, tmp_path):
+    """
+    A JobDaemon with the job root tmp_path/root and the daemon directory tmp_path/root/daemon, a job directory below
+    the root with a symlink out of it, and a directory outside the root.
+    """
+    root = tmp_path / "root"
+    (root / "daemon").mkdir(parents=True)
+    (root / "job").mkdir()
+    (tmp_path / "outside").mkdir()
+    (root / "job" / "escape").symlink_to(tmp_path / "outside")
+    monkeypatch.chdir(root / "daemon")
+    return JobDaemon(main.run, 1, str(root)), root
+
+
+def test_check_job_paths_accepts_paths_below_the_job_root(job_paths):
+    job_daemon, root = job_paths
+    config = {"log_status_file_name": "logs/status.json", "journal": {"file_name": str(root / "journal.jsonl")}, "inventory_cache": {"directory": ".inv"}}
+    job_daemon.check_job_paths(config, str(root / "job"))
+
+
+@pytest.mark.parametrize(
+    "directory, config",
+    [
+        ("../outside", {}),
+        ("job", {"log_status_file_name": "../../outside/status.json"}),
+        ("job", {"log_operation_file_name": "/etc/ops.json"}),
+        ("job", {"journal": {"file_name": "escape/journal.jsonl"}}),
+        ("job/escape", {}),
+        ("job", {"inventory_cache": {"directory": "../../outside"}}),
+        ("job", {"inventory_cache": {"directory": ["not", "a", "path"]}}),
+    ],
+)
+def test_check_job_paths_rejects_paths_outside_the_job_root(job_paths, directory, config):
+    job_daemon, root = job_paths
+    with pytest.raises(ValueError):
+        job_daemon.check_job_paths(config, os.path.join(root, directory))
+
+
+def test_daemon_only_listens_on_a_loopback_address(config, tmp_path):
+    config.update(build_config({}, "STATUS", str(tmp_path), {"daemon.host": "0.0.0.0"}))
+    with pytest.raises(ValidationError):
+        validate_config()
+    with pytest.raises(SystemExit):
+        serve(main.run)
+
+
+def test_job_handed_to_the_daemon_runs_to_the_end(config, job_daemon, monkeypatch, tmp_path):
+    url, daemon_jobs = job_daemon
+    mock = MockIBMCloud(accounts=2, workspaces=2, job_seconds=0.2)
+    endpoints = mock.start()
+    job_directory = tmp_path / "root" / "job"
+    job_directory.mkdir()
+    monkeypatch.chdir(job_directory)
+    monkeypatch.setenv("IMAGE_SHARING_DAEMON_TOKEN", TOKEN)
+    monkeypatch.setenv("IBMCLOUD_API_KEY", "api-key")
+    monkeypatch.setattr(daemon, "PROGRESS_INTERVAL", 0.2)
+    config.clear()
+    config.update(build_config(endpoints, "STATUS", str(job_directory), {}))
+    try:
+        assert submit_job(url) == 0
+    finally:
+        mock.stop()
+
+    (job,) = daemon_jobs.list_jobs()
+    assert (job["state"], job["exit_code"], job["directory"]) == (SUCCEEDED, 0, str(job_directory))
+    status_log = json.loads((job_directory / "pi_image_status_log.json").read_text())
+    assert sum(len(account["workspaces"]) for account in status_log["missing_images"]) == 4
+    # The tokens of the job are kept for the next ones
+    assert len(next(iter(daemon_jobs.tokens.values()))) == 3
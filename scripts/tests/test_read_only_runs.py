@@ -0,0 +1,115 @@
+"""
+Tests of the runs which must not change anything: the STATUS scan and plan runs. They run main.run() against the mock
+server of benchmark/mock_ibmcloud.py and check that no import or delete request reached it.
+"""
+
+import json
+
+import pytest
+from mock_ibmcloud import MockIBMCloud
+from run_benchmark import build_config
+
+import main
+from src import metrics
+from src.metrics import MetricsRegistry
+
+JOURNAL_LINE = '{"account_id": "account-000000", "state": "submitted"}\n'
+STREAM_LINE = '{"phase": "operation", "account": {"id": "account-000000"}}\n'
+
+
+@pytest.fixture
+def enterprise(config, monkeypatch, tmp_path):
+    """
+    Runs the mock IBM Cloud with one account of three workspaces, and points CONFIG at it with a journal
+    and a result stream left over from an earlier import run.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("IBMCLOUD_API_KEY", "api-key")
+    monkeypatch.setenv("COS_ACCESS_KEY", "access-key")
+    monkeypatch.setenv("COS_SECRET_KEY", "secret-key")
+    # The plan estimates the requests of the real run from the ones counted by this run
+    monkeypatch.setattr(metrics, "_registry", MetricsRegistry())
+    mock = MockIBMCloud(accounts=1, workspaces=3, job_seconds=0.2)
+    endpoints = mock.start()
+    (tmp_path / "journal.jsonl").write_text(JOURNAL_LINE)
+    (tmp_path / "stream.jsonl").write_text(STREAM_LINE)
+    overrides = {
+        "journal.file_name": str(tmp_path / "journal.jsonl"),
+        "result_stream_file_name": str(tmp_path / "stream.jsonl"),
+        "inventory_cache.directory": str(tmp_path / "cache"),
+    }
+    config.clear()
+    config.update(build_config(endpoints, "STATUS", str(tmp_path), overrides))
+    yield mock
+    mock.stop()
+
+
+def assert_nothing_changed(mock, tmp_path):
+    stats = mock.get_stats()
+    assert not [call for call in stats if call.startswith("call.") and call.endswith((".POST", ".DELETE")) and call != "call.iam.POST"]
+    assert (tmp_path / "journal.jsonl").read_text() == JOURNAL_LINE
+    assert (tmp_path / "stream.jsonl").read_text() == STREAM_LINE
+
+
+def test_status_scan_reports_the_image_states_without_changing_them(enterprise, tmp_path):
+    workspace_ids = [workspace["id"] for workspace in enterprise.workspaces["account-000000"]]
+    # Active in the first workspace, still importing in the second, missing in the third
+    enterprise.images[workspace_ids[0]]["image-0"] = {"name": "test-image", "active_at": 0, "gone_at": None}
+    enterprise.images[workspace_ids[1]]["image-1"] = {"name": "test-image", "active_at": float("inf"), "gone_at": None}
+    enterprise.jobs[workspace_ids[1]] = {"completes_at": float("inf")}
+
+    main.run()
+
+    status_log = json.loads((tmp_path / "pi_image_status_log.json").read_text())
+    states = {
+        status: [(workspace["id"], workspace["job_state"], workspace.get("image_state")) for account in status_log[status] for workspace in account["workspaces"]]
+        for status in ("active_images", "inactive_images", "missing_images")
+    }
+    assert states == {
+        "active_images": [(workspace_ids[0], "none", None)],
+        "inactive_images": [(workspace_ids[1], "running", "queued")],
+        "missing_images": [(workspace_ids[2], "none", None)],
+    }
+    assert not status_log["other"]
+    assert_nothing_changed(enterprise, tmp_path)
+    # The image lists are read fresh and not cached
+    assert not (tmp_path / "cache" / "workspaces").exists()
+
+
+def test_plan_run_decides_like_a_real_run_without_changing_anything(enterprise, config, tmp_path):
+    workspace_ids = [workspace["id"] for workspace in enterprise.workspaces["account-000000"]]
+    enterprise.images[workspace_ids[0]]["image-0"] = {"name": "old-image", "active_at": 0, "gone_at": None}
+    enterprise.images[workspace_ids[2]]["image-2"] = {"name": "a", "active_at": 0, "gone_at": None}
+    config["images"] = [
+        {"image_name": "a", "operation": "IMPORT"},
+        {"image_name": "b", "operation": "IMPORT"},
+        {"image_name": "old-image", "operation": "DELETE"},
+    ]
+    config["plan"] = {"enabled": True, "file_name": str(tmp_path / "plan.json"), "expected_import_seconds": 2, "expected_delete_seconds": 1}
+
+    main.run()
+
+    plan = json.loads((tmp_path / "plan.json").read_text())
+    decisions = {
+        key: sorted((workspace["id"], workspace["image_name"]) for account in plan[key] for workspace in account["workspaces"])
+        for key in ("import", "delete", "queued", "skipped")
+    }
+    assert decisions == {
+        # b waits for a where a is imported, and is imported right away where a exists already
+        "import": [(workspace_ids[0], "a"), (workspace_ids[1], "a"), (workspace_ids[2], "b")],
+        "delete": [(workspace_ids[0], "old-image")],
+        "queued": [(workspace_ids[0], "b"), (workspace_ids[1], "b")],
+        "skipped": [(workspace_ids[1], "old-image"), (workspace_ids[2], "a"), (workspace_ids[2], "old-image")],
+    }
+    summary = plan["summary"]
+    assert (summary["import"], summary["delete"], summary["queued"], summary["skipped"], summary["workspaces"]) == (3, 1, 2, 3, 3)
+    # Polls of 0.5, 1 and 2 seconds see an import of 2 seconds complete, 0.5 and 1 a delete of 1 second:
+    # 3 polls per import, of which two run one after the other in workspaces 0 and 1, and 2 for the delete
+    assert summary["estimated_requests"] == {
+        "read": enterprise.get_stats()["requests"],
+        "import_delete": 6,
+        "status_poll": 17,
+        "total": enterprise.get_stats()["requests"] + 6 + 17,
+    }
+    assert summary["estimated_duration_seconds"]["status_poll"] == 7.0
+    assert_nothing_changed(enterprise, tmp_path)
@@ -0,0 +1,652 @@
+"""
+Tests of the run logic which needs no IBM Cloud account: resuming from the journal, queued imports,
+the adaptive concurrency limit, sharding, the token cache, the result stream and the inventory cache. Requests go to the mock server of benchmark/mock_ibmcloud.py.
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from mock_ibmcloud import MockIBMCloud
+from run_benchmark import build_config
+
+from src import ibmcloud_utils, inventory_cache, regions, run_journal, status_poller
+from src.adaptive_limit import AdaptiveLimit, SlotTimeout, start_adaptive_limit
+from src.constants import CONFIG, get_image_specs
+from src.custom_logger import ImageShareLogger, ResultStatus, log_account_level_image_op, merge_image_op_logs, merge_status_logs
+from src.ibmcloud_iam import get_child_account_token, get_enterprise_access_token
+from src.ibmcloud_powervs import get_powervs_workspaces, import_boot_image, workspace_from_details
+from src.ibmcloud_utils import image_ops_on_account_workspace, image_ops_on_workspace, init_worker
+from src.inventory_cache import get_cache_path, invalidate_boot_images, list_boot_images, list_powervs_workspaces, write_entry
+from src.regions import get_region_slots, region_slot, start_region_slots
+from src.result_stream import read_stream_log, report_results, start_stream
+from src.run_journal import get_journal_state, get_resumed_state, resume_workspace, set_journal_state, start_journal
+from src.sharding import get_account_shard, get_shard_file_name, in_shard, merge_logs, merge_shard_logs
+from src.status_poller import StatusPoller
+from src.token_cache import TokenCache, token_cache
+
+ACCOUNT = {"account_id": "account-000000", "profile_id": "Profile-account-000000", "name": "account-0"}
+WORKSPACE = {"name": "workspace-0", "id": "ws-0", "details": {"crn": "crn:ws-0"}, "location": {"url": "http://127.0.0.1"}}
+
+
+def image_spec(image_name, operation="import"):
+    return {"image_name": image_name, "operation": operation}
+
+
+def journal_record(image_name, state, workspace_id="ws-0", account_id="account-000000"):
+    workspace_details = {"name": "workspace-0", "id": workspace_id, "crn": f"crn:{workspace_id}", "base_url": "http://127.0.0.1", "image_name": image_name}
+    return {"account_id": account_id, "workspace": workspace_details, "state": state}
+
+
+def load_records(*records, listed=None):
+    set_journal_state(
+        (
+            {(record["account_id"], record["workspace"]["id"], record["workspace"]["image_name"]): record for record in records},
+            {ACCOUNT["account_id"]: listed} if listed is not None else {},
+        )
+    )
+
+
+def test_resumed_state_of_handled_images():
+    specs = [image_spec("a"), image_spec("b"), image_spec("c")]
+    load_records(journal_record("a", run_journal.SUBMITTED), journal_record("b", run_journal.COMPLETED), journal_record("c", run_journal.FAILED))
+
+    assert get_resumed_state(ACCOUNT, "ws-0", specs, specs[0]) == run_journal.SUBMITTED
+    assert get_resumed_state(ACCOUNT, "ws-0", specs, specs[1]) == run_journal.COMPLETED
+    # Failed images are tried again
+    assert get_resumed_state(ACCOUNT, "ws-0", specs, specs[2]) is None
+    assert get_resumed_state(ACCOUNT, "ws-1", specs, specs[0]) is None
+
+
+def test_queued_import_is_resumed_only_behind_a_submitted_one():
+    specs = [image_spec("a"), image_spec("b")]
+    load_records(journal_record("a", run_journal.SUBMITTED), journal_record("b", run_journal.QUEUED))
+    assert get_resumed_state(ACCOUNT, "ws-0", specs, specs[1]) == run_journal.QUEUED
+
+    # Once the import it waited for failed, the queued import has to be sent again
+    load_records(journal_record("a", run_journal.FAILED), journal_record("b", run_journal.QUEUED))
+    assert get_resumed_state(ACCOUNT, "ws-0", specs, specs[1]) is None
+
+
+def test_resume_workspace_logs_handled_images_and_returns_the_rest():
+    specs = [image_spec("a"), image_spec("b"), image_spec("c"), image_spec("d", "delete")]
+    load_records(journal_record("a", run_journal.SUBMITTED), journal_record("b", run_journal.QUEUED), journal_record("d", run_journal.SKIPPED))
+    logger = ImageShareLogger()
+
+    remaining_specs = resume_workspace(ACCOUNT, WORKSPACE, specs, logger)
+
+    assert remaining_specs == [specs[2]]
+    assert [(result.image_name, result.status) for result in logger.results] == [
+        ("a", ResultStatus.SUCCESS),
+        ("b", ResultStatus.QUEUED),
+        ("d", ResultStatus.SKIPPED),
+    ]
+
+
+def test_start_journal_loads_the_records_of_the_same_config(config, tmp_path):
+    journal_file = tmp_path / "journal.jsonl"
+    config["journal"] = {"file_name": str(journal_file), "resume": True}
+    fingerprint = run_journal.get_config_fingerprint()
+    lines = [
+        json.dumps({**journal_record("a", run_journal.SUBMITTED), "fingerprint": fingerprint}),
+        json.dumps({**journal_record("b", run_journal.SUBMITTED), "fingerprint": "other config"}),
+        json.dumps({"account_id": "account-000000", "state": run_journal.LISTED, "workspace_ids": ["ws-0"], "fingerprint": fingerprint}),
+        # A run killed mid-write leaves a partial last line
+        '{"account_id": "account-0',
+    ]
+    journal_file.write_text("\n".join(lines))
+
+    start_journal()
+
+    workspace_states, account_workspaces = get_journal_state()
+    assert list(workspace_states) == [("account-000000", "ws-0", "a")]
+    assert account_workspaces == {"account-000000": ["ws-0"]}
+
+
+def get_worker_resumed_state(specs):
+    return get_resumed_state(ACCOUNT, "ws-0", specs, specs[0])
+
+
+def test_spawned_pool_workers_resume_from_the_journal_of_the_parent(monkeypatch, tmp_path):
+    # Workers started by spawn log to their own console.log
+    monkeypatch.chdir(tmp_path)
+    specs = [image_spec("a")]
+    load_records(journal_record("a", run_journal.SUBMITTED))
+
+    with multiprocessing.get_context("spawn").Pool(1, initializer=init_worker, initargs=(None, None, None, None, None, get_journal_state())) as pool:
+        assert pool.apply(get_worker_resumed_state, (specs,)) == run_journal.SUBMITTED
+
+
+def test_resumed_workspace_records_only_the_results_of_this_run(monkeypatch):
+    specs = [image_spec("a"), image_spec("b", "delete")]
+    load_records(journal_record("a", run_journal.COMPLETED))
+    sent = []
+    recorded = []
+
+    def image_ops_on_workspace(image_specs, workspace, bearer_token, logger):
+        sent.extend(spec["image_name"] for spec in image_specs)
+        for spec in image_specs:
+            logger.log_success(workspace, spec["image_name"])
+
+    monkeypatch.setattr(ibmcloud_utils, "image_ops_on_workspace", image_ops_on_workspace)
+    monkeypatch.setattr(ibmcloud_utils, "record_workspace_outcome", lambda account, logger: recorded.extend(result.image_name for result in logger.results))
+    account_logger = ImageShareLogger()
+
+    image_ops_on_account_workspace(specs, ACCOUNT, WORKSPACE, "Bearer token", account_logger)
+
+    assert sent == ["b"]
+    # The completed import is in the journal already, recording it again would rewrite it as skipped
+    assert recorded == ["b"]
+    assert sorted((result.image_name, result.status) for result in account_logger.results) == [("a", ResultStatus.SKIPPED), ("b", ResultStatus.SUCCESS)]
+
+
+@pytest.fixture
+def mock_cloud(config, tmp_path):
+    """
+    Runs the mock IBM Cloud with one account of one workspace, whose imports take 0.2 seconds,
+    and points CONFIG at it with short status polling.
+    """
+    mock = MockIBMCloud(accounts=1, workspaces=1, job_seconds=0.2)
+    endpoints = mock.start()
+    overrides = {
+        "images": [{"image_name": "a", "operation": "IMPORT"}, {"image_name": "b", "operation": "IMPORT"}],
+        "status_poll.initial_interval": 0.1,
+        "status_poll.max_interval": 0.2,
+        "status_poll.deadline": 10,
+        "journal.file_name": "",
+    }
+    config.clear()
+    config.update(build_config(endpoints, "IMPORT", str(tmp_path), overrides))
+    yield mock
+    mock.stop()
+
+
+def poll_two_imports(mock_cloud):
+    """
+    Sends the import of image a to the workspace of the mock, hands it to a status poller with the import
+    of image b queued behind it, and returns the status log once the poller finished.
+    """
+    image_specs = get_image_specs()
+    enterprise_access_token, _error = get_enterprise_access_token("api-key")
+    access_token, _error = get_child_account_token(ACCOUNT["profile_id"], ACCOUNT["account_id"], enterprise_access_token)
+    workspace_details = {"name": "workspace-0", "id": "account-000000-ws-000", "crn": "crn:ws", "base_url": CONFIG["endpoints"]["powervs"]}
+    response, _error = import_boot_image(workspace_from_details({**workspace_details, "image_name": "a"}), f"Bearer {access_token}", image_specs[0])
+    assert response
+
+    poller = StatusPoller(image_specs, [ACCOUNT], enterprise_access_token)
+    poller.open()
+    poller.start()
+    poller.inbox.put((ACCOUNT, [("success", {**workspace_details, "image_name": "a"}), ("queued", {**workspace_details, "image_name": "b"})]))
+    return poller.finish()
+
+
+def test_status_poller_starts_the_queued_import_once_the_first_completed(mock_cloud):
+    status_log = poll_two_imports(mock_cloud)
+
+    assert [workspace["image_name"] for account in status_log["success"] for workspace in account["workspaces"]] == ["a", "b"]
+    assert not status_log["failed"] and not status_log["timed_out"]
+    assert mock_cloud.get_stats()["call.powervs.POST"] == 2
+
+
+def test_status_poller_keeps_polling_after_a_check_raised(mock_cloud, monkeypatch):
+    get_image_op_status = status_poller.get_image_op_status
+    calls = []
+
+    def raise_first_checks(*args):
+        calls.append(args)
+        if len(calls) <= 2:
+            # E.g. a 200 response without status.state
+            raise KeyError("state")
+        return get_image_op_status(*args)
+
+    monkeypatch.setattr(status_poller, "get_image_op_status", raise_first_checks)
+
+    status_log = poll_two_imports(mock_cloud)
+
+    assert [workspace["image_name"] for account in status_log["success"] for workspace in account["workspaces"]] == ["a", "b"]
+
+
+def test_status_poller_threads_start_after_the_pool_workers_exist(mock_cloud, monkeypatch, tmp_path):
+    CONFIG["processes"] = 2
+    start = StatusPoller.start
+    children_at_start = []
+
+    def record_children(poller):
+        children_at_start.append(len(multiprocessing.active_children()))
+        start(poller)
+
+    monkeypatch.setattr(StatusPoller, "start", record_children)
+    enterprise_access_token, _error = get_enterprise_access_token("api-key")
+    ops_log_file, ops_status_log_file = tmp_path / "ops.json", tmp_path / "status.json"
+
+    ibmcloud_utils.image_ops_on_child_accounts(get_image_specs(), [ACCOUNT], enterprise_access_token, str(ops_log_file), str(ops_status_log_file))
+
+    # No worker is forked while a poller thread could hold a lock
+    assert children_at_start == [2]
+    status_log = json.loads(ops_status_log_file.read_text())
+    assert [workspace["image_name"] for account in status_log["success"] for workspace in account["workspaces"]] == ["a", "b"]
+    assert mock_cloud.get_stats()["call.powervs.POST"] == 2
+
+
+def test_adaptive_limit_grows_by_one_per_round_of_requests():
+    adaptive_limit = AdaptiveLimit(floor=1, ceiling=3, initial=2, backoff_ratio=0.5, latency_tolerance=2.0)
+    # 2 + 1/2 + 1/2.5 + 1/2.9
+    for _ in range(3):
+        adaptive_limit.acquire()
+        adaptive_limit.release("powervs", 0.1, 200)
+    assert adaptive_limit.get_limits()["current"] == 3
+
+    for _ in range(10):
+        adaptive_limit.acquire()
+        adaptive_limit.release("powervs", 0.1, 200)
+    assert adaptive_limit.get_limits() == {"current": 3, "lowest": 2, "highest": 3}
+
+
+@pytest.mark.parametrize("status", [429, 503, "error"])
+def test_adaptive_limit_backs_off_once_per_burst_of_errors(status):
+    adaptive_limit = AdaptiveLimit(floor=3, ceiling=20, initial=10, backoff_ratio=0.5, latency_tolerance=2.0)
+    adaptive_limit.acquire()
+    adaptive_limit.release("iam", 0.1, status)
+    assert adaptive_limit.get_limits()["current"] == 5
+
+    # Errors of requests sent before the decrease do not lower the limit again
+    adaptive_limit.acquire()
+    adaptive_limit.release("iam", 0.1, status)
+    assert adaptive_limit.get_limits()["current"] == 5
+
+
+def test_adaptive_limit_stays_above_the_floor():
+    adaptive_limit = AdaptiveLimit(floor=3, ceiling=20, initial=4, backoff_ratio=0.5, latency_tolerance=2.0)
+    adaptive_limit.acquire()
+    adaptive_limit.release("powervs", 0.1, 429)
+    assert adaptive_limit.get_limits()["current"] == 3
+
+
+def test_adaptive_limit_backs_off_when_latency_grows():
+    adaptive_limit = AdaptiveLimit(floor=1, ceiling=20, initial=10, backoff_ratio=0.5, latency_tolerance=2.0)
+    adaptive_limit.acquire()
+    adaptive_limit.release("powervs", 0.01, 200)
+    for _ in range(20):
+        adaptive_limit.acquire()
+        adaptive_limit.release("powervs", 0.1, 200)
+    assert adaptive_limit.get_limits()["lowest"] < 10
+
+
+def test_adaptive_limit_ignores_requests_failed_for_other_reasons():
+    adaptive_limit = AdaptiveLimit(floor=1, ceiling=20, initial=10, backoff_ratio=0.5, latency_tolerance=2.0)
+    adaptive_limit.acquire()
+    adaptive_limit.release("enterprise", 0.1, None)
+    assert adaptive_limit.get_limits() == {"current": 10, "lowest": 10, "highest": 10}
+
+
+def test_adaptive_slot_wait_ends_at_the_timeout():
+    adaptive_limit = AdaptiveLimit(floor=1, ceiling=1, initial=1, backoff_ratio=0.5, latency_tolerance=2.0)
+    adaptive_limit.acquire()
+    with pytest.raises(SlotTimeout):
+        adaptive_limit.acquire(timeout=0.1)
+
+    adaptive_limit.release("powervs", 0.1, 200)
+    assert adaptive_limit.acquire(timeout=0.1) < 0.1
+
+
+def test_adaptive_limit_needs_floor_below_initial_below_ceiling(config):
+    config["adaptive_concurrency"] = {"enabled": True, "floor": 8, "initial": 4, "ceiling": 16}
+    with pytest.raises(SystemExit):
+        start_adaptive_limit()
+
+
+def hold_region_slot(url):
+    with region_slot(url):
+        started = time.time()
+        time.sleep(0.2)
+        return started, time.time()
+
+
+@pytest.mark.parametrize("start_method", ["fork", "spawn"])
+def test_region_limit_holds_over_all_pool_workers(config, monkeypatch, tmp_path, start_method):
+    monkeypatch.chdir(tmp_path)
+    config["regions"] = {"max_concurrency": 2}
+    url = "https://us-south.power-iaas.cloud.ibm.com"
+    # Locks of one start method cannot be handed to processes of another
+    monkeypatch.setattr(regions, "multiprocessing", multiprocessing.get_context(start_method))
+    start_region_slots()
+    # The row of the region takes its limit from the process which works on it first
+    with region_slot(url):
+        pass
+
+    with multiprocessing.get_context(start_method).Pool(4, initializer=init_worker, initargs=(None, None, None, None, get_region_slots(), get_journal_state())) as pool:
+        spans = pool.map(hold_region_slot, [url] * 8, chunksize=1)
+
+    most_at_once = max(sum(started <= moment < ended for started, ended in spans) for moment, _ended in spans)
+    assert most_at_once == 2
+
+
+def test_accounts_are_split_evenly_and_always_into_the_same_shard():
+    account_ids = [f"account-{index:06d}" for index in range(4000)]
+    shards = [get_account_shard(account_id, 4) for account_id in account_ids]
+
+    assert shards == [get_account_shard(account_id, 4) for account_id in account_ids]
+    assert all(600 < shards.count(index) < 1400 for index in range(4))
+
+
+def test_a_run_works_on_the_accounts_of_its_shard(config):
+    account_ids = [f"account-{index:06d}" for index in range(100)]
+    assert all(in_shard(account_id) for account_id in account_ids)
+
+    selected = []
+    for index in range(3):
+        config["sharding"] = {"index": index, "count": 3}
+        selected.append({account_id for account_id in account_ids if in_shard(account_id)})
+    assert set().union(*selected) == set(account_ids)
+    assert sum(map(len, selected)) == len(account_ids)
+    assert get_shard_file_name("pi_image_ops_log.json") == "pi_image_ops_log.shard-2-of-3.json"
+
+
+def test_merge_logs_puts_the_account_entries_of_the_shards_together():
+    operation_logs = [merge_image_op_logs([]) for _ in range(2)]
+    operation_logs[0]["success"].append({"account_id": "a"})
+    operation_logs[1]["success"].append({"account_id": "b"})
+    operation_logs[1]["other"].append({"account_id": "c"})
+    merged_log = merge_logs(operation_logs)
+    assert merged_log["success"] == [{"account_id": "a"}, {"account_id": "b"}]
+    assert merged_log["other"] == [{"account_id": "c"}]
+
+    status_logs = [merge_status_logs([]) for _ in range(2)]
+    status_logs[1]["active_images"].append({"account_id": "b"})
+    assert merge_logs(status_logs) == {**merge_status_logs([]), "active_images": [{"account_id": "b"}]}
+
+
+def write_shard_logs(file_name, log, indexes):
+    for index in indexes:
+        with open(get_shard_file_name(file_name, index), "w", encoding="utf-8") as f:
+            json.dump(log, f)
+
+
+def test_merge_shard_logs_needs_the_status_log_of_every_shard(config, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    config.update({"log_operation_file_name": "ops.json", "log_status_file_name": "status.json", "sharding": {"index": 0, "count": 2}})
+    write_shard_logs("ops.json", merge_image_op_logs([]), [0, 1])
+    write_shard_logs("status.json", merge_image_op_logs([]), [0])
+
+    # The status log of shard 1 may be left from an earlier run, it must not be merged as the one of this run
+    with pytest.raises(SystemExit):
+        merge_shard_logs()
+    assert not (tmp_path / "status.json").exists()
+
+    write_shard_logs("status.json", merge_image_op_logs([]), [1])
+    merge_shard_logs()
+    assert json.loads((tmp_path / "status.json").read_text()) == merge_image_op_logs([])
+    assert json.loads((tmp_path / "ops.json").read_text()) == merge_image_op_logs([])
+
+
+class TokenResponse:
+    def __init__(self, access_token, expires_in):
+        self.token_details = {"access_token": access_token, "expires_in": expires_in}
+
+    def json(self):
+        return self.token_details
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+def counting_exchange(exchanges, expires_in=1000, delay=0):
+    def exchange():
+        time.sleep(delay)
+        exchanges.append(None)
+        return TokenResponse(f"token-{len(exchanges)}", expires_in), None
+
+    return exchange
+
+
+def test_cached_token_is_refreshed_once_the_refresh_margin_is_reached(config, monkeypatch):
+    config["token_refresh_margin"] = 300
+    clock = Clock()
+    monkeypatch.setattr("src.token_cache.time", clock)
+    cache = TokenCache()
+    exchanges = []
+
+    assert cache.get_token(("profile", "account"), counting_exchange(exchanges)) == ("token-1", None)
+    clock.now += 699
+    assert cache.get_token(("profile", "account"), counting_exchange(exchanges)) == ("token-1", None)
+    clock.now += 1
+    assert cache.get_token(("profile", "account"), counting_exchange(exchanges)) == ("token-2", None)
+    assert len(exchanges) == 2
+
+
+def test_failed_exchange_is_not_cached():
+    cache = TokenCache()
+    assert cache.get_token(("profile", "account"), lambda: (None, "HTTP error occurred")) == (None, "HTTP error occurred")
+    assert cache.export() == {}
+
+
+def test_concurrent_callers_share_one_exchange_per_key():
+    cache = TokenCache()
+    exchanges = {"account-a": [], "account-b": []}
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        tokens = list(
+            executor.map(
+                lambda account_id: cache.get_token(("profile", account_id), counting_exchange(exchanges[account_id], delay=0.1)),
+                ["account-a", "account-b"] * 8,
+            )
+        )
+
+    assert {account_id: len(account_exchanges) for account_id, account_exchanges in exchanges.items()} == {"account-a": 1, "account-b": 1}
+    assert set(tokens) == {("token-1", None)}
+
+
+def test_key_locks_are_reset_in_a_forked_process():
+    cache = TokenCache()
+    # Held by a thread of the parent when the worker was forked
+    cache._get_key_lock(("profile", "account")).acquire()
+    cache._pid = -1
+    exchanges = []
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(cache.get_token(("profile", "account"), counting_exchange(exchanges))), daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert result == [("token-1", None)]
+
+
+def test_exported_tokens_are_reused_by_another_cache(config, monkeypatch):
+    config["token_refresh_margin"] = 300
+    clock = Clock()
+    monkeypatch.setattr("src.token_cache.time", clock)
+    cache = TokenCache()
+    cache.get_token(("profile", "account-a"), counting_exchange([], expires_in=1000))
+    cache.get_token(("profile", "account-b"), counting_exchange([], expires_in=200))
+
+    # Tokens within the refresh margin are not handed on
+    tokens = cache.export()
+    assert list(tokens) == [("profile", "account-a")]
+
+    other_cache = TokenCache()
+    other_cache.load(tokens)
+    exchanges = []
+    assert other_cache.get_token(("profile", "account-a"), counting_exchange(exchanges)) == ("token-1", None)
+    assert not exchanges
+
+
+def test_token_answered_with_401_is_minted_again(mock_cloud, monkeypatch):
+    monkeypatch.setattr(token_cache, "_tokens", {})
+    key = (ACCOUNT["profile_id"], ACCOUNT["account_id"])
+    # E.g. revoked before it expired
+    token_cache.load({key: ("revoked", time.monotonic() + 3600)})
+    enterprise_access_token, _error = get_enterprise_access_token("api-key")
+
+    access_token, _error = get_child_account_token(*key, enterprise_access_token)
+    response, error = get_powervs_workspaces(f"Bearer {access_token}")
+    assert access_token == "revoked" and response is None and "401" in error
+
+    access_token, _error = get_child_account_token(*key, enterprise_access_token)
+    response, error = get_powervs_workspaces(f"Bearer {access_token}")
+    assert access_token != "revoked" and response and error is None
+    assert mock_cloud.get_stats()["call.iam.POST"] == 2
+
+
+def stream_account(index):
+    return {"account_id": f"account-{index:06d}", "name": f"account-{index}"}
+
+
+def report_account(phase, index, target_logger=None):
+    """
+    Reports the results of an account workspace by workspace, as the operation pass and the status poller do:
+    every state of ResultStatus, with long messages so the batches are larger than a write buffer, and an
+    account level error for every third account.
+    """
+    account = stream_account(index)
+    log_methods = ("log_success", "log_skipped", "log_failure", "log_timeout", "log_queued")
+    for number in range(10):
+        workspace = {"name": f"workspace-{number}", "id": f"{account['account_id']}-ws-{number}", "details": {"crn": f"crn:{number}"}, "location": {"url": "http://127.0.0.1"}}
+        workspace_logger = ImageShareLogger()
+        for image_number in range(5):
+            log_method = getattr(workspace_logger, log_methods[(index + number + image_number) % len(log_methods)])
+            log_method(workspace, f"image-{image_number}", f"{phase} {account['account_id']} {number} " + "x" * 2000)
+        report_results(phase, account, workspace_logger, target_logger)
+    if index % 3 == 0:
+        account_logger = ImageShareLogger()
+        account_logger.log_other(account, f"Failed to retrieve access token for account - {account['account_id']}")
+        report_results(phase, account, account_logger, target_logger)
+
+
+def report_stream_accounts(index):
+    report_account("operation", index)
+    report_account("status", index)
+
+
+def get_memory_log(phase, indexes):
+    account_logs = []
+    for index in indexes:
+        account_logger = ImageShareLogger()
+        report_account(phase, index, account_logger)
+        account_logs.append(log_account_level_image_op(ImageShareLogger(), account_logger, stream_account(index)))
+    return merge_image_op_logs(account_logs)
+
+
+def sort_accounts(log):
+    return {key: sorted(entries, key=lambda entry: entry.get("id") or entry.get("account_id")) for key, entries in log.items()}
+
+
+def test_stream_log_equals_the_log_kept_in_memory(config, tmp_path):
+    expected = {phase: get_memory_log(phase, range(6)) for phase in ("operation", "status")}
+    config["result_stream_file_name"] = str(tmp_path / "stream.jsonl")
+    start_stream()
+
+    for index in range(6):
+        report_stream_accounts(index)
+
+    assert expected["operation"]["other"]
+    assert read_stream_log("operation") == expected["operation"]
+    assert read_stream_log("status") == expected["status"]
+
+
+def test_stream_log_of_concurrent_pool_workers_equals_the_log_kept_in_memory(config, tmp_path):
+    expected = {phase: get_memory_log(phase, range(24)) for phase in ("operation", "status")}
+    config["result_stream_file_name"] = str(tmp_path / "stream.jsonl")
+    start_stream()
+
+    with multiprocessing.Pool(6) as pool:
+        pool.map(report_stream_accounts, range(24), chunksize=1)
+
+    # Accounts appear in the order the workers reported them, the workspaces of an account in their order
+    assert sort_accounts(read_stream_log("operation")) == sort_accounts(expected["operation"])
+    assert sort_accounts(read_stream_log("status")) == sort_accounts(expected["status"])
+
+
+class ListResponse:
+    def __init__(self, key, items):
+        self.listing = {key: items}
+
+    def json(self):
+        return self.listing
+
+
+@pytest.fixture
+def cache_clock(config, monkeypatch, tmp_path):
+    """
+    Puts the inventory cache below tmp_path, with 'workspaces_ttl' 3600 and 'images_ttl' 300, on a clock moved by the test.
+    """
+    config["inventory_cache"] = {"directory": str(tmp_path / "cache"), "workspaces_ttl": 3600, "images_ttl": 300}
+    clock = Clock()
+    monkeypatch.setattr("src.inventory_cache.time", clock)
+    return clock
+
+
+@pytest.mark.parametrize(
+    "list_function, fetch_function, key, ttl",
+    [
+        (list_powervs_workspaces, "get_powervs_workspaces", "workspaces", 3600),
+        (list_boot_images, "get_boot_images", "images", 300),
+    ],
+)
+def test_inventory_cache_entries_expire_after_their_ttl(cache_clock, monkeypatch, list_function, fetch_function, key, ttl):
+    fetches = []
+
+    def fetch(*args):
+        fetches.append(args)
+        return ListResponse(key, [{"id": f"item-{len(fetches)}"}]), None
+
+    monkeypatch.setattr(inventory_cache, fetch_function, fetch)
+    argument = "account-000000" if key == "workspaces" else WORKSPACE
+
+    assert list_function(argument, "Bearer token") == ([{"id": "item-1"}], None)
+    cache_clock.now += ttl
+    assert list_function(argument, "Bearer token") == ([{"id": "item-1"}], None)
+    cache_clock.now += 1
+    assert list_function(argument, "Bearer token") == ([{"id": "item-2"}], None)
+    assert len(fetches) == 2
+
+
+def test_failed_listing_is_not_cached(cache_clock, monkeypatch):
+    monkeypatch.setattr(inventory_cache, "get_boot_images", lambda *args: (None, "HTTP error occurred"))
+    assert list_boot_images(WORKSPACE, "Bearer token") == (None, "HTTP error occurred")
+    assert not os.path.exists(get_cache_path("workspaces", WORKSPACE["id"]))
+
+
+@pytest.mark.parametrize("operation, existing", [("IMPORT", None), ("DELETE", "a")])
+def test_image_list_is_dropped_from_the_cache_once_a_request_was_accepted(mock_cloud, config, tmp_path, operation, existing):
+    config["inventory_cache"] = {"directory": str(tmp_path / "cache")}
+    config["images"] = [{"image_name": "a", "operation": operation}]
+    access_token, _error = get_child_account_token(ACCOUNT["profile_id"], ACCOUNT["account_id"], get_enterprise_access_token("api-key")[0])
+    (workspace,) = mock_cloud.workspaces[ACCOUNT["account_id"]]
+    if existing:
+        mock_cloud.images[workspace["id"]]["image-a"] = {"name": existing, "active_at": 0, "gone_at": None}
+    list_boot_images(workspace, f"Bearer {access_token}")
+    assert os.path.exists(get_cache_path("workspaces", workspace["id"]))
+
+    logger = ImageShareLogger()
+    image_ops_on_workspace(get_image_specs(), workspace, f"Bearer {access_token}", logger)
+
+    assert [result.status for result in logger.results] == [ResultStatus.SUCCESS]
+    assert not os.path.exists(get_cache_path("workspaces", workspace["id"]))
+
+
+def test_concurrent_invalidation_of_an_entry_does_not_raise(cache_clock):
+    write_entry("workspaces", WORKSPACE["id"], [{"id": "image-0"}])
+    barrier = threading.Barrier(16)
+
+    def invalidate():
+        barrier.wait()
+        invalidate_boot_images(WORKSPACE["id"])
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for future in [executor.submit(invalidate) for _ in range(16)]:
+            future.result()
+
+    assert not os.path.exists(get_cache_path("workspaces", WORKSPACE["id"]))
+    # Dropping an entry which is not cached is no error either
+    invalidate_boot_images("ws-unknown")
@@ -22,11 +22,11 @@ variable "account_list" {
 }
 
 variable "image_operation" {
-  description = "Select the import or delete operation to be performed for the custom PowerVS boot image."
+  description = "Select the import or delete operation to be performed for the custom PowerVS boot image, or STATUS to only report the image state in every workspace."
   type        = string
   validation {
     condition     = var.image_operation == "IMPORT" || var.image_operation == "DELETE" || var.image_operation == "STATUS"
-    error_message = "Supported values are IMPORT and DELETE"
+    error_message = "Supported values are IMPORT, DELETE and STATUS"
   }
 }
 
@@ -74,3 +74,13 @@ variable "processes" {
   type        = number
   default     = 10
 }
+
+variable "run_deadline" {
+  description = "Seconds the script may run. Requests are not sent after the deadline and the remaining workspaces are logged as timed out, so the local-exec provisioner cannot hang on an unresponsive endpoint."
+  type        = number
+  default     = 7200
+  validation {
+    condition     = var.run_deadline > 0
+    error_message = "The run_deadline must be a positive number of seconds."
+  }
+}